@@ -0,0 +1,74 @@
+"""Per-record execution (chained and compiled) vs. batched execution of pipelines.
+
+Usage:
+
+    > PYTHONPATH=. python benchmarks/bench_batch.py [--records N] [--repeat N] [--batch-size N]
+"""
+import json
+import time
+import argparse
+
+from json_pipeline.transform import Transform
+
+from datasets import generate_lines
+
+
+PIPELINES = {
+    'filters': [
+        {'operation': 'filter_not_exists', 'field': 'name'},
+        {'operation': 'filter_regex', 'field': 'name', 'regex': r'^(office|store)', 'regex_flags': ['I']},
+        {'operation': 'filter_regex_neg', 'field': 'description', 'regex': r'closed'},
+        {'operation': 'cross_filter', 'field': 'description', 'target': 'city'},
+    ],
+    'mapping': [
+        {'operation': 'fixed_value', 'field': 'chain', 'target': 'USPS'},
+        {'operation': 'rename_field', 'field': 'description', 'target': 'title'},
+        {'operation': 'remove_fields', 'field': 'open_hours,chain'},
+        {'operation': 'rename_field', 'field': 'title', 'target': 'description'},
+    ],
+    'plaintext': [
+        {'operation': 'plaintext', 'field': 'description'},
+    ],
+    'mixed': [
+        {'operation': 'filter_regex', 'field': 'name', 'regex': r'^(office|store)', 'regex_flags': ['I']},
+        {'operation': 'fixed_value', 'field': 'chain', 'target': 'USPS'},
+        {'operation': 'plaintext', 'field': 'name'},
+        {'operation': 'dedupe', 'field': 'id'},
+        {'operation': 'remove_fields', 'field': 'open_hours'},
+    ],
+}
+
+
+def timeit(func, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        dataset = [json.loads(l) for l in lines]
+        start = time.perf_counter()
+        for _ in func(dataset):
+            pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=1024)
+    args = parser.parse_args()
+
+    lines = generate_lines(args.records)
+    for name, steps in PIPELINES.items():
+        pipeline = [Transform.args_from_dict(step) for step in steps]
+        chained = timeit(lambda dataset: Transform.chain(dataset, pipeline), lines, args.repeat)
+        compiled = timeit(Transform.compile(pipeline), lines, args.repeat)
+        batched = timeit(Transform.batched(pipeline, args.batch_size), lines, args.repeat)
+        print(f'{name}: chained {chained / args.records * 1e6:.2f} us/record, '
+              f'compiled {compiled / args.records * 1e6:.2f} us/record, '
+              f'batched {batched / args.records * 1e6:.2f} us/record, '
+              f'speedup x{compiled / batched:.2f} over compiled (x{chained / batched:.2f} over chained)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Decoding + filtering + encoding throughput of the available codecs, eager and lazy, on filter-heavy
+pipelines over wide records.
+
+Usage:
+
+    > PYTHONPATH=. python benchmarks/bench_codec.py [--records N] [--repeat N]
+"""
+import json
+import time
+import argparse
+
+from json_pipeline.transform import Transform
+from json_pipeline.codec import get_codec, BACKENDS
+
+
+PIPELINES = {
+    'filter first field (10% pass)': [
+        {'operation': 'filter_regex', 'field': 'id', 'regex': r'0$'},
+    ],
+    'filter + dedupe (10% pass)': [
+        {'operation': 'filter_regex', 'field': 'id', 'regex': r'0$'},
+        {'operation': 'filter_not_exists', 'field': 'name'},
+        {'operation': 'dedupe', 'field': 'id'},
+    ],
+    'filter last field (50% pass)': [
+        {'operation': 'filter_regex', 'field': 'last', 'regex': r'[02468]$'},
+    ],
+}
+
+
+def make_lines(count, width=30):
+    lines = []
+    for i in range(count):
+        d = {'id': str(i), 'name': f'Office {i}'}
+        d.update((f'field{j}', f'value {j} of record {i}' * 3) for j in range(width))
+        d['nested'] = {'a': [1, 2, 3], 'b': {'c': 'd'}}
+        d['last'] = str(i)
+        lines.append(json.dumps(d))
+    return lines
+
+
+def run(lines, pipeline, decode, encode):
+    return sum(1 for _ in map(encode, Transform.compile(pipeline)(map(decode, lines))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    lines = make_lines(args.records)
+    codecs = []
+    for name in BACKENDS:
+        try:
+            codecs.append(get_codec(name))
+        except ImportError:
+            print(f'{name}: not installed')
+
+    for title, steps in PIPELINES.items():
+        pipeline = [Transform.args_from_dict(s) for s in steps]
+        print(title)
+        for codec in codecs:
+            for mode, decode in (('eager', codec.decode), ('lazy', codec.lazy_decode)):
+                best = min(timed(run, lines, pipeline, decode, codec.encode) for _ in range(args.repeat))
+                print(f'    {codec.name:>8} {mode:>5}: {args.records / best:12,.0f} records/s')
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""End-to-end latency of --follow, from the append of an input line to the write of its output record.
+
+A producer appends --records lines at --rate lines per second to a file followed by the command line tool,
+in a separate process, while a tailer polls its output file. The latency of each record is the time from its
+append (saved into the record) to the time its output line is seen, so it includes up to --tail-poll seconds
+of measurement error. Each --flush-intervals value is run separately.
+
+Usage:
+
+    > PYTHONPATH=. python benchmarks/bench_follow.py [--records N] [--rate N] [--save results.json]
+    > PYTHONPATH=. python benchmarks/bench_follow.py --compare results.json --threshold 0.5
+
+With --compare, the run fails (exit code 1) if any latency is higher than the baseline by more than the given
+threshold (a fraction).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def tail(path, count, latencies, poll):
+    # reads the output lines as they are written, recording the latency of each one
+    while not os.path.exists(path):
+        time.sleep(poll)
+    with open(path, 'rb') as f:
+        buffer = b''
+        while len(latencies) < count:
+            data = f.read()
+            if not data:
+                time.sleep(poll)
+                continue
+            now = time.time()
+            buffer += data
+            *lines, buffer = buffer.split(b'\n')
+            latencies.extend(now - json.loads(line)['t'] for line in lines)
+
+
+def run(records, rate, flush_interval, poll_interval, tail_poll):
+    """Returns the list of latencies (in seconds) of the given number of records.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inpath, outpath = os.path.join(tmpdir, 'in.jl'), os.path.join(tmpdir, 'out.jl')
+        open(inpath, 'w').close()
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (ROOT, os.environ.get('PYTHONPATH')) if p))
+        process = subprocess.Popen([sys.executable, '-m', 'json_pipeline.transform', '--input', inpath,
+                                    '--output', outpath, '--follow', '--idle-timeout', '1',
+                                    '--flush-interval', str(flush_interval), '--poll-interval', str(poll_interval),
+                                    'plaintext', '--field', 'name'], env=env)
+        latencies = []
+        tailer = threading.Thread(target=tail, args=(outpath, records, latencies, tail_poll), daemon=True)
+        tailer.start()
+        # let the command start before the first append
+        time.sleep(0.5)
+        with open(inpath, 'a') as f:
+            start = time.perf_counter()
+            for i in range(records):
+                f.write(json.dumps({'id': i, 'name': f'Office {i}', 't': time.time()}) + '\n')
+                f.flush()
+                delay = start + (i + 1) / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        process.wait()
+        tailer.join(5)
+        if process.returncode or len(latencies) < records:
+            raise RuntimeError(f'the run failed ({len(latencies)} of {records} records written)')
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=1000, help='Appended lines per second')
+    parser.add_argument('--flush-intervals', type=float, nargs='+', default=[0.0, 0.01, 0.1, 0.5])
+    parser.add_argument('--poll-interval', type=float, default=0.1, help='--poll-interval of the command')
+    parser.add_argument('--tail-poll', type=float, default=0.0005, help='Poll interval of the output tailer')
+    parser.add_argument('--save', help='Save results as JSON into this file')
+    parser.add_argument('--compare', help='Compare results against this baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='Allowed slowdown against the baseline, as a fraction (default: %(default)s)')
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'flush interval':<20} {'p50 (ms)':>10} {'p95 (ms)':>10} {'p99 (ms)':>10} {'max (ms)':>10}")
+    for interval in args.flush_intervals:
+        latencies = run(args.records, args.rate, interval, args.poll_interval, args.tail_poll)
+        stats = {f'p{pct}': percentile(latencies, pct) for pct in (50, 95, 99)}
+        stats['max'] = max(latencies)
+        for name, value in stats.items():
+            results[f'flush={interval}/{name}'] = value
+        print(f'{interval:<20} ' + ' '.join(f'{value * 1000:>10.1f}' for value in stats.values()))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'rate': args.rate, 'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print('\nComparison against baseline (speedup):')
+        regressions = []
+        for name, value in sorted(results.items()):
+            if name not in baseline:
+                continue
+            ratio = baseline[name] / value
+            flag = ''
+            if ratio < 1 - args.threshold:
+                regressions.append(name)
+                flag = '  REGRESSION'
+            print(f'{name:<30} {ratio:>8.2f}x{flag}')
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Startup time of the command line tool.
+
+Measures the import time of json_pipeline.transform (as reported by python -X importtime, best of --repeat
+runs) and the end-to-end time of running the command line over an empty input, and lists the heaviest
+imports. Both run in fresh interpreters.
+
+Usage:
+
+    > PYTHONPATH=. python benchmarks/bench_startup.py [--repeat N] [--save results.json]
+    > PYTHONPATH=. python benchmarks/bench_startup.py --compare results.json --threshold 0.2
+
+With --compare, the run fails (exit code 1) if any time is slower than the baseline by more than the given
+threshold (a fraction), or if any of HEAVY_MODULES is imported at startup.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+# modules that only some operations and options need
+HEAVY_MODULES = ('sqlite3', 'multiprocessing', 'concurrent.futures', 'asyncio', 'yaml', 'bz2', 'lzma')
+
+COMMANDS = {
+    'plaintext': ['plaintext', '--field', 'name'],
+    'filter_regex': ['filter_regex', '--field', 'name', '--regex', 'office', '--regex-flags', 'I'],
+    'dedupe': ['dedupe', '--field', 'id'],
+}
+
+
+def _env():
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (root, env.get('PYTHONPATH')) if p)
+    return env
+
+
+def import_times(repeat):
+    """Returns the best total import time of json_pipeline.transform in seconds, and the self import times of
+    the modules of that run.
+    """
+    best, modules = None, None
+    for _ in range(repeat):
+        stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import json_pipeline.transform'],
+                                env=_env(), stderr=subprocess.PIPE, text=True, check=True).stderr
+        times = {}
+        for line in stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            own, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = (int(own) / 1e6, int(cumulative) / 1e6)
+        total = times['json_pipeline.transform'][1]
+        if best is None or total < best:
+            best, modules = total, times
+    return best, modules
+
+
+def loaded_heavy_modules():
+    code = 'import sys, json_pipeline.transform; print(",".join(sorted(sys.modules)))'
+    loaded = subprocess.run([sys.executable, '-c', code], env=_env(), stdout=subprocess.PIPE, text=True,
+                            check=True).stdout.strip().split(',')
+    return [m for m in HEAVY_MODULES if m in loaded]
+
+
+def time_command(argv, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'json_pipeline.transform', '--input', os.devnull,
+                        '--output', os.devnull] + argv, env=_env(), check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10, help='Number of heaviest imports to list')
+    parser.add_argument('--save', help='Save results as JSON into this file')
+    parser.add_argument('--compare', help='Compare results against this baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline, as a fraction (default: %(default)s)')
+    args = parser.parse_args()
+
+    results = {}
+    results['import'], modules = import_times(args.repeat)
+    print(f"{'import json_pipeline.transform':<45} {results['import'] * 1000:>8.1f}ms")
+    for name, command in COMMANDS.items():
+        results[f'cli/{name}'] = time_command(command, args.repeat)
+        print(f"{'cli/' + name + ' (empty input)':<45} {results[f'cli/{name}'] * 1000:>8.1f}ms")
+    print('\nHeaviest imports (self time):')
+    for name, (own, _) in sorted(modules.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f'  {name:<43} {own * 1000:>8.1f}ms')
+    heavy = loaded_heavy_modules()
+    if heavy:
+        print(f"\nModules imported at startup that shouldn't be: {', '.join(heavy)}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print('\nComparison against baseline (speedup):')
+        regressions = []
+        for name, value in sorted(results.items()):
+            if name not in baseline:
+                continue
+            ratio = baseline[name] / value
+            flag = ''
+            if ratio < 1 - args.threshold:
+                regressions.append(name)
+                flag = '  REGRESSION'
+            print(f'{name:<45} {ratio:>8.2f}x{flag}')
+        if regressions or heavy:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Synthetic jsonlines datasets for the benchmarks.
+
+Usage:
+
+    > PYTHONPATH=. python benchmarks/datasets.py --shape wide --records 100000 > wide.jl
+
+Shapes:
+
+- default: a handful of short fields, plus a small nested dict.
+- wide: the default fields plus --width extra fields.
+- long_text: the default fields plus a text field of about --text-size characters.
+- high_cardinality: like default, but every record has a distinct dedupe key.
+"""
+import sys
+import json
+import random
+import argparse
+
+
+SHAPES = ('default', 'wide', 'long_text', 'high_cardinality')
+
+_WORDS = ('office', 'store', 'headquarter', 'branch', 'warehouse', 'north', 'south', 'east', 'west', 'main',
+          'street', 'avenue', 'open', 'closed', 'monday', 'friday', 'service', 'post', 'mail', 'center')
+
+
+def make_record(idx, shape='default', width=50, text_size=2000, rnd=random):
+    kind = rnd.choice(('Office', 'Shop', 'Store', 'Branch'))
+    d = {
+        'id': str(idx) if shape == 'high_cardinality' else str(rnd.randrange(max(idx // 10, 1) + 1000)),
+        'name': f'{kind} {idx}',
+        'description': ' '.join(rnd.choice(_WORDS) for _ in range(8)).capitalize(),
+        'city': rnd.choice(('New York', 'Los Angeles', 'Chicago', 'Houston', 'Phoenix')),
+        'open_hours': {'Monday': '9:00-18:00', 'Saturday': '10:00-14:00'},
+    }
+    if shape == 'wide':
+        d.update((f'field_{j}', f'value {j} {rnd.choice(_WORDS)}') for j in range(width))
+    elif shape == 'long_text':
+        words = []
+        size = 0
+        while size < text_size:
+            word = rnd.choice(_WORDS)
+            words.append(word)
+            size += len(word) + 1
+        d['text'] = ' '.join(words)
+    return d
+
+
+def generate(records, shape='default', width=50, text_size=2000, seed=0):
+    """Yields the given number of records of the given shape. Same seed gives the same records.
+    """
+    if shape not in SHAPES:
+        raise ValueError(f"Unknown shape '{shape}'. Available: {', '.join(SHAPES)}")
+    rnd = random.Random(seed)
+    for idx in range(records):
+        yield make_record(idx, shape, width, text_size, rnd)
+
+
+def generate_lines(records, shape='default', **kwargs):
+    return [json.dumps(d) for d in generate(records, shape, **kwargs)]
+
+
+def write_file(path, records, shape='default', **kwargs):
+    with open(path, 'w') as f:
+        for d in generate(records, shape, **kwargs):
+            f.write(json.dumps(d) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--shape', choices=SHAPES, default='default')
+    parser.add_argument('--width', type=int, default=50, help='Number of extra fields of wide records')
+    parser.add_argument('--text-size', type=int, default=2000, help='Text size of long_text records')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for d in generate(args.records, args.shape, width=args.width, text_size=args.text_size, seed=args.seed):
+        sys.stdout.write(json.dumps(d) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""Benchmark suite: every Transform operation on its own, representative preset pipelines, and the
+command line tool end-to-end, over synthetic datasets (see datasets.py).
+
+Usage:
+
+    > PYTHONPATH=. python benchmarks/suite.py --records 50000 --save results.json
+    > PYTHONPATH=. python benchmarks/suite.py --records 50000 --compare results.json --threshold 0.1
+
+Results are throughputs in records per second (best of --repeat runs). With --compare, the run fails (exit
+code 1) if any benchmark is slower than the baseline by more than the given threshold (a fraction).
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+from copy import deepcopy
+
+from json_pipeline import version
+from json_pipeline.transform import Transform
+
+from datasets import generate, write_file
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# operation name: (args, dataset shape)
+OPERATIONS = {
+    'filter_regex': ({'field': 'name', 'regex': r'^office \d+', 'regex_flags': ['I']}, 'default'),
+    'filter_regex_neg': ({'field': 'description', 'regex': r'closed|warehouse'}, 'default'),
+    'cross_filter': ({'field': 'description', 'target': 'city'}, 'default'),
+    'filter_not_exists': ({'field': 'field_10'}, 'wide'),
+    'rename_field': ({'field': 'description', 'target': 'title'}, 'default'),
+    'extract': ({'field': 'text', 'regex': r'(north|south) (\w+)', 'target': 'where', 'separator': '-'},
+                'long_text'),
+    'extract_per_item': ({'operation': 'extract', 'field': 'description', 'regex_per_item': r'{city}|main',
+                          'target': 'where'}, 'default'),
+    'template': ({'field': '{name} ({city})', 'target': 'title'}, 'default'),
+    'remove_fields': ({'field': ','.join(f'field_{i}' for i in range(0, 50, 2))}, 'wide'),
+    'dedupe': ({'field': 'id'}, 'high_cardinality'),
+    'dedupe_composite': ({'operation': 'dedupe', 'field': 'city,name'}, 'default'),
+    'plaintext': ({'field': 'description'}, 'default'),
+    # limit stops early, so it is measured over the whole dataset with a count past its end
+    'limit': ({'count': 10 ** 9}, 'default'),
+    'skip': ({'count': 100}, 'default'),
+    'sample': ({'fraction': 0.5, 'seed': 1}, 'default'),
+    'sample_reservoir': ({'operation': 'sample', 'count': 1000, 'seed': 1}, 'default'),
+    'group_by': ({'field': 'city', 'aggregations': ['count', 'distinct:name', 'first:id']}, 'default'),
+    # high cardinality keys, spilled to disk every 10000 groups
+    'group_by_spill': ({'operation': 'group_by', 'field': 'id', 'aggregations': ['count'], 'max_groups': 10000},
+                       'high_cardinality'),
+    'function': ({'field': 'json_pipeline.utils.dict_to_text', 'target': 'open_hours', 'separator': ', '},
+                 'default'),
+    'fixed_value': ({'field': 'chain', 'target': 'USPS'}, 'default'),
+    # the reference file is generated with write_reference()
+    'lookup': ({'field': 'id', 'reference': 'REFERENCE', 'target': 'store'}, 'default'),
+}
+
+PRESETS = {
+    'filter_heavy': ('default', [
+        {'operation': 'filter_not_exists', 'field': 'name'},
+        {'operation': 'filter_regex', 'field': 'name', 'regex': r'^office', 'regex_flags': ['I']},
+        {'operation': 'filter_regex_neg', 'field': 'description', 'regex': 'closed'},
+        {'operation': 'plaintext', 'field': 'name'},
+        {'operation': 'dedupe', 'field': 'id'},
+    ]),
+    'enrichment': ('default', [
+        {'operation': 'extract', 'field': 'name', 'regex': r'(\d+)', 'target': 'number'},
+        {'operation': 'template', 'field': '{city}-{number}', 'target': 'key'},
+        {'operation': 'plaintext', 'field': 'key'},
+        {'operation': 'fixed_value', 'field': 'chain', 'target': 'USPS'},
+        {'operation': 'function', 'field': 'json_pipeline.utils.dict_to_text', 'target': 'open_hours',
+         'separator': ', '},
+        {'operation': 'rename_field', 'field': 'description', 'target': 'title'},
+        {'operation': 'remove_fields', 'field': 'number'},
+    ]),
+    'wide_cleanup': ('wide', [
+        {'operation': 'remove_fields', 'field': ','.join(f'field_{i}' for i in range(40))},
+        {'operation': 'filter_regex', 'field': 'city', 'regex': 'New York|Chicago'},
+        {'operation': 'dedupe', 'field': 'name'},
+    ]),
+}
+
+
+PIPELINE = {name: [Transform.args_from_dict(step) for step in steps] for name, (_, steps) in PRESETS.items()}
+
+
+class SuiteTransform(Transform):
+    PIPELINE = PIPELINE
+
+
+CLI = {
+    'filter_regex': ('default', ['filter_regex', '--field', 'name', '--regex', '^Office']),
+    'preset_filter_heavy': ('default', ['preset', '--pipeline', 'suite.PIPELINE',
+                                        '--target', 'filter_heavy']),
+    'preset_filter_heavy_lazy': ('default', ['--lazy', 'preset', '--pipeline', 'suite.PIPELINE',
+                                             '--target', 'filter_heavy']),
+}
+
+
+def write_reference(path, records):
+    """Writes a reference file for lookup, keyed by the ids of half the records of the default dataset.
+    """
+    with open(path, 'w') as f:
+        for i in range(0, records, 2):
+            f.write(json.dumps({'id': str(i), 'store': f'Store {i}', 'region': f'Region {i % 50}'}) + '\n')
+
+
+def best_of(func, repeat):
+    best = None
+    for _ in range(repeat):
+        elapsed = func()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def time_pipeline(records, args, repeat):
+    def run():
+        dataset = deepcopy(records)
+        start = time.perf_counter()
+        for _ in Transform().run(dataset, args):
+            pass
+        return time.perf_counter() - start
+    return best_of(run, repeat)
+
+
+def time_cli(path, argv, repeat):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.dirname(os.path.abspath(__file__))]))
+    cmd = [sys.executable, '-m', 'json_pipeline.transform', '--input', path, '--output', os.devnull] + argv
+
+    def run():
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, env=env)
+        return time.perf_counter() - start
+    return best_of(run, repeat)
+
+
+def run_suite(records, repeat, selected=None, log=print):
+    datasets = {}
+
+    def dataset(shape):
+        if shape not in datasets:
+            datasets[shape] = list(generate(records, shape))
+        return datasets[shape]
+
+    results = {}
+
+    def record(name, elapsed):
+        results[name] = records / elapsed
+        log(f'{name:<45} {results[name]:>14,.0f} records/s')
+
+    missing = set(Transform.OPERATIONS) - set(OPERATIONS) - {'preset'}
+    if missing:
+        log(f"warning: no benchmark for operations: {', '.join(sorted(missing))}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        reference = os.path.join(tmpdir, 'reference.jl')
+        write_reference(reference, records)
+        for name, (spec, shape) in OPERATIONS.items():
+            if selected and not any(s in f'operation/{name}' for s in selected):
+                continue
+            spec = dict({'operation': name}, **spec)
+            if spec.get('reference') == 'REFERENCE':
+                spec['reference'] = reference
+            record(f'operation/{name}', time_pipeline(dataset(shape), Transform.args_from_dict(spec), repeat))
+
+    for name, (shape, _) in PRESETS.items():
+        if selected and not any(s in f'preset/{name}' for s in selected):
+            continue
+        args = SuiteTransform.args_from_dict({'operation': 'preset', 'target': name})
+
+        def run(args=args, shape=shape):
+            data = deepcopy(dataset(shape))
+            start = time.perf_counter()
+            for _ in SuiteTransform().run(data, args):
+                pass
+            return time.perf_counter() - start
+        record(f'preset/{name}', best_of(run, repeat))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, (shape, argv) in CLI.items():
+            if selected and not any(s in f'cli/{name}' for s in selected):
+                continue
+            path = os.path.join(tmpdir, f'{shape}.jl')
+            if not os.path.exists(path):
+                write_file(path, records, shape)
+            record(f'cli/{name}', time_cli(path, argv, repeat))
+    return results
+
+
+def compare(results, baseline, threshold, log=print):
+    """Logs the ratio of each result against the baseline, and returns the names of the regressed ones.
+    """
+    regressions = []
+    for name, value in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = value / baseline[name]
+        flag = ''
+        if ratio < 1 - threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        log(f'{name:<45} {ratio:>8.2f}x{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', action='append', help='Run only benchmarks whose name contains this string')
+    parser.add_argument('--save', help='Save results as JSON into this file')
+    parser.add_argument('--compare', help='Compare results against this baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Allowed slowdown against the baseline, as a fraction (default: %(default)s)')
+    args = parser.parse_args()
+
+    results = run_suite(args.records, args.repeat, args.only)
+    report = {
+        'meta': {
+            'version': version,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'records': args.records,
+            'repeat': args.repeat,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('records') != args.records:
+            print('warning: baseline was run with a different number of records')
+        print('\nComparison against baseline:')
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
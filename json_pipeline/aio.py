@@ -0,0 +1,301 @@
+"""Asyncio execution of Transform pipelines.
+
+arun() takes a sync or async iterable of records and is an async generator of the results. The pipeline is
+split into stages connected by bounded asyncio queues, so a slow consumer makes the stages before it wait
+(backpressure) instead of piling up records:
+
+- function steps whose function is a coroutine function run as an async stage: records are passed to the
+  function concurrently, up to the given concurrency. Results keep the input order unless ordered=False.
+- consecutive steps of any other kind run as a sync stage: the records that are available in its input
+  queue (up to batch_size) are processed as a batch (see json_pipeline.batch.batch_processor) in the
+  given executor (the default executor of the loop if None), so the loop stays responsive. The executor
+  must be thread based, as the steps state lives in the current process. With executor=False the batches
+  are processed inline.
+- stateful steps that can't run over separate batches (limit, skip, sample, group_by) run as a sequential
+  stage: their generator runs over the whole stream of records in a thread of its own, which pulls them
+  from its input queue, so its state lives across batches. When it stops before the end of its input
+  (limit), the stages before it are stopped.
+"""
+import asyncio
+import inspect
+import threading
+import concurrent.futures
+from functools import partial
+
+from json_pipeline.utils import load_object
+from json_pipeline.batch import batch_processor, KERNELS
+
+
+_END = object()
+
+
+class _Failure:
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _coroutine_function(step):
+    if step.operation != 'function':
+        return None
+    func = load_object(step.field) if isinstance(step.field, str) else step.field
+    return func if inspect.iscoroutinefunction(func) else None
+
+
+def flatten(transform_cls, pipeline):
+    """Returns the given pipeline with the nested preset steps replaced by their steps, unless the preset
+    operation is overriden.
+    """
+    from json_pipeline.transform import Transform
+
+    if getattr(transform_cls.preset, '__func__', None) is not Transform.preset.__func__:
+        return list(pipeline)
+    result = []
+    for step in pipeline:
+        if step.operation == 'preset':
+            result.extend(flatten(transform_cls, transform_cls.load_pipeline(step)))
+        else:
+            result.append(step)
+    return result
+
+
+async def _get_available(queue, size):
+    """Waits for an item, then returns it with the following available ones, up to size.
+    """
+    items = [await queue.get()]
+    while len(items) < size and not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+async def _feed(dataset, outq):
+    try:
+        if hasattr(dataset, '__aiter__'):
+            async for d in dataset:
+                await outq.put(d)
+        else:
+            for d in dataset:
+                await outq.put(d)
+    except Exception as e:
+        await outq.put(_Failure(e))
+        return
+    await outq.put(_END)
+
+
+async def _sync_stage(process, inq, outq, batch_size, executor):
+    loop = asyncio.get_running_loop()
+    done = False
+    while not done:
+        batch = await _get_available(inq, batch_size)
+        end = batch[-1]
+        if end is _END or isinstance(end, _Failure):
+            batch.pop()
+            done = True
+        try:
+            if batch:
+                if executor is False:
+                    batch = process(batch)
+                else:
+                    batch = await loop.run_in_executor(executor, process, batch)
+        except Exception as e:
+            await outq.put(_Failure(e))
+            return
+        for d in batch:
+            await outq.put(d)
+    await outq.put(end)
+
+
+async def _async_stage(func, args, inq, outq, concurrency, ordered):
+    semaphore = asyncio.Semaphore(concurrency)
+    # ordered: running tasks in input order, bounded so finished results wait for a slow consumer
+    pending = asyncio.Queue(concurrency)
+    tasks = set()
+    # unordered: the first failure, which ends the output, so no result is queued after it
+    failures = []
+
+    async def call(d):
+        try:
+            return await func(d, args)
+        finally:
+            semaphore.release()
+
+    async def call_unordered(d):
+        try:
+            result = await call(d)
+        except Exception as e:
+            failures.append(_Failure(e))
+            return
+        if not failures:
+            await outq.put(result)
+
+    async def emit_ordered():
+        while True:
+            task = await pending.get()
+            if task is _END:
+                return
+            try:
+                result = await task
+            except Exception as e:
+                await outq.put(_Failure(e))
+                return
+            await outq.put(result)
+
+    emitter = asyncio.ensure_future(emit_ordered()) if ordered else None
+    end = _END
+    try:
+        while True:
+            d = await inq.get()
+            if d is _END or isinstance(d, _Failure):
+                end = d
+                break
+            await semaphore.acquire()
+            if failures:
+                break
+            if ordered:
+                await pending.put(asyncio.ensure_future(call(d)))
+            else:
+                task = asyncio.ensure_future(call_unordered(d))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if ordered:
+            await pending.put(_END)
+            await emitter
+        elif not failures:
+            await asyncio.gather(*tasks)
+    finally:
+        # only left on cancellation, or after an unordered failure
+        if emitter is not None:
+            emitter.cancel()
+        while not pending.empty():
+            task = pending.get_nowait()
+            if task is not _END:
+                task.cancel()
+        for task in list(tasks):
+            task.cancel()
+    await outq.put(failures[0] if failures else end)
+
+
+async def _sequential_stage(op, args, inq, outq, stop_upstream):
+    loop = asyncio.get_running_loop()
+    stop = threading.Event()
+    done = loop.create_future()
+    # the end item of the input, once it is reached
+    end = []
+
+    def call(func, *args):
+        # runs the given coroutine function in the loop, and waits for its result unless the stage is cancelled
+        if stop.is_set():
+            raise _Stopped()
+        coro = func(*args)
+        try:
+            future = asyncio.run_coroutine_threadsafe(coro, loop)
+        except RuntimeError:
+            # the loop is closed
+            coro.close()
+            raise _Stopped()
+        while True:
+            try:
+                return future.result(0.1)
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    raise _Stopped()
+            except concurrent.futures.CancelledError:
+                raise _Stopped()
+
+    def records():
+        while True:
+            d = call(inq.get)
+            if d is _END or isinstance(d, _Failure):
+                end.append(d)
+                return
+            yield d
+
+    def run():
+        try:
+            for d in op(records(), args):
+                call(outq.put, d)
+            if not end:
+                loop.call_soon_threadsafe(stop_upstream)
+            result = end[0] if end else _END
+        except _Stopped:
+            return
+        except Exception as e:
+            result = _Failure(e)
+        try:
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(result))
+        except RuntimeError:
+            # the loop is closed
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        result = await done
+    finally:
+        stop.set()
+    await outq.put(result)
+
+
+def _stages(transform_cls, pipeline, batchable):
+    """Splits the pipeline into ('async', function, args), ('sequential', operation, args) and
+    ('sync', steps) stages.
+    """
+    stages = []
+    for step in flatten(transform_cls, pipeline):
+        func = _coroutine_function(step)
+        opname = step.operation
+        if func is not None:
+            stages.append(('async', func, step))
+        elif opname in transform_cls.STATEFUL_OPERATIONS and not (opname in KERNELS and batchable(opname)):
+            stages.append(('sequential', getattr(transform_cls, opname), step))
+        elif stages and stages[-1][0] == 'sync':
+            stages[-1][1].append(step)
+        else:
+            stages.append(('sync', [step]))
+    return stages
+
+
+async def arun(transform_cls, dataset, pipeline, batchable, concurrency=16, executor=None, queue_size=1024,
+               batch_size=256, ordered=True):
+    """Async generator of the results of running the given pipeline (a list of Args) over the given sync or
+    async iterable of records.
+    """
+    queues = [asyncio.Queue(queue_size)]
+    stages = _stages(transform_cls, pipeline, batchable)
+    # built before any coroutine, so none is left unawaited if one of them fails
+    processes = [batch_processor(transform_cls, stage[1], batchable) if stage[0] == 'sync' else None
+                 for stage in stages]
+    coros = [_feed(dataset, queues[0])]
+    tasks = []
+
+    def stop_upstream(count):
+        for task in tasks[:count]:
+            task.cancel()
+
+    for stage, process in zip(stages, processes):
+        queues.append(asyncio.Queue(queue_size))
+        if stage[0] == 'async':
+            coros.append(_async_stage(stage[1], stage[2], queues[-2], queues[-1], concurrency, ordered))
+        elif stage[0] == 'sequential':
+            coros.append(_sequential_stage(stage[1], stage[2], queues[-2], queues[-1],
+                                           partial(stop_upstream, len(coros))))
+        else:
+            coros.append(_sync_stage(process, queues[-2], queues[-1], batch_size, executor))
+    tasks.extend(asyncio.ensure_future(coro) for coro in coros)
+    output = queues[-1]
+    try:
+        while True:
+            d = await output.get()
+            if d is _END:
+                break
+            if isinstance(d, _Failure):
+                raise d.exc
+            yield d
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,189 @@
+"""Batched execution of Transform pipelines.
+
+Records are grouped into batches (lists) of a given size, which go through the pipeline one at a time.
+Steps with a column kernel work over the whole column of values of the batch: plaintext joins the values
+and cleans them with a single pass of each regex, then splits them again, dedupe checks and adds the keys
+of the batch in a single list comprehension, and lookup queries the keys of the batch together.
+Consecutive steps without column kernel are fused (see json_pipeline.compiler) into a single loop over the
+batch, which builds the list of results. Other operations get no column kernel, as a single fused loop
+over the records is faster than one column pass per step for them (even C-level ones, i.e. a map of the
+regex search over the values then itertools.compress of the batch), so segments without column kernels
+run as the compiled pipeline, without batching.
+
+Results are the same as running the steps one record at a time. Steps that can't be fused nor run by a
+column kernel (nested presets, custom operations, operations overriden in a Transform subclass) run as
+regular generator operations between batched segments.
+"""
+import re
+
+from json_pipeline.utils import plain, _UNDERSCORE_RE
+from json_pipeline.dedupe import key_fields, make_seen
+from json_pipeline.checkpoint import track
+from json_pipeline.lookup import ReferenceIndex, enrich
+from json_pipeline.parallel import chunked
+from json_pipeline.compiler import compile_batch, compile_pipeline, COMPILERS
+
+
+DEFAULT_BATCH_SIZE = 1024
+
+_SEPARATOR = '\x00'
+# same as utils._REMOVE_RE, but keeping the separator
+_COLUMN_REMOVE_RE = re.compile(r'[^\w\d\s\x00-]+')
+
+
+def plain_column(values):
+    """Same as [plain(v) for v in values], cleaning all the values in a single pass.
+    """
+    if not all(type(v) is str for v in values):
+        return [plain(v) for v in values]
+    txt = _SEPARATOR.join(values)
+    if txt.count(_SEPARATOR) != len(values) - 1:
+        return [plain(v) for v in values]
+    txt = _UNDERSCORE_RE.sub('_', txt.lower())
+    txt = _COLUMN_REMOVE_RE.sub('', txt)
+    return txt.split(_SEPARATOR) if values else []
+
+
+def _plaintext(args):
+    field = args.field
+
+    def kernel(batch):
+        for d, value in zip(batch, plain_column([d[field] for d in batch])):
+            d[field] = value
+        return batch
+    return kernel
+
+
+def _dedupe(args):
+    fields = key_fields(args.field)
+    if len(fields) == 1 and not args.backend and not args.hash_keys:
+        field, seen = fields[0], track(set())
+        add = seen.add
+        # add() returns None, so the first record of each key is kept and its key added in the same pass
+        return lambda batch: [d for d in batch if field not in d or (d[field] not in seen and not add(d[field]))]
+    seen = make_seen(args)
+    if len(fields) == 1:
+        field = fields[0]
+        return lambda batch: [d for d in batch if field not in d or seen.add(d[field])]
+    return lambda batch: [d for d in batch
+                          if any(f not in d for f in fields) or seen.add(tuple(d[f] for f in fields))]
+
+
+def _lookup(args):
+    field, target = args.field, args.target
+    key = args.reference_key or field
+    index = ReferenceIndex(args.reference, key)
+
+    def kernel(batch):
+        present = [d for d in batch if field in d]
+        for d, reference in zip(present, index.get_many([d[field] for d in present])):
+            if reference is not None:
+                enrich(d, reference, key, target)
+        return batch
+    return kernel
+
+
+# column kernels. They are built for each run, as they may keep state across batches
+KERNELS = {
+    'plaintext': _plaintext,
+    'dedupe': _dedupe,
+    'lookup': _lookup,
+}
+
+
+def _run_batches(dataset, kernels, batch_size):
+    kernels = [factory() for factory in kernels]
+    for batch in chunked(dataset, batch_size):
+        for kernel in kernels:
+            batch = kernel(batch)
+            if not batch:
+                break
+        yield from batch
+
+
+def _segments(transform_cls, pipeline, batchable):
+    """Splits the pipeline into ('kernels', kernel factories) segments, ('fused', steps) segments of fusable
+    steps without column kernels in between, and ('op', operation, args) steps that can't run inside a batch.
+    """
+    segments = []
+    kernels = []
+    fused = []
+
+    def close_fused():
+        if fused:
+            kernels.append(lambda steps=list(fused): compile_batch(steps))
+            fused.clear()
+
+    def close_segment():
+        if fused and not kernels:
+            segments.append(('fused', list(fused)))
+            fused.clear()
+        close_fused()
+        if kernels:
+            segments.append(('kernels', list(kernels)))
+            kernels.clear()
+
+    for opargs in pipeline:
+        opname = opargs.operation
+        if opname in KERNELS and batchable(opname):
+            close_fused()
+            kernels.append(lambda factory=KERNELS[opname], opargs=opargs: factory(opargs))
+        elif opname in COMPILERS and opname not in transform_cls.STATEFUL_OPERATIONS and batchable(opname):
+            fused.append(opargs)
+        else:
+            close_segment()
+            segments.append(('op', getattr(transform_cls, opname), opargs))
+    close_segment()
+    return segments
+
+
+def batch_pipeline(transform_cls, pipeline, batchable, batch_size=DEFAULT_BATCH_SIZE):
+    """Returns a function that, given a dataset, returns an iterator over the results of running the given
+    pipeline (a list of Args) over it in batches of batch_size records. batchable(opname) tells whether an
+    operation can run inside a batch, either fused or with its column kernel.
+    """
+    stages = []
+    for segment in _segments(transform_cls, pipeline, batchable):
+        if segment[0] == 'kernels':
+            stages.append(lambda dataset, kernels=segment[1]: _run_batches(dataset, kernels, batch_size))
+        elif segment[0] == 'fused':
+            # nothing to gain from batching them
+            stages.append(lambda dataset, steps=segment[1]: compile_pipeline(transform_cls, steps, batchable)(dataset))
+        else:
+            stages.append(lambda dataset, op=segment[1], opargs=segment[2]: op(dataset, opargs))
+
+    def run(dataset):
+        result = dataset
+        for stage in stages:
+            result = stage(result)
+        return result
+
+    run.stages = stages
+    return run
+
+
+def batch_processor(transform_cls, pipeline, batchable):
+    """Returns a function that runs the given pipeline over the batch (a list of records) it is given, and
+    returns the list of results. State (i.e. dedupe seen keys) is kept across calls. Operations that can't run
+    inside a batch are run over each batch on its own, so they can't be stateful.
+    """
+    kernels = []
+    for segment in _segments(transform_cls, pipeline, batchable):
+        if segment[0] == 'kernels':
+            kernels.extend(factory() for factory in segment[1])
+            continue
+        if segment[0] == 'fused':
+            kernels.append(compile_batch(segment[1]))
+            continue
+        _, op, opargs = segment
+        if opargs.operation in transform_cls.STATEFUL_OPERATIONS:
+            raise ValueError(f"Stateful operation '{opargs.operation}' can't run over separate batches")
+        kernels.append(lambda batch, op=op, opargs=opargs: list(op(batch, opargs)))
+
+    def process(batch):
+        for kernel in kernels:
+            batch = kernel(batch)
+            if not batch:
+                break
+        return batch
+    return process
@@ -0,0 +1,149 @@
+"""Checkpoints of command line runs, to resume them after a failure.
+
+A checkpoint records the input byte offset up to which records were processed, the output byte offset up to
+which their results were written, and the state of the stateful stores of the pipeline (i.e. dedupe seen
+keys). Checkpoints are only taken between two input records, when the previous one went through the whole
+pipeline and its results are in the output, so resuming from a checkpoint gives the same output as an
+uninterrupted run.
+
+Stateful stores register themselves with track() when they are created. A store is either a set or a list,
+whose (picklable) contents are saved, or an object with a snapshot(prefix) method, which returns its
+(picklable) state and may save big states into files starting with prefix, and a restore(state) method.
+Stores are matched by their creation order, which is the same for the same pipeline.
+
+The checkpoint file is written into a temporary file which is then renamed over the previous one, so it is
+always complete. State files of a checkpoint are named after its generation, and removed once a newer
+checkpoint is in place.
+"""
+import os
+import sys
+import time
+
+
+VERSION = 1
+
+_active = None
+
+
+def track(store):
+    """Registers the given store into the active checkpointer (if any), which restores its saved state when
+    resuming. Returns the store.
+    """
+    if _active is not None:
+        _active.register(store)
+    return store
+
+
+def _snapshot(store, prefix):
+    if isinstance(store, (set, list)):
+        return store
+    return store.snapshot(prefix)
+
+
+def _restore(store, state):
+    if isinstance(store, set):
+        store.update(state)
+    elif isinstance(store, list):
+        store[:] = state
+    else:
+        store.restore(state)
+
+
+class Checkpointer:
+
+    def __init__(self, path, interval=60.0, signature=None):
+        self.path = path
+        self.state_dir = path + '.state'
+        self.interval = interval
+        self.signature = signature
+        self.stores = []
+        self.saved = None
+        self.generation = 0
+        self.costs = []
+        self.started = self.last = time.perf_counter()
+
+    def load(self):
+        """Loads the checkpoint to resume from, and returns it.
+        """
+        import pickle
+
+        with open(self.path, 'rb') as f:
+            try:
+                saved = pickle.load(f)
+            except (pickle.UnpicklingError, EOFError) as e:
+                raise ValueError(f'Invalid checkpoint file: {e}')
+        if not isinstance(saved, dict) or saved.get('version') != VERSION:
+            raise ValueError('Unsupported checkpoint version')
+        if self.signature is not None and saved.get('signature') != self.signature:
+            raise ValueError('The checkpoint was taken by a run with different operation arguments')
+        self.saved = saved
+        self.generation = saved['generation']
+        return saved
+
+    def register(self, store):
+        idx = len(self.stores)
+        self.stores.append(store)
+        if self.saved is not None:
+            states = self.saved['states']
+            if idx >= len(states):
+                raise ValueError('The pipeline has more stateful steps than the checkpoint')
+            _restore(store, states[idx])
+
+    def due(self):
+        return time.perf_counter() - self.last >= self.interval
+
+    def save(self, input_offset, output_offset, complete=False):
+        """Writes a checkpoint. The output must be flushed up to output_offset already.
+        """
+        import pickle
+
+        start = time.perf_counter()
+        self.generation += 1
+        prefix = os.path.join(self.state_dir, f'{self.generation}-')
+        os.makedirs(self.state_dir, exist_ok=True)
+        data = {
+            'version': VERSION,
+            'generation': self.generation,
+            'signature': self.signature,
+            'input_offset': input_offset,
+            'output_offset': output_offset,
+            'complete': complete,
+            'states': [_snapshot(store, f'{prefix}{idx}') for idx, store in enumerate(self.stores)],
+        }
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmppath, self.path)
+        for name in os.listdir(self.state_dir):
+            if not name.startswith(f'{self.generation}-'):
+                os.remove(os.path.join(self.state_dir, name))
+        self.last = time.perf_counter()
+        self.costs.append(self.last - start)
+
+    def activate(self):
+        global _active
+        _active = self
+
+    def deactivate(self):
+        global _active
+        if _active is self:
+            _active = None
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.started
+        total = sum(self.costs)
+        return {
+            'checkpoints': len(self.costs),
+            'total_time': total,
+            'mean_time': total / len(self.costs) if self.costs else 0.0,
+            'max_time': max(self.costs, default=0.0),
+            'overhead': total / elapsed if elapsed else 0.0,
+        }
+
+    def report(self, stream=None):
+        stats = self.stats()
+        print(f"checkpoints: {stats['checkpoints']}, {stats['total_time']:.3f}s in total "
+              f"({stats['overhead'] * 100:.2f}% of the run), {stats['mean_time'] * 1000:.1f}ms mean, "
+              f"{stats['max_time'] * 1000:.1f}ms max", file=stream or sys.stderr)
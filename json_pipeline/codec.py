@@ -0,0 +1,204 @@
+"""JSON codecs used to decode and encode jsonlines.
+
+get_codec() returns a Codec for one of the supported backends: json (stdlib), orjson, ujson or simdjson.
+The optional backends are only imported when requested, and auto picks the first of them that is
+installed, falling back to the stdlib. Notice that other backends may not serialize records exactly like
+the stdlib (i.e. they don't add spaces after separators).
+
+Codec.lazy_decode() returns a LazyRecord, that only decodes the top-level fields of a record up to the
+one being looked up, so a line rejected by a filter on an early field is never fully parsed. Records
+that reach the output unmodified are written back as the original line, without being re-encoded.
+"""
+import json
+from functools import lru_cache
+from json.decoder import scanstring, WHITESPACE, JSONDecodeError
+from collections.abc import MutableMapping
+
+
+_scan_once = json.JSONDecoder().scan_once
+_whitespace = WHITESPACE.match
+# lookups decode item by item only if the key is within the first 1/SCAN_RATIO of the undecoded text
+SCAN_RATIO = 8
+
+
+@lru_cache(maxsize=1024)
+def _needle(key):
+    return json.dumps(key, ensure_ascii=False)
+
+
+class LazyRecord(MutableMapping):
+    """Dict-like record decoded on demand from a jsonline.
+
+    If the line contains duplicated keys, the first value of a key may be returned by lookups done before
+    the record is fully decoded (json.loads() keeps the last one).
+    """
+
+    __slots__ = ('raw', 'data', 'pos', 'dirty', 'loads')
+
+    def __init__(self, raw, loads=json.loads):
+        self.raw = raw
+        self.loads = loads
+        self.data = {}
+        self.pos = _whitespace(raw).end() + 1
+        self.dirty = False
+
+    def _scan(self, key=None):
+        """Decode top-level items until key is found, or until the end of the record if key is None.
+        """
+        s, pos, data = self.raw, self.pos, self.data
+        if key is not None and '\\' not in s:
+            # without escapes, a key can only be spelled one way
+            idx = s.find(_needle(key), pos)
+            if idx < 0:
+                return
+            if (idx - pos) * SCAN_RATIO > len(s) - pos:
+                # decoding the rest at once is cheaper than going item by item up to a far key
+                key = None
+        if key is None:
+            self._decode_rest()
+            return
+        while pos is not None:
+            pos = _whitespace(s, pos).end()
+            if s[pos:pos + 1] == '}':
+                pos = None
+                break
+            if data:
+                if s[pos:pos + 1] != ',':
+                    raise JSONDecodeError("Expecting ',' delimiter", s, pos)
+                pos = _whitespace(s, pos + 1).end()
+            if s[pos:pos + 1] != '"':
+                raise JSONDecodeError('Expecting property name enclosed in double quotes', s, pos)
+            k, pos = scanstring(s, pos + 1)
+            pos = _whitespace(s, pos).end()
+            if s[pos:pos + 1] != ':':
+                raise JSONDecodeError("Expecting ':' delimiter", s, pos)
+            pos = _whitespace(s, pos + 1).end()
+            try:
+                data[k], pos = _scan_once(s, pos)
+            except StopIteration as err:
+                raise JSONDecodeError('Expecting value', s, err.value) from None
+            if k == key:
+                break
+        self.pos = pos
+
+    def _decode_rest(self):
+        s, pos, data = self.raw, self.pos, self.data
+        if not data:
+            self.data = self.loads(s)
+        else:
+            pos = _whitespace(s, pos).end()
+            if s[pos:pos + 1] == ',':
+                data.update(self.loads('{' + s[pos + 1:]))
+            elif s[pos:].rstrip() != '}':
+                raise JSONDecodeError("Expecting ',' delimiter", s, pos)
+        self.pos = None
+
+    def decoded(self):
+        if self.pos is not None:
+            self._scan()
+        return self.data
+
+    def __getitem__(self, key):
+        if key not in self.data and self.pos is not None:
+            self._scan(key)
+        value = self.data[key]
+        if isinstance(value, (dict, list)):
+            # may be modified in place
+            self.dirty = True
+        return value
+
+    def __contains__(self, key):
+        if key not in self.data and self.pos is not None:
+            self._scan(key)
+        return key in self.data
+
+    def __setitem__(self, key, value):
+        self.decoded()[key] = value
+        self.dirty = True
+
+    def __delitem__(self, key):
+        del self.decoded()[key]
+        self.dirty = True
+
+    def __iter__(self):
+        return iter(self.decoded())
+
+    def __len__(self):
+        return len(self.decoded())
+
+    def __repr__(self):
+        return f'LazyRecord({self.raw!r})'
+
+
+def _json():
+    return json.loads, json.dumps
+
+
+def _orjson():
+    import orjson
+
+    def dumps(d):
+        return orjson.dumps(d).decode('utf8')
+    return orjson.loads, dumps
+
+
+def _ujson():
+    import ujson
+
+    def dumps(d):
+        return ujson.dumps(d, escape_forward_slashes=False)
+    return ujson.loads, dumps
+
+
+def _simdjson():
+    import simdjson
+    return simdjson.loads, json.dumps
+
+
+BACKENDS = {
+    'json': _json,
+    'orjson': _orjson,
+    'ujson': _ujson,
+    'simdjson': _simdjson,
+}
+AUTO_ORDER = ('orjson', 'ujson', 'simdjson', 'json')
+
+
+class Codec:
+
+    def __init__(self, name):
+        self.name = name
+        self.loads, self.dumps = BACKENDS[name]()
+
+    def __reduce__(self):
+        return (Codec, (self.name,))
+
+    def decode(self, line):
+        return self.loads(line)
+
+    def lazy_decode(self, line):
+        line = line.rstrip('\r\n')
+        if line.lstrip()[:1] != '{':
+            return self.loads(line)
+        return LazyRecord(line, self.loads)
+
+    def encode(self, d):
+        if isinstance(d, LazyRecord):
+            if not d.dirty:
+                return d.raw
+            d = d.decoded()
+        return self.dumps(d)
+
+
+def get_codec(name='json'):
+    """Returns a Codec for the given backend name, or for the fastest installed one if name is auto.
+    """
+    if name == 'auto':
+        for candidate in AUTO_ORDER:
+            try:
+                return Codec(candidate)
+            except ImportError:
+                pass
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown codec '{name}'. Available: auto, {', '.join(BACKENDS)}")
+    return Codec(name)
@@ -0,0 +1,219 @@
+"""Compiles a list of Args steps into a single fused generator.
+
+Instead of chaining one generator per step, consecutive steps of the supported operations are translated
+into python source and inlined in the body of one loop over the dataset: regexes, flags and constants are
+prepared once, and a record is discarded (the loop continues) as soon as a filter rejects it. Steps whose
+operation can't be fused (nested presets, custom operations, operations overriden in a Transform subclass)
+break the pipeline into several fused segments chained with the regular generator operations.
+
+compile_batch() builds the same loop as a function of a list of records that returns the list of results,
+for batched execution (see json_pipeline.batch).
+"""
+import re
+
+from json_pipeline.utils import load_object, reflags, plain, per_item_search
+from json_pipeline.dedupe import key_fields, make_seen
+from json_pipeline.checkpoint import track
+from json_pipeline.matcher import MultiMatcher, patterns_from_args
+
+
+class _Segment:
+
+    def __init__(self):
+        self.namespace = {'__name__': 'json_pipeline.compiler'}
+        self.setup = []
+        self.body = []
+
+    def const(self, value):
+        name = f'_c{len(self.namespace)}'
+        self.namespace[name] = value
+        return name
+
+    def state(self, factory):
+        name = f'_s{len(self.setup)}'
+        self.setup.append(f'{name} = {self.const(factory)}()')
+        return name
+
+    def emit(self, *lines):
+        self.body.extend(lines)
+
+    def build(self, batch=False):
+        if batch:
+            # state is set up once, so it lives across the batches
+            source = list(self.setup)
+            source.extend(['def fused(dataset):',
+                           '    result = []',
+                           '    append = result.append'])
+        else:
+            source = ['def fused(dataset):']
+            source.extend('    ' + line for line in self.setup)
+        source.append('    for d in dataset:')
+        source.extend('        ' + line for line in self.body)
+        source.extend(['        append(d)', '    return result'] if batch else ['        yield d'])
+        exec(compile('\n'.join(source), '<fused pipeline>', 'exec'), self.namespace)
+        fused = self.namespace['fused']
+        fused.source = '\n'.join(source)
+        return fused
+
+
+def _search(segment, args):
+    regex_re = re.compile(args.regex, flags=reflags(args.regex_flags))
+    return segment.const(regex_re.search)
+
+
+def _filter_regex(segment, args):
+    f = repr(args.field)
+    patterns = patterns_from_args(args)
+    if patterns is None:
+        segment.emit(f'if {f} in d and not {_search(segment, args)}(d[{f}]): continue')
+        return
+    matcher = MultiMatcher(patterns, reflags(args.regex_flags))
+    if not args.target:
+        segment.emit(f'if {f} in d and not {segment.const(matcher.search)}(d[{f}]): continue')
+        return
+    segment.emit(f'if {f} in d:',
+                 f'    p = {segment.const(matcher.match)}(d[{f}])',
+                 '    if p is None: continue',
+                 f'    d[{args.target!r}] = p')
+
+
+def _filter_regex_neg(segment, args):
+    f = repr(args.field)
+    patterns = patterns_from_args(args)
+    if patterns is None:
+        segment.emit(f'if {f} in d and {_search(segment, args)}(d[{f}]) is not None: continue')
+        return
+    matcher = MultiMatcher(patterns, reflags(args.regex_flags))
+    segment.emit(f'if {f} in d and {segment.const(matcher.search)}(d[{f}]): continue')
+
+
+def _cross_filter(segment, args):
+    f, t = repr(args.field), repr(args.target)
+    segment.emit(f'if {f} in d and {t} in d and d[{t}] not in d[{f}]: continue')
+
+
+def _filter_not_exists(segment, args):
+    segment.emit(f'if {args.field!r} not in d: continue')
+
+
+def _rename_field(segment, args):
+    mapping = args.field if isinstance(args.field, dict) else {args.field: args.target}
+    for field, target in mapping.items():
+        f, t = repr(field), repr(target)
+        segment.emit(f'if {f} in d: d[{t}] = d.pop({f})')
+
+
+def _extract(segment, args):
+    f, t = repr(args.field), repr(args.target)
+    if args.regex_per_item is not None:
+        search = per_item_search(args.regex_per_item, reflags(args.regex_flags), escape=args.escape_per_item)
+        segment.emit(f'if {f} in d:',
+                     f'    m = {segment.const(search)}(d, d[{f}])')
+    else:
+        segment.emit(f'if {f} in d:',
+                     f'    m = {_search(segment, args)}(d[{f}])')
+    segment.emit('    if m:',
+                 '        g = m.groups()',
+                 f'        d[{t}] = {segment.const(args.separator)}.join(g) if g else m.group()')
+
+
+def _template(segment, args):
+    segment.emit(f'd[{args.target!r}] = {segment.const(args.field.format)}(**d)')
+
+
+def _remove_fields(segment, args):
+    fields = args.field
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    for field in fields:
+        segment.emit(f'd.pop({field!r}, None)')
+
+
+def _dedupe(segment, args):
+    fields = key_fields(args.field)
+    if len(fields) == 1 and not args.backend and not args.hash_keys:
+        f, seen = repr(fields[0]), segment.state(lambda: track(set()))
+        segment.emit(f'if {f} in d:',
+                     f'    if d[{f}] in {seen}: continue',
+                     f'    {seen}.add(d[{f}])')
+        return
+    seen = segment.state(lambda: make_seen(args))
+    present = ' and '.join(f'{f!r} in d' for f in fields)
+    key = '(' + ''.join(f'd[{f!r}], ' for f in fields) + ')' if len(fields) > 1 else f'd[{fields[0]!r}]'
+    segment.emit(f'if {present} and not {seen}.add({key}): continue')
+
+
+def _plaintext(segment, args):
+    f = repr(args.field)
+    segment.emit(f'd[{f}] = {segment.const(plain)}(d[{f}])')
+
+
+def _function(segment, args):
+    func = args.field
+    if isinstance(func, str):
+        func = load_object(func)
+    segment.emit(f'd = {segment.const(func)}(d, {segment.const(args)})')
+
+
+def _fixedvalue(segment, args):
+    mapping = args.field if isinstance(args.field, dict) else {args.field: args.target}
+    for field, value in mapping.items():
+        segment.emit(f'd[{field!r}] = {segment.const(value)}')
+
+
+COMPILERS = {
+    'filter_regex': _filter_regex,
+    'filter_regex_neg': _filter_regex_neg,
+    'cross_filter': _cross_filter,
+    'filter_not_exists': _filter_not_exists,
+    'rename_field': _rename_field,
+    'extract': _extract,
+    'template': _template,
+    'remove_fields': _remove_fields,
+    'dedupe': _dedupe,
+    'plaintext': _plaintext,
+    'function': _function,
+    'fixedvalue': _fixedvalue,
+    'fixed_value': _fixedvalue,
+}
+
+
+def compile_batch(pipeline):
+    """Returns a function that runs the given pipeline (a list of Args of fusable operations) over the list of
+    records it is given, and returns the list of results. State (i.e. dedupe seen keys) is kept across calls.
+    """
+    segment = _Segment()
+    for opargs in pipeline:
+        COMPILERS[opargs.operation](segment, opargs)
+    return segment.build(batch=True)
+
+
+def compile_pipeline(transform_cls, pipeline, fusable):
+    """Returns a function that, given a dataset, returns an iterator over the results of running the given
+    pipeline (a list of Args) over it. fusable(opname) tells whether an operation can be inlined.
+    """
+    stages = []
+    segment = None
+    for opargs in pipeline:
+        opname = opargs.operation
+        if opname in COMPILERS and fusable(opname):
+            if segment is None:
+                segment = _Segment()
+            COMPILERS[opname](segment, opargs)
+        else:
+            if segment is not None:
+                stages.append(segment.build())
+                segment = None
+            op = getattr(transform_cls, opname)
+            stages.append(lambda dataset, op=op, opargs=opargs: op(dataset, opargs))
+    if segment is not None:
+        stages.append(segment.build())
+
+    def run(dataset):
+        result = dataset
+        for stage in stages:
+            result = stage(result)
+        return result
+
+    run.stages = stages
+    return run
@@ -0,0 +1,186 @@
+"""Seen-keys stores for the dedupe operation.
+
+All of them implement add(key), which records the given key and returns whether it was new:
+
+- memory: exact, keeps every key in a python set (the default).
+- sqlite: exact, keeps the keys in a temporary sqlite database on local disk.
+- bloom: probabilistic, uses a Bloom filter of fixed size, computed from the expected number of keys
+  (capacity) and the accepted false positive rate (error_rate). A false positive means that a record with a
+  new key is considered duplicated and dropped. There are no false negatives.
+
+With hash_keys, memory and sqlite stores keep fixed-width digests of the keys instead of the keys
+themselves (bloom and sqlite stores always work on serialized keys).
+
+Stores are tracked by the active checkpoint, if any (see json_pipeline.checkpoint), through their
+snapshot(prefix) and restore(state) methods.
+"""
+import os
+import json
+import math
+import weakref
+from hashlib import blake2b
+
+from json_pipeline.checkpoint import track
+
+
+DIGEST_SIZE = 16
+
+
+def key_fields(field):
+    """Returns the list of fields of a (possibly composite, comma-separated or list) dedupe key.
+    """
+    if field is None:
+        # no record has a None field, so they all pass through dedupe
+        return [None]
+    if isinstance(field, str):
+        return field.split(',')
+    return list(field)
+
+
+def encode_key(key):
+    return json.dumps(key, sort_keys=True, ensure_ascii=False).encode('utf8')
+
+
+def digest(key):
+    return blake2b(encode_key(key), digest_size=DIGEST_SIZE).digest()
+
+
+class MemorySeen:
+
+    def __init__(self, hash_keys=False):
+        self.seen = set()
+        self.hash_keys = hash_keys
+
+    def add(self, key):
+        if self.hash_keys:
+            key = digest(key)
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        return True
+
+    def __len__(self):
+        return len(self.seen)
+
+    def snapshot(self, prefix):
+        return self.seen
+
+    def restore(self, state):
+        self.seen.update(state)
+
+
+class SqliteSeen:
+
+    COMMIT_EVERY = 10000
+
+    def __init__(self, hash_keys=False, path=None):
+        # only needed by this backend
+        import sqlite3
+        import tempfile
+
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='json_pipeline_dedupe_', suffix='.sqlite')
+            os.close(fd)
+            weakref.finalize(self, _remove, path)
+        self.path = path
+        self.hash_keys = hash_keys
+        # async pipelines build the store in the loop thread and use it from executor threads, one batch at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=OFF')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS seen (key BLOB PRIMARY KEY) WITHOUT ROWID')
+        weakref.finalize(self, self.conn.close)
+        self.pending = 0
+
+    def add(self, key):
+        key = digest(key) if self.hash_keys else encode_key(key)
+        cursor = self.conn.execute('INSERT OR IGNORE INTO seen (key) VALUES (?)', (key,))
+        self.pending += 1
+        if self.pending >= self.COMMIT_EVERY:
+            self.conn.commit()
+            self.pending = 0
+        return cursor.rowcount == 1
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+
+    def snapshot(self, prefix):
+        """Copies the database into prefix.sqlite, and returns its path.
+        """
+        import sqlite3
+
+        self.conn.commit()
+        self.pending = 0
+        path = prefix + '.sqlite'
+        copy = sqlite3.connect(path)
+        try:
+            self.conn.backup(copy)
+        finally:
+            copy.close()
+        return path
+
+    def restore(self, state):
+        import sqlite3
+
+        copy = sqlite3.connect(state)
+        try:
+            copy.backup(self.conn)
+        finally:
+            copy.close()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class BloomSeen:
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        h = digest(key)
+        h1, h2 = int.from_bytes(h[:8], 'little'), int.from_bytes(h[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def add(self, key):
+        bits = self.bits
+        new = False
+        for pos in self._positions(key):
+            byte, mask = pos >> 3, 1 << (pos & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                new = True
+        return new
+
+    def snapshot(self, prefix):
+        return self.bits
+
+    def restore(self, state):
+        self.bits[:] = state
+
+
+BACKENDS = {
+    'memory': lambda args: MemorySeen(hash_keys=bool(args.hash_keys)),
+    'sqlite': lambda args: SqliteSeen(hash_keys=bool(args.hash_keys)),
+    'bloom': lambda args: BloomSeen(capacity=args.capacity or 1000000, error_rate=args.error_rate or 0.001),
+}
+
+
+def make_seen(args):
+    """Returns a new seen-keys store, as configured in the given dedupe args.
+    """
+    backend = args.backend or 'memory'
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown dedupe backend '{backend}'. Available: {', '.join(BACKENDS)}")
+    return track(BACKENDS[backend](args))
@@ -0,0 +1,454 @@
+"""Input and output files of the command line tool.
+
+Compressed files (gzip, bzip2, xz and zstd) are detected from the file extension or, failing that, from
+the magic bytes at the beginning of the file, and decompressed on the fly. zstd requires the zstandard
+package. Uncompressed input files are memory-mapped. Lines are split out of large blocks of bytes, which
+avoids the per-line overhead of reading text files line by line.
+
+Several input files (a directory or a glob pattern) are read by MultiInput, which reads the next files ahead
+in threads. Output can be split into shards (see ShardedOutput). FollowFile keeps reading a file as it grows,
+like tail -F.
+
+Output files are compressed according to their extension.
+"""
+import io
+import os
+import sys
+import glob
+import time
+import gzip
+import mmap
+import zlib
+import queue
+import threading
+from itertools import chain
+from collections import deque
+
+
+# small enough to stay in the cpu cache
+BLOCK_SIZE = 1 << 15
+
+# name: (extensions, magic bytes, default compression level)
+COMPRESSIONS = {
+    'gzip': (('.gz', '.gzip'), b'\x1f\x8b', 6),
+    'bz2': (('.bz2',), b'BZh', 9),
+    'xz': (('.xz', '.lzma'), b'\xfd7zXZ\x00', 6),
+    'zstd': (('.zst', '.zstd'), b'\x28\xb5\x2f\xfd', 3),
+}
+
+
+def detect_compression(path, head=b''):
+    """Returns the compression name of the given file, from its extension or the given first bytes of it,
+    or None if it is not compressed.
+    """
+    lower = path.lower()
+    for name, (extensions, magic, _) in COMPRESSIONS.items():
+        if lower.endswith(extensions):
+            return name
+    for name, (_, magic, _) in COMPRESSIONS.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd compressed files require the zstandard package')
+    return zstandard
+
+
+# the modules of the less common compressions are imported on first use, which keeps startup fast
+def _decompressor(name, fileobj):
+    if name == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if name == 'bz2':
+        import bz2
+        return bz2.BZ2File(fileobj, mode='rb')
+    if name == 'xz':
+        import lzma
+        return lzma.LZMAFile(fileobj, mode='rb')
+    return _zstandard().ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+
+def _compressor(name, fileobj, level):
+    if name == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level)
+    if name == 'bz2':
+        import bz2
+        return bz2.BZ2File(fileobj, mode='wb', compresslevel=level)
+    if name == 'xz':
+        import lzma
+        return lzma.LZMAFile(fileobj, mode='wb', preset=level)
+    return _zstandard().ZstdCompressor(level=level).stream_writer(fileobj)
+
+
+def _split_blocks(read, block_size, encoding, offset=0):
+    # yields the lines of each block, with the stream offset right after them
+    tail = b''
+    while True:
+        block = read(block_size)
+        if not block:
+            break
+        end = block.rfind(b'\n')
+        if end == -1:
+            tail += block
+            continue
+        offset += len(tail) + end + 1
+        # a block cut at a newline never splits a multibyte character
+        yield (tail + block[:end]).decode(encoding).split('\n'), offset
+        tail = block[end + 1:]
+    if tail:
+        yield [tail.decode(encoding)], offset + len(tail)
+
+
+def iter_lines(read, block_size=BLOCK_SIZE, encoding='utf-8'):
+    """Returns an iterator over the lines (without line terminator) of the binary stream given by its read
+    function, which is called with block_size until it returns no data.
+    """
+    return chain.from_iterable(lines for lines, _ in _split_blocks(read, block_size, encoding))
+
+
+class InputFile:
+    """Iterates over the lines of the given path ('-' for stdin), decompressing them if needed, starting at the
+    given (uncompressed) byte offset, which must be at the beginning of a line.
+    """
+
+    def __init__(self, path='-', block_size=BLOCK_SIZE, offset=0):
+        self.path = path
+        self.block_size = block_size
+        self.offset = offset
+        self.compression = None
+        self._file = self._map = self._stream = None
+        if path == '-':
+            raw = sys.stdin.buffer
+            head = raw.peek(8)[:8] if hasattr(raw, 'peek') else b''
+        else:
+            raw = self._file = open(path, 'rb')
+            head = raw.read(8)
+            raw.seek(0)
+        self.compression = detect_compression('' if path == '-' else path, head)
+        if self.compression is not None:
+            self._stream = _decompressor(self.compression, raw)
+            self.read = self._stream.read
+        elif self._file is not None and head:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self._map, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                self._map.madvise(mmap.MADV_SEQUENTIAL)
+            self.read = self._map.read
+        else:
+            self.read = raw.read
+        if offset:
+            self._skip(offset)
+
+    def _skip(self, offset):
+        if self._map is not None:
+            self._map.seek(offset)
+            return
+        while offset:
+            data = self.read(min(offset, self.block_size))
+            if not data:
+                raise EOFError('Input is shorter than the starting offset')
+            offset -= len(data)
+
+    def __iter__(self):
+        return chain.from_iterable(lines for lines, _ in self.blocks())
+
+    def blocks(self):
+        """Yields lists of lines, together with the input offset right after each list.
+        """
+        return _split_blocks(self.read, self.block_size, 'utf-8', self.offset)
+
+    def file_blocks(self):
+        """Yields lists of lines, together with the path they were read from.
+        """
+        return ((self.path, lines) for lines, _ in self.blocks())
+
+    def close(self):
+        for obj in (self._stream, self._map, self._file):
+            if obj is not None:
+                obj.close()
+
+
+class FollowFile:
+    """Iterates over the lines of the given (uncompressed) file as they are appended to it, like tail -F. When
+    the end of the file is reached, it is polled with a delay that doubles from MIN_POLL up to poll_interval
+    while no data comes. If the path is replaced by a new file (rotation), the old one is read to its end and
+    the new one is read from its beginning; if the file is truncated (noticed when it is shorter than what was
+    read of it), it is read again from its beginning. Iteration stops after idle_timeout seconds without new
+    data (if given), or once close() is called.
+    """
+
+    MIN_POLL = 0.001
+
+    def __init__(self, path, poll_interval=0.1, idle_timeout=None, block_size=BLOCK_SIZE, offset=0):
+        if path == '-':
+            raise ValueError("can't follow stdin")
+        self.path = path
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.block_size = block_size
+        self.offset = offset
+        self.rotations = 0
+        self._closed = False
+        self._file = open(path, 'rb', buffering=0)
+        head = self._file.read(8)
+        if detect_compression(path, head) is not None:
+            self._file.close()
+            raise ValueError("can't follow a compressed file")
+        self._file.seek(offset)
+
+    def _change(self):
+        # called at the end of the file. Returns 'rotated' if the path is now another file, 'truncated' if the
+        # file got shorter than what was read of it, or None
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # rotated, and the new file is not there yet
+            return None
+        current = os.fstat(self._file.fileno())
+        if (stat.st_dev, stat.st_ino) != (current.st_dev, current.st_ino):
+            return 'rotated'
+        if current.st_size < self._file.tell():
+            return 'truncated'
+        return None
+
+    def blocks(self):
+        """Yields lists of lines, together with the offset in the current file right after each list. While
+        waiting for new data, yields an empty list after each poll.
+        """
+        tail = b''
+        last_data = time.monotonic()
+        delay = self.MIN_POLL
+        while not self._closed:
+            data = self._file.read(self.block_size)
+            if not data:
+                change = self._change()
+                if change == 'rotated':
+                    # the old file may still get a last write between our last read and the rename
+                    data = self._file.read()
+                    if not data:
+                        # the last line of the old file is complete, even without a final newline
+                        if tail:
+                            yield [tail.decode('utf-8')], self.offset + len(tail)
+                        self._file.close()
+                        self._file = open(self.path, 'rb', buffering=0)
+                        tail, self.offset = b'', 0
+                        self.rotations += 1
+                        continue
+                elif change == 'truncated':
+                    self._file.seek(0)
+                    tail, self.offset = b'', 0
+                    self.rotations += 1
+                    continue
+                else:
+                    if self.idle_timeout is not None and time.monotonic() - last_data >= self.idle_timeout:
+                        break
+                    yield [], self.offset
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.poll_interval)
+                    continue
+            last_data, delay = time.monotonic(), self.MIN_POLL
+            end = data.rfind(b'\n')
+            if end == -1:
+                tail += data
+                continue
+            self.offset += len(tail) + end + 1
+            yield (tail + data[:end]).decode('utf-8').split('\n'), self.offset
+            tail = data[end + 1:]
+        if tail:
+            yield [tail.decode('utf-8')], self.offset + len(tail)
+
+    def __iter__(self):
+        return chain.from_iterable(lines for lines, _ in self.blocks())
+
+    def file_blocks(self):
+        return ((self.path, lines) for lines, _ in self.blocks())
+
+    def close(self):
+        """Stops the iteration (once the current poll is over) and closes the file.
+        """
+        self._closed = True
+        self._file.close()
+
+
+def expand_input(spec):
+    """Returns the sorted list of files of the given directory or glob pattern, or [spec] for any other path.
+    """
+    if spec == '-':
+        return [spec]
+    if os.path.isdir(spec):
+        paths = [os.path.join(spec, name) for name in os.listdir(spec) if not name.startswith('.')]
+    elif glob.has_magic(spec):
+        paths = glob.glob(spec, recursive=True)
+    else:
+        return [spec]
+    paths = sorted(p for p in paths if os.path.isfile(p))
+    if not paths:
+        raise FileNotFoundError(f"no input files in '{spec}'")
+    return paths
+
+
+_END = object()
+
+
+class MultiInput:
+    """Iterates over the lines of the given files, one file after another. Up to readers files are read
+    (and decompressed) ahead by threads, each into a queue of queue_size blocks of lines.
+    """
+
+    def __init__(self, paths, readers=4, block_size=BLOCK_SIZE, queue_size=16):
+        self.paths = list(paths)
+        self.readers = max(readers, 1)
+        self.block_size = block_size
+        self.queue_size = queue_size
+        self._stop = threading.Event()
+
+    def _put(self, blocks, item):
+        while not self._stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(self, path, blocks):
+        try:
+            infile = InputFile(path, self.block_size)
+            try:
+                for lines, _ in infile.blocks():
+                    if not self._put(blocks, lines):
+                        return
+            finally:
+                infile.close()
+        except Exception as e:
+            self._put(blocks, e)
+            return
+        self._put(blocks, _END)
+
+    def file_blocks(self):
+        """Yields lists of lines, together with the path they were read from, in the order of the paths.
+        """
+        paths = iter(self.paths)
+        pending = deque()
+
+        def start():
+            path = next(paths, None)
+            if path is not None:
+                blocks = queue.Queue(self.queue_size)
+                threading.Thread(target=self._read, args=(path, blocks), daemon=True).start()
+                pending.append((path, blocks))
+
+        for _ in range(self.readers):
+            start()
+        while pending:
+            path, blocks = pending[0]
+            while True:
+                lines = blocks.get()
+                if lines is _END:
+                    break
+                if isinstance(lines, Exception):
+                    raise lines
+                yield path, lines
+            pending.popleft()
+            start()
+
+    def __iter__(self):
+        return chain.from_iterable(lines for _, lines in self.file_blocks())
+
+    def close(self):
+        self._stop.set()
+
+
+def open_input(spec='-', offset=0, readers=4):
+    """Returns an InputFile for a single path, or a MultiInput for a directory or glob pattern.
+    """
+    paths = expand_input(spec)
+    if paths == [spec]:
+        return InputFile(spec, offset=offset)
+    if offset:
+        raise ValueError("can't start several input files at an offset")
+    return MultiInput(paths, readers)
+
+
+def shard_of(value, shards):
+    """Returns the shard of the given key value. Unlike hash(), it is the same across runs.
+    """
+    return zlib.crc32(str(value).encode('utf-8')) % shards
+
+
+class ShardedOutput:
+    """Output split into the given number of shards, whose paths are given by formatting the template with
+    shard (i.e. 'out-{shard:03d}.jl.gz'). files is the list of (text) shard files.
+    """
+
+    def __init__(self, template, shards, level=None):
+        try:
+            paths = [template.format(shard=shard) for shard in range(shards)]
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f'invalid output path template: {e!r}')
+        if template == '-' or len(set(paths)) < shards:
+            raise ValueError('the output path must contain {shard}')
+        self.files = []
+        try:
+            for path in paths:
+                self.files.append(open_output(path, level))
+        except Exception:
+            self.close()
+            raise
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+def open_output(path='-', level=None, offset=None):
+    """Returns a text file to write into the given path ('-' for stdout), compressed according to its
+    extension with the given level (or the default level of the compression). If offset is given, the
+    existing file is truncated at that byte offset and written from there (only for uncompressed files).
+    """
+    if path == '-':
+        if offset is not None:
+            raise ValueError("can't continue writing into stdout")
+        return sys.stdout
+    compression = detect_compression(path)
+    if offset is not None:
+        if compression is not None:
+            raise ValueError("can't continue writing a compressed file")
+        output = open(path, 'r+', encoding='utf-8')
+        output.truncate(offset)
+        output.seek(offset)
+        return output
+    if compression is None:
+        return open(path, 'w', encoding='utf-8')
+    if level is None:
+        level = COMPRESSIONS[compression][2]
+    fileobj = open(path, 'wb')
+    try:
+        stream = _compressor(compression, fileobj, level)
+    except Exception:
+        fileobj.close()
+        raise
+    return _ClosingTextWrapper(stream, fileobj)
+
+
+class _ClosingTextWrapper(io.TextIOWrapper):
+    """Text wrapper over a compressed stream which also closes the underlying file, which compressed streams
+    given a file object don't.
+    """
+
+    def __init__(self, stream, fileobj):
+        super().__init__(stream, encoding='utf-8')
+        self._fileobj = fileobj
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._fileobj.close()
@@ -0,0 +1,291 @@
+"""Grouping and aggregation for the group_by operation.
+
+Records are grouped by the value of one or more (comma-separated or list) key fields, and each group is
+reduced to one record with the key fields and the results of the aggregations. Aggregations are given as
+'function', 'function:field' or 'name=function:field', i.e. 'count', 'sum:price', 'cities=distinct:city'.
+Without a name, results are saved into 'function_field' (or 'count'). Functions are:
+
+- count: number of records, or of records with the field if given.
+- sum, min, max: of the field values.
+- first, last: field value of the first and last record of the group with the field.
+- collect: list of the field values, in input order.
+- distinct: number of distinct field values.
+
+Records without the field are skipped by its aggregations (their result is None, or 0 for counts, if no
+record of the group has the field). Null values are skipped too by sum, min and max, which can't compare or
+add them, but are kept by the other functions: first and last can be None, and collect and distinct include
+them. Key values can be any JSON value, lists and dicts included.
+
+Partial aggregates are kept in a dict of up to max_groups groups. Once it is full, its groups are sorted and
+spilled into a run file on local disk, and the dict starts over, so the number of distinct keys is only
+bounded by the disk. At the end of the input, the runs are merged (with heapq.merge) and the partial
+aggregates of the same key combined. Groups come out in the order of their first record if nothing was
+spilled, and sorted by their JSON-encoded key otherwise.
+
+Group stores are tracked by the active checkpoint, if any (see json_pipeline.checkpoint).
+"""
+import os
+import heapq
+import pickle
+import shutil
+import weakref
+import operator
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+from json_pipeline.dedupe import key_fields, encode_key
+from json_pipeline.checkpoint import track
+
+
+MAX_GROUPS = 1000000
+# runs merged at once. When there are more, they are merged into a single run first
+MERGE_FANIN = 64
+
+
+def _identity(value):
+    return value
+
+
+def _append(state, value):
+    state.append(value)
+    return state
+
+
+def _add(state, value):
+    state.add(value)
+    return state
+
+
+def _hashable(value):
+    return encode_key(value) if isinstance(value, (list, dict)) else value
+
+
+# function: (start(value), add(state, value), merge(state, later state), result(state))
+AGGREGATIONS = {
+    'count': (lambda value: 1, lambda state, value: state + 1, operator.add, _identity),
+    'sum': (_identity, operator.add, operator.add, _identity),
+    'min': (_identity, min, min, _identity),
+    'max': (_identity, max, max, _identity),
+    'first': (_identity, lambda state, value: state, lambda state, other: state, _identity),
+    'last': (_identity, lambda state, value: value, lambda state, other: other, _identity),
+    'collect': (lambda value: [value], _append, operator.add, _identity),
+    'distinct': (lambda value: {_hashable(value)}, lambda state, value: _add(state, _hashable(value)),
+                 operator.or_, len),
+}
+
+# results of the aggregations that no record of a group had a value for, if not None
+EMPTY = {'count': 0, 'distinct': 0}
+# functions that skip null values
+SKIP_NULL = {'sum', 'min', 'max'}
+
+
+class _Missing:
+    # pickled by reference, so the empty states of groups spilled to disk or checkpointed are still _MISSING
+
+    def __reduce__(self):
+        return '_MISSING'
+
+
+# missing field, or state of an aggregation that no record of the group had a value for
+_MISSING = _Missing()
+
+
+class _Key:
+    """Hashable stand-in for a group key with list or dict values, by its JSON encoding.
+    """
+    __slots__ = ('value', 'encoded')
+
+    def __init__(self, value):
+        self.value = value
+        self.encoded = encode_key(value)
+
+    def __hash__(self):
+        return hash(self.encoded)
+
+    def __eq__(self, other):
+        return isinstance(other, _Key) and other.encoded == self.encoded
+
+
+def _encoded(key):
+    return key.encoded if isinstance(key, _Key) else encode_key(key)
+
+
+def parse_aggregation(spec):
+    """Returns the (name, function, field) of the given aggregation spec. field is None for plain counts.
+    """
+    name, _, spec = spec.rpartition('=')
+    function, _, field = spec.partition(':')
+    if function not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation '{function}'. Available: {', '.join(AGGREGATIONS)}")
+    if not field and function != 'count':
+        raise ValueError(f"Aggregation '{function}' requires a field, as '{function}:field'")
+    if not name:
+        name = f'{function}_{field}' if field else function
+    return name, function, field or None
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class GroupStore:
+    """Partial aggregates of the groups seen so far, spilled to disk beyond max_groups groups.
+    """
+
+    def __init__(self, aggregations, max_groups=MAX_GROUPS):
+        self.aggregations = [parse_aggregation(spec) for spec in aggregations]
+        self.max_groups = max_groups
+        self.groups = {}
+        self.runs = []
+        self._finalizers = {}
+        functions = [AGGREGATIONS[function] for _, function, _ in self.aggregations]
+        self._starts = [f[0] for f in functions]
+        self._adds = [f[1] for f in functions]
+        self._merges = [f[2] for f in functions]
+        self._results = [f[3] for f in functions]
+        self._empty = [EMPTY.get(function) for _, function, _ in self.aggregations]
+        self._fields = [field for _, _, field in self.aggregations]
+        skip_null = [function in SKIP_NULL for _, function, _ in self.aggregations]
+        self._updates = list(zip(range(len(functions)), self._fields, skip_null, self._starts, self._adds))
+
+    def add(self, key, record):
+        try:
+            states = self.groups.get(key)
+        except TypeError:
+            # list or dict values
+            key = _Key(key)
+            states = self.groups.get(key)
+        if states is None:
+            if len(self.groups) >= self.max_groups:
+                self.spill()
+            states = self.groups[key] = [_MISSING] * len(self._fields)
+        for idx, field, skip_null, start, add in self._updates:
+            value = record if field is None else record.get(field, _MISSING)
+            if value is _MISSING or (value is None and skip_null):
+                continue
+            state = states[idx]
+            states[idx] = start(value) if state is _MISSING else add(state, value)
+
+    def _new_run(self):
+        fd, path = tempfile.mkstemp(prefix='json_pipeline_groups_', suffix='.run')
+        os.close(fd)
+        self._finalizers[path] = weakref.finalize(self, _remove, path)
+        return path
+
+    def _write_run(self, items):
+        path = self._new_run()
+        with open(path, 'wb') as f:
+            for item in items:
+                pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return path
+
+    def _drop_run(self, path):
+        self._finalizers.pop(path)()
+
+    def _sorted_groups(self):
+        return sorted(((_encoded(key), key, states) for key, states in self.groups.items()), key=itemgetter(0))
+
+    def spill(self):
+        """Writes the in-memory groups, sorted by encoded key, into a new run file.
+        """
+        self.runs.append(self._write_run(self._sorted_groups()))
+        self.groups = {}
+        if len(self.runs) >= MERGE_FANIN:
+            merged = self._write_run(self._merged(self.runs))
+            for path in self.runs:
+                self._drop_run(path)
+            self.runs = [merged]
+
+    def _combine(self, states, other):
+        merges = self._merges
+        for idx, state in enumerate(other):
+            if state is _MISSING:
+                continue
+            states[idx] = state if states[idx] is _MISSING else merges[idx](states[idx], state)
+        return states
+
+    def _merged(self, runs, extra=()):
+        # runs are in input order, and heapq.merge keeps it for equal keys, so first and last hold
+        streams = [_read_run(path) for path in runs]
+        streams.append(extra)
+        for encoded, items in groupby(heapq.merge(*streams, key=itemgetter(0)), key=itemgetter(0)):
+            _, key, states = next(items)
+            for _, _, other in items:
+                states = self._combine(states, other)
+            yield encoded, key, states
+
+    def results(self):
+        """Yields the (key, list of aggregation results) of every group, and empties the store.
+        """
+        if self.runs:
+            items = ((key, states) for _, key, states in self._merged(self.runs, self._sorted_groups()))
+        else:
+            items = self.groups.items()
+        results, empty = self._results, self._empty
+        for key, states in items:
+            if isinstance(key, _Key):
+                key = key.value
+            yield key, [results[idx](state) if state is not _MISSING else empty[idx]
+                        for idx, state in enumerate(states)]
+        for path in self.runs:
+            self._drop_run(path)
+        self.groups, self.runs = {}, []
+
+    def snapshot(self, prefix):
+        """Links (or copies) the run files next to prefix, and returns them together with the in-memory groups.
+        """
+        paths = []
+        for idx, path in enumerate(self.runs):
+            target = f'{prefix}-{idx}.run'
+            _link(path, target)
+            paths.append(target)
+        return self.groups, paths
+
+    def restore(self, state):
+        groups, paths = state
+        self.groups.update(groups)
+        for path in paths:
+            run = self._new_run()
+            os.remove(run)
+            _link(path, run)
+            self.runs.append(run)
+
+
+def _link(source, target):
+    # run files are never modified once written, so they can be shared
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def group_by(dataset, args):
+    """Yields one record per group of the given records, with the key fields and the aggregation results.
+    """
+    fields = key_fields(args.field)
+    store = track(GroupStore(args.aggregations or ['count'], max_groups=args.max_groups or MAX_GROUPS))
+    if len(fields) == 1:
+        field = fields[0]
+        for d in dataset:
+            store.add(d.get(field), d)
+    else:
+        for d in dataset:
+            store.add(tuple(d.get(f) for f in fields), d)
+    names = [name for name, _, _ in store.aggregations]
+    for key, values in store.results():
+        record = {fields[0]: key} if len(fields) == 1 else dict(zip(fields, key))
+        record.update(zip(names, values))
+        yield record
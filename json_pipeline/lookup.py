@@ -0,0 +1,187 @@
+"""Indexed reference datasets for the lookup operation.
+
+The reference file (jsonlines, possibly compressed, or CSV if it has a .csv extension) is indexed once by the
+key field into a sqlite database next to it (reference.<key>.index.sqlite), which is reused by later runs
+as long as the reference file doesn't change (same size and modification time). The index is built by
+streaming the reference file, so reference datasets larger than the available memory work too. If a key
+appears several times in the reference, its first record is used.
+
+Keys are matched by their JSON value, so 1 and '1' are different keys in jsonlines references. CSV values
+are all strings, so number (and boolean) keys are looked up in CSV references by their str(), i.e. 1 and
+'1' find the same row there (but 1.0 only finds '1.0').
+
+Lookups go through an in-memory LRU cache of the most recently used keys. get_many() looks up a whole batch
+of keys with a few queries instead of one query per key. The cache holds the JSON text of the rows, which is
+decoded on every lookup, so records never share (and later steps never change) the nested values of a row.
+"""
+import os
+import csv
+import json
+import sqlite3
+import weakref
+from collections import OrderedDict
+
+from json_pipeline.dedupe import encode_key
+from json_pipeline.fileio import InputFile
+
+
+CACHE_SIZE = 100000
+# keys per query, below the default limit of sqlite host parameters
+QUERY_SIZE = 500
+INSERT_SIZE = 10000
+
+_MISSING = object()
+
+
+def index_path(reference, key):
+    return f'{reference}.{key}.index.sqlite'
+
+
+def is_csv(path):
+    return path.lower().endswith('.csv')
+
+
+def read_reference(path):
+    """Yields the records of the given reference file.
+    """
+    if is_csv(path):
+        with open(path, newline='', encoding='utf-8') as f:
+            yield from csv.DictReader(f)
+        return
+    infile = InputFile(path)
+    try:
+        for line in infile:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        infile.close()
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def build_index(reference, key, path=None):
+    """Builds the sqlite index of the given reference file by the given key field, unless an up to date
+    one exists already. Returns the index path.
+    """
+    path = path or index_path(reference, key)
+    signature = _signature(reference)
+    if os.path.exists(path):
+        conn = sqlite3.connect(path)
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'signature'").fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        finally:
+            conn.close()
+        if row is not None and row[0] == signature:
+            return path
+    # built aside and moved in place, so concurrent runs never see a partial index
+    tmppath = f'{path}.{os.getpid()}.tmp'
+    if os.path.exists(tmppath):
+        os.remove(tmppath)
+    conn = sqlite3.connect(tmppath)
+    try:
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('CREATE TABLE records (key BLOB PRIMARY KEY, value TEXT) WITHOUT ROWID')
+        conn.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+        rows = []
+        for d in read_reference(reference):
+            if key in d:
+                rows.append((encode_key(d[key]), json.dumps(d)))
+                if len(rows) >= INSERT_SIZE:
+                    conn.executemany('INSERT OR IGNORE INTO records VALUES (?, ?)', rows)
+                    rows = []
+        conn.executemany('INSERT OR IGNORE INTO records VALUES (?, ?)', rows)
+        conn.execute("INSERT INTO meta VALUES ('signature', ?)", (signature,))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmppath, path)
+    return path
+
+
+class ReferenceIndex:
+    """Read access to the index of a reference file, by key.
+    """
+
+    def __init__(self, reference, key, cache_size=CACHE_SIZE):
+        self.path = build_index(reference, key)
+        self.conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+        weakref.finalize(self, self.conn.close)
+        self.cache_size = cache_size
+        self.csv = is_csv(reference)
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+
+    def _remember(self, ekey, value):
+        self.cache[ekey] = value
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _encode(self, key):
+        if self.csv and isinstance(key, (int, float)):
+            key = str(key)
+        return encode_key(key)
+
+    def get(self, key):
+        """Returns the reference record of the given key, or None.
+        """
+        ekey = self._encode(key)
+        value = self.cache.get(ekey, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            self.cache.move_to_end(ekey)
+        else:
+            self.misses += 1
+            row = self.conn.execute('SELECT value FROM records WHERE key = ?', (ekey,)).fetchone()
+            value = row[0] if row is not None else None
+            self._remember(ekey, value)
+        return json.loads(value) if value is not None else None
+
+    def get_many(self, keys):
+        """Returns the list of reference records (or None) of the given keys.
+        """
+        ekeys = [self._encode(k) for k in keys]
+        found = {}
+        missing = []
+        for ekey in ekeys:
+            if ekey in found:
+                continue
+            value = self.cache.get(ekey, _MISSING)
+            if value is _MISSING:
+                found[ekey] = None
+                missing.append(ekey)
+            else:
+                self.hits += 1
+                self.cache.move_to_end(ekey)
+                found[ekey] = value
+        self.misses += len(missing)
+        for idx in range(0, len(missing), QUERY_SIZE):
+            chunk = missing[idx:idx + QUERY_SIZE]
+            query = f"SELECT key, value FROM records WHERE key IN ({', '.join('?' * len(chunk))})"
+            for ekey, value in self.conn.execute(query, chunk):
+                found[ekey] = value
+        for ekey in missing:
+            self._remember(ekey, found[ekey])
+        loads = json.loads
+        return [loads(found[ekey]) if found[ekey] is not None else None for ekey in ekeys]
+
+    def stats(self):
+        return {'size': len(self.cache), 'maxsize': self.cache_size, 'hits': self.hits, 'misses': self.misses}
+
+
+def enrich(d, reference, key, target):
+    """Adds the given reference record into d: into the target field if given, or else its fields other
+    than the key. Its values are not copied, so it must not be shared (lookups return a new one every time).
+    """
+    if target:
+        d[target] = reference
+    else:
+        for field, value in reference.items():
+            if field != key:
+                d[field] = value
+    return d
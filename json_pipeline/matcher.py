@@ -0,0 +1,166 @@
+"""Single matcher for a list of patterns.
+
+MultiMatcher compiles many patterns into one matcher, so a text is scanned once instead of once per pattern:
+
+- If all the patterns are literal keywords, they are searched with an Aho-Corasick automaton when the
+  pyahocorasick package is installed, or else with a single regex built from the trie of the keywords, in
+  which the regex engine follows the keywords that share a prefix at once. Either way the cost grows with
+  the length of the text, not with the number of keywords.
+- Otherwise the patterns (and the keyword trie, if any) are joined into a single alternation of
+  non-capturing groups, as saving the marks of capturing groups on every branch makes it slow. The pattern
+  that matched is then found by matching the alternatives again, in order, at the start of the match.
+  Patterns with backreferences (whose group numbers would change in the alternation), and every pattern
+  if they can't be joined (i.e. inline global flags), are searched on their own after it.
+"""
+import re
+from functools import lru_cache
+
+from json_pipeline.utils import _REGEX_SPECIAL
+
+
+_BACKREF_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+@lru_cache(maxsize=None)
+def _ahocorasick():
+    # imported on first use, as most runs don't match keywords
+    try:
+        import ahocorasick
+    except ImportError:
+        return None
+    return ahocorasick
+
+
+def load_patterns(path):
+    """Returns the patterns from the given file, one per line. Empty lines and lines starting with # are
+    skipped.
+    """
+    with open(path, encoding='utf-8') as f:
+        lines = (line.rstrip('\r\n') for line in f)
+        return [line for line in lines if line.strip() and not line.startswith('#')]
+
+
+def is_literal(pattern):
+    return not _REGEX_SPECIAL.intersection(pattern)
+
+
+def trie_regex(keywords):
+    """Returns a regex matching any of the given keywords, built from their trie.
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return _trie_to_regex(trie)
+
+
+def _trie_to_regex(node):
+    optional = '' in node
+    branches = [re.escape(char) + _trie_to_regex(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    if len(branches) == 1 and not optional:
+        return branches[0]
+    regex = '(?:' + '|'.join(branches) + ')'
+    return regex + '?' if optional else regex
+
+
+class MultiMatcher:
+    """match(text) returns one of the given patterns that match text (the first one found in it), or None
+    if none does. search(text) only tells whether any of them matches, which is cheaper.
+    """
+
+    def __init__(self, patterns, flags=0):
+        self.patterns = list(dict.fromkeys(patterns))
+        if not self.patterns:
+            raise ValueError('At least one pattern is required')
+        self.flags = flags
+        self.ignorecase = bool(flags & re.IGNORECASE)
+        # in verbose mode, whitespace in a pattern is not matched literally
+        literals = [p for p in self.patterns if is_literal(p)] if not flags & re.VERBOSE else []
+        self.keywords = {self._key(p): p for p in literals}
+        if len(literals) == len(self.patterns) and '' not in self.keywords \
+                and not flags & ~(re.IGNORECASE | re.UNICODE) and _ahocorasick() is not None:
+            self.kind = 'aho-corasick'
+            self.automaton = _ahocorasick().Automaton()
+            for key, pattern in self.keywords.items():
+                self.automaton.add_word(key, pattern)
+            self.automaton.make_automaton()
+            self.match = self._match_automaton
+            self.search = self._search_automaton
+            return
+        self.kind = 'literal' if len(literals) == len(self.patterns) else 'alternation'
+        self.trie = re.compile(trie_regex(self.keywords), flags) if literals else None
+        self.regexes = [re.compile(p, flags) for p in self.patterns
+                        if p not in self.keywords.values() and not _BACKREF_RE.search(p)]
+        # the group numbers of backreferences would change in the alternation
+        self.separate = [re.compile(p, flags) for p in self.patterns if _BACKREF_RE.search(p)]
+        alternatives = [r.pattern for r in ([self.trie] if self.trie else []) + self.regexes]
+        self.regex = None
+        if alternatives:
+            try:
+                # without capturing groups: saving their marks on every branch makes a big alternation slow
+                self.regex = re.compile('|'.join(f'(?:{a})' for a in alternatives), flags)
+            except re.error:
+                # i.e. inline global flags, or the same group name in several patterns
+                self.separate = self.regexes + self.separate
+                self.regexes = []
+                if self.trie is not None:
+                    self.regex = self.trie
+        self.match = self._match_regex
+        self.search = self._search_regex
+
+    def _key(self, text):
+        return text.lower() if self.ignorecase else text
+
+    def _match_automaton(self, text):
+        for _, pattern in self.automaton.iter(self._key(text)):
+            return pattern
+        return None
+
+    def _search_automaton(self, text):
+        return self._match_automaton(text) is not None
+
+    def _search_regex(self, text):
+        if self.regex is not None and self.regex.search(text):
+            return True
+        return any(regex.search(text) for regex in self.separate)
+
+    def _keyword(self, found):
+        pattern = self.keywords.get(self._key(found))
+        if pattern is None:
+            # case insensitive regex matching is not exactly lower()
+            pattern = next(p for p in self.keywords.values() if re.fullmatch(re.escape(p), found, self.flags))
+        return pattern
+
+    def _match_regex(self, text):
+        if self.regex is not None:
+            m = self.regex.search(text)
+            if m:
+                # the alternative that matched is the first one matching at the same position
+                start = m.start()
+                if self.trie is not None:
+                    k = self.trie.match(text, start)
+                    if k:
+                        return self._keyword(k.group())
+                for regex in self.regexes:
+                    if regex.match(text, start):
+                        return regex.pattern
+        for regex in self.separate:
+            if regex.search(text):
+                return regex.pattern
+        return None
+
+
+def patterns_from_args(args):
+    """Returns the patterns of a filter_regex (or filter_regex_neg) step: its regex (a pattern or a list of
+    them) plus the ones from its patterns_file, or None if the step has a single pattern and no target.
+    """
+    if isinstance(args.regex, str) and not args.patterns_file and not getattr(args, 'target', None):
+        return None
+    patterns = [args.regex] if isinstance(args.regex, str) else list(args.regex or [])
+    if args.patterns_file:
+        patterns.extend(load_patterns(args.patterns_file))
+    return patterns
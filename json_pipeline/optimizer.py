@@ -0,0 +1,207 @@
+"""Rewrites a pipeline (a list of Args) into an equivalent, cheaper one.
+
+Every step is described by the record fields it reads and writes (see effects()). Two adjacent steps are
+only swapped when neither of them is a barrier (stateful or opaque operations, like dedupe or function)
+and none of the fields written by one of them is read or written by the other, so the swap can't change
+the result of any record. On top of that:
+
+- filters are moved as early as possible, so discarded records skip the work of the steps before them.
+- remove_fields steps are moved as early as possible, so removed fields are not carried along.
+- consecutive remove_fields, rename_field and fixedvalue steps are merged into a single step.
+- consecutive filter_regex (or filter_regex_neg) steps on the same field and flags are merged into a
+  single regex, unless in verbose mode.
+
+Each rewrite is recorded in the returned log together with its justification.
+"""
+import re
+from string import Formatter
+from collections import namedtuple
+
+from json_pipeline.utils import reflags
+
+
+Effects = namedtuple('Effects', ('kind', 'reads', 'writes'))
+
+FILTER, MAP, BARRIER = 'filter', 'map', 'barrier'
+
+_BACKREF_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def _as_list(fields):
+    if isinstance(fields, str):
+        return fields.split(',')
+    return list(fields)
+
+
+def format_fields(template):
+    """Returns the set of record fields used by the given str.format() template.
+    """
+    fields = set()
+    for _, name, spec, _ in Formatter().parse(template):
+        if name is not None:
+            fields.add(re.match(r'[^.\[]*', name).group())
+        if spec:
+            fields |= format_fields(spec)
+    return fields
+
+
+def effects(step):
+    op = step.operation
+    if op == 'filter_regex' and step.target:
+        return Effects(FILTER, frozenset([step.field]), frozenset([step.target]))
+    if op in ('filter_regex', 'filter_regex_neg', 'filter_not_exists'):
+        return Effects(FILTER, frozenset([step.field]), frozenset())
+    if op == 'cross_filter':
+        return Effects(FILTER, frozenset([step.field, step.target]), frozenset())
+    if op == 'rename_field':
+        mapping = step.field if isinstance(step.field, dict) else {step.field: step.target}
+        fields = frozenset(mapping) | frozenset(mapping.values())
+        return Effects(MAP, fields, fields)
+    if op == 'extract':
+        reads = {step.field}
+        if step.regex_per_item is not None:
+            reads |= format_fields(step.regex_per_item)
+        return Effects(MAP, frozenset(reads), frozenset([step.target]))
+    if op == 'template':
+        return Effects(MAP, frozenset(format_fields(step.field)), frozenset([step.target]))
+    if op == 'remove_fields':
+        return Effects(MAP, frozenset(), frozenset(_as_list(step.field)))
+    if op == 'plaintext':
+        return Effects(MAP, frozenset([step.field]), frozenset([step.field]))
+    if op in ('fixedvalue', 'fixed_value'):
+        fields = step.field if isinstance(step.field, dict) else [step.field]
+        return Effects(MAP, frozenset(), frozenset(fields))
+    if op == 'lookup' and step.target:
+        return Effects(MAP, frozenset([step.field]), frozenset([step.target]))
+    return Effects(BARRIER, None, None)
+
+
+def commute(first, second):
+    """Tells whether the given consecutive steps can be swapped without changing the result, and why.
+    """
+    a, b = effects(first), effects(second)
+    if BARRIER in (a.kind, b.kind):
+        return False, 'barrier'
+    conflicts = (a.writes & (b.reads | b.writes)) | (b.writes & a.reads)
+    if conflicts:
+        return False, 'both use ' + ', '.join(sorted(conflicts))
+    return True, 'reads {} / writes {} are disjoint from reads {} / writes {}'.format(
+        _fmt(b.reads), _fmt(b.writes), _fmt(a.reads), _fmt(a.writes))
+
+
+def _fmt(fields):
+    return '{' + ', '.join(sorted(fields)) + '}'
+
+
+def describe(step):
+    items = [f'{k}={v!r}' for k, v in step._asdict().items()
+             if k != 'operation' and v not in (None, '', [], False)]
+    return f"{step.operation}({', '.join(items)})"
+
+
+def format_plan(pipeline):
+    return '\n'.join(f'{idx}. {describe(step)}' for idx, step in enumerate(pipeline, 1))
+
+
+def _is_movable(step, kind):
+    if kind == FILTER:
+        return effects(step).kind == FILTER
+    return step.operation == 'remove_fields'
+
+
+def _push_early(pipeline, kind, log):
+    pipeline = list(pipeline)
+    for idx in range(len(pipeline)):
+        if not _is_movable(pipeline[idx], kind):
+            continue
+        pos = idx
+        while pos > 0 and effects(pipeline[pos - 1]).kind == MAP and not _is_movable(pipeline[pos - 1], kind):
+            ok, why = commute(pipeline[pos - 1], pipeline[pos])
+            if not ok:
+                break
+            log.append(f'move {describe(pipeline[pos])} before {describe(pipeline[pos - 1])}: {why}')
+            pipeline[pos - 1], pipeline[pos] = pipeline[pos], pipeline[pos - 1]
+            pos -= 1
+    return pipeline
+
+
+def _merge_regex(first, second):
+    if first.field != second.field or sorted(first.regex_flags or []) != sorted(second.regex_flags or []):
+        return None
+    if not all(isinstance(s.regex, str) and not s.patterns_file and not s.target for s in (first, second)):
+        return None
+    if any(_BACKREF_RE.search(s.regex) for s in (first, second)):
+        return None
+    flags = reflags(first.regex_flags)
+    if flags & re.VERBOSE:
+        # a comment in the first pattern would swallow the rest of the merged regex
+        return None
+    if first.operation == 'filter_regex':
+        # anchored, so a search that fails tries the lookaheads at the start only instead of at every offset
+        regex = f'\\A(?=[\\s\\S]*?(?:{first.regex}))(?=[\\s\\S]*?(?:{second.regex}))'
+    else:
+        regex = f'(?:{first.regex})|(?:{second.regex})'
+    try:
+        re.compile(regex, flags)
+    except re.error:
+        return None
+    return first._replace(regex=regex)
+
+
+def _merge(first, second):
+    op = first.operation
+    if op != second.operation:
+        return None
+    if op == 'remove_fields':
+        fields = _as_list(first.field)
+        fields.extend(f for f in _as_list(second.field) if f not in fields)
+        return first._replace(field=fields)
+    if op == 'rename_field':
+        mapping = dict(first.field) if isinstance(first.field, dict) else {first.field: first.target}
+        other = second.field if isinstance(second.field, dict) else {second.field: second.target}
+        if set(other) & set(mapping):
+            # renames are applied in order, a repeated source field can't be expressed with a mapping
+            return None
+        mapping.update(other)
+        return first._replace(field=mapping, target=None)
+    if op in ('fixedvalue', 'fixed_value'):
+        mapping = dict(first.field) if isinstance(first.field, dict) else {first.field: first.target}
+        other = second.field if isinstance(second.field, dict) else {second.field: second.target}
+        mapping.update(other)
+        return first._replace(field=mapping, target=None)
+    if op in ('filter_regex', 'filter_regex_neg'):
+        return _merge_regex(first, second)
+    return None
+
+
+def _merge_consecutive(pipeline, log):
+    result = []
+    for step in pipeline:
+        merged = _merge(result[-1], step) if result else None
+        if merged is not None:
+            log.append(f'merge {describe(result[-1])} and {describe(step)}')
+            result[-1] = merged
+        else:
+            result.append(step)
+    return result
+
+
+def optimize(pipeline):
+    """Returns the optimized pipeline and the log of applied rewrites.
+    """
+    log = []
+    result = _push_early(pipeline, FILTER, log)
+    result = _push_early(result, MAP, log)
+    result = _merge_consecutive(result, log)
+    return result, log
+
+
+def explain(pipeline):
+    """Returns a printable report with the plan before and after the optimization.
+    """
+    optimized, log = optimize(pipeline)
+    lines = ['Plan:', format_plan(pipeline), '', 'Optimized plan:', format_plan(optimized)]
+    if log:
+        lines.extend(['', 'Rewrites:'])
+        lines.extend(f'- {entry}' for entry in log)
+    return '\n'.join(lines)
@@ -0,0 +1,99 @@
+"""Multi-process execution of Transform pipelines.
+
+The input is split into chunks which are processed by a pool of worker processes. Only the leading
+stateless steps of a pipeline run in the workers: from the first stateful step on (see
+Transform.STATEFUL_OPERATIONS), the remaining steps run serially in the parent process over the merged
+worker results, so operations like dedupe keep their global semantics.
+"""
+import os
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+
+
+_worker_state = None
+
+
+def split_steps(transform_cls, steps):
+    """Split the pipeline steps into the leading stateless ones, which can run in parallel, and the rest.
+    """
+    for idx, step in enumerate(steps):
+        if step.operation in transform_cls.STATEFUL_OPERATIONS:
+            return steps[:idx], steps[idx:]
+    return steps, []
+
+
+def chunked(dataset, size):
+    dataset = iter(dataset)
+    while True:
+        chunk = list(islice(dataset, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def _pack(transform_cls, step):
+    # Args namedtuples (and argparse namespaces holding open files) don't pickle, so send plain dicts
+    return {prop: getattr(step, prop, transform_cls.get_default(prop)) for prop in transform_cls.ARGS_PROPERTIES}
+
+
+def _init_worker(transform_cls, steps, decode, encode):
+    global _worker_state
+    _worker_state = (transform_cls.compile([transform_cls.args_from_dict(s) for s in steps]), decode, encode)
+
+
+def _process_chunk(chunk):
+    pipeline, decode, encode = _worker_state
+    result = map(decode, chunk) if decode is not None else chunk
+    result = pipeline(result)
+    if encode is not None:
+        result = map(encode, result)
+    return list(result)
+
+
+def run_parallel(transform_cls, dataset, steps, workers=None, chunksize=1000, ordered=True, decode=None,
+                 encode=None):
+    """Run the given pipeline steps over dataset using a pool of worker processes.
+
+    If decode is given, dataset items are decoded with it in the workers (i.e. raw jsonlines). If encode is
+    given, results are encoded before being yielded. With ordered=False, chunks are yielded as soon as they
+    are ready, so output order is not preserved.
+    """
+    parallel_steps, serial_steps = split_steps(transform_cls, steps)
+    worker_encode = encode if not serial_steps else None
+    workers = workers or os.cpu_count()
+    initargs = (transform_cls, [_pack(transform_cls, s) for s in parallel_steps], decode, worker_encode)
+
+    def _results():
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as executor:
+            max_pending = 2 * workers
+            pending = deque() if ordered else set()
+            try:
+                if ordered:
+                    for chunk in chunked(dataset, chunksize):
+                        pending.append(executor.submit(_process_chunk, chunk))
+                        if len(pending) >= max_pending:
+                            yield from pending.popleft().result()
+                    while pending:
+                        yield from pending.popleft().result()
+                else:
+                    for chunk in chunked(dataset, chunksize):
+                        pending.add(executor.submit(_process_chunk, chunk))
+                        if len(pending) >= max_pending:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                yield from future.result()
+                    for future in as_completed(pending):
+                        yield from future.result()
+            finally:
+                # if the results are not consumed to the end (i.e. a limit step after them), the chunks that
+                # didn't start yet are dropped
+                for future in pending:
+                    future.cancel()
+
+    result = _results()
+    if serial_steps:
+        result = transform_cls.compile(serial_steps)(result)
+        if encode is not None:
+            result = map(encode, result)
+    return result
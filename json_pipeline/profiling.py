@@ -0,0 +1,203 @@
+"""Per-stage instrumentation of pipelines.
+
+Profiler.instrument() chains the pipeline stages putting a tap between each pair of them. Every time a
+record crosses a tap, the wall and cpu time elapsed since the previous crossing is attributed to the stage
+that was running, so each stage gets its own time, excluding the time spent by its upstream stages. Besides
+the pipeline steps, the time spent producing the input records (i.e. decoding) and consuming the output
+records (i.e. encoding and writing) is reported as the input and output stages.
+
+With sample=N, only the processing of one of every N input records (at random) is timed (records are always counted),
+and times are extrapolated. Per-record latencies are the stage time between two consecutive records out of
+it (within the processing of one input record), and their percentiles are computed over a bounded reservoir
+of samples.
+"""
+import sys
+import json
+import time
+import random
+
+
+RESERVOIR_SIZE = 10000
+
+
+class StageStats:
+
+    def __init__(self, name):
+        self.name = name
+        self.records_in = 0
+        self.records_out = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.mark = 0.0
+        self.latencies = []
+        self.seen_latencies = 0
+
+    def add_latency(self, latency):
+        self.seen_latencies += 1
+        if len(self.latencies) < RESERVOIR_SIZE:
+            self.latencies.append(latency)
+        else:
+            idx = random.randrange(self.seen_latencies)
+            if idx < RESERVOIR_SIZE:
+                self.latencies[idx] = latency
+
+    def percentile(self, pct):
+        if not self.latencies:
+            return None
+        values = sorted(self.latencies)
+        return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Profiler:
+
+    _overhead = None
+
+    def __init__(self, sample=1):
+        self.sample = max(int(sample), 1)
+        self.stats = []
+        self.cycles = 0
+        self.timed_cycles = 0
+        self.timing = False
+        self.active = 0
+        self.last_wall = self.last_cpu = 0.0
+        self.started = self.finished = None
+        self.overhead = 0.0
+
+    @classmethod
+    def calibrate(cls, rounds=5000):
+        """Returns the time attributed to a stage by the instrumentation itself on each switch between stages,
+        which is discounted from every measurement. Measured once per process, on an empty pipeline.
+        """
+        if cls._overhead is None:
+            profiler = cls()
+            for _ in profiler._instrument(range(rounds), [('noop', iter)]):
+                pass
+            switches = rounds * 5
+            cls._overhead = sum(stats.wall for stats in profiler.stats) / switches
+        return cls._overhead
+
+    def _switch(self, stage):
+        if self.timing:
+            wall, cpu = time.perf_counter(), time.process_time()
+            stats = self.stats[self.active]
+            stats.wall += max(wall - self.last_wall - self.overhead, 0.0)
+            stats.cpu += max(cpu - self.last_cpu - self.overhead, 0.0)
+            self.last_wall, self.last_cpu = wall, cpu
+        self.active = stage
+
+    def _start_cycle(self):
+        # a new input record is requested, so the previous one went through all the pipeline
+        # sampled at random, so periodic patterns in the input don't bias the estimation
+        self.timing = self.sample == 1 or random.random() * self.sample < 1
+        self.cycles += 1
+        if self.timing:
+            self.timed_cycles += 1
+            self.last_wall, self.last_cpu = time.perf_counter(), time.process_time()
+            for stats in self.stats:
+                stats.mark = stats.wall
+
+    def _tap(self, iterable, up):
+        down = up + 1
+        upstats, downstats = self.stats[up], self.stats[down]
+        iterator = iter(iterable)
+        while True:
+            self._switch(up)
+            if up == 0:
+                self._start_cycle()
+            try:
+                d = next(iterator)
+            except StopIteration:
+                self._switch(down)
+                return
+            if self.timing:
+                upstats.add_latency(upstats.wall + time.perf_counter() - self.last_wall - upstats.mark)
+            self._switch(down)
+            upstats.mark = upstats.wall
+            upstats.records_out += 1
+            downstats.records_in += 1
+            yield d
+
+    def _sink(self, iterable):
+        output = len(self.stats) - 1
+        for d in iterable:
+            yield d
+            # accounts the time spent by the consumer
+            self._switch(output)
+        self.finished = time.perf_counter()
+
+    def instrument(self, dataset, stages):
+        """Chains the given (name, function) stages over dataset, with a tap between each pair of them.
+        Each function must take a dataset and return an iterator over the results.
+        """
+        self.overhead = self.calibrate()
+        return self._instrument(dataset, stages)
+
+    def _instrument(self, dataset, stages):
+        self.stats = [StageStats('input')] + [StageStats(name) for name, _ in stages] + [StageStats('output')]
+        self.started = time.perf_counter()
+        result = self._tap(dataset, 0)
+        for idx, (_, func) in enumerate(stages, 1):
+            result = self._tap(func(result), idx)
+        return self._sink(result)
+
+    def report(self):
+        scale = self.cycles / self.timed_cycles if self.timed_cycles else 0
+        result = []
+        for idx, stats in enumerate(self.stats):
+            p50, p99 = stats.percentile(50), stats.percentile(99)
+            drop_rate = None
+            if 0 < idx < len(self.stats) - 1:
+                drop_rate = 1 - stats.records_out / stats.records_in if stats.records_in else 0.0
+            result.append({
+                'stage': stats.name,
+                'records_in': stats.records_in,
+                'records_out': stats.records_out,
+                'drop_rate': drop_rate,
+                'wall_time': stats.wall * scale,
+                'cpu_time': stats.cpu * scale,
+                'p50_latency': p50,
+                'p99_latency': p99,
+            })
+        return result
+
+    def format_table(self):
+        lines = ['{:<40} {:>10} {:>10} {:>7} {:>10} {:>10} {:>10} {:>10}'.format(
+            'stage', 'in', 'out', 'drop%', 'wall (s)', 'cpu (s)', 'p50 (us)', 'p99 (us)')]
+        for row in self.report():
+            drop = '-' if row['drop_rate'] is None else f"{row['drop_rate'] * 100:.1f}"
+            lines.append('{:<40} {:>10} {:>10} {:>7} {:>10.3f} {:>10.3f} {:>10} {:>10}'.format(
+                row['stage'][:40], row['records_in'], row['records_out'], drop,
+                row['wall_time'], row['cpu_time'], _us(row['p50_latency']), _us(row['p99_latency'])))
+        if self.started is not None and self.finished is not None:
+            records = self.stats[-1].records_in
+            lines.append(f'total: {records} records in {self.finished - self.started:.3f}s')
+        return '\n'.join(lines)
+
+    def emit(self, fmt='table', stream=None):
+        stream = stream or sys.stderr
+        if fmt == 'json':
+            print(json.dumps(self.report()), file=stream)
+        else:
+            print(self.format_table(), file=stream)
+
+
+def _us(seconds):
+    return '-' if seconds is None else f'{seconds * 1e6:.1f}'
+
+
+def progress(dataset, interval=10.0, stream=None):
+    """Passes through the given records, printing the number of records and the current rate into the given
+    stream (stderr by default) every interval seconds.
+    """
+    stream = stream or sys.stderr
+    start = last = time.perf_counter()
+    count = last_count = 0
+    for d in dataset:
+        yield d
+        count += 1
+        if not count & 255:
+            now = time.perf_counter()
+            if now - last >= interval:
+                print(f'{count} records, {(count - last_count) / (now - last):.0f} records/s '
+                      f'({count / (now - start):.0f} records/s overall)', file=stream)
+                last, last_count = now, count
@@ -0,0 +1,236 @@
+"""Pipeline spec files.
+
+A spec file is a JSON or YAML (requires the PyYAML package) file with a mapping from pipeline names to lists
+of steps, each step being a mapping of Args properties (see Transform.args_from_dict), i.e.:
+
+    offices:
+      - {operation: filter_regex, field: name, regex: office, regex_flags: [I]}
+      - {operation: dedupe, field: id}
+      - {operation: function, field: mymodule.geocode}
+
+Specs are validated against the operations of the Transform class before anything runs. Unknown operations
+and arguments, missing fields, invalid regexes and flags, unknown dedupe backends, function paths that can't
+be imported and presets naming missing pipelines are all reported at once. preset steps without pipeline nor
+pipeline_file run a pipeline of the same file.
+
+Validated specs are cached on disk (in $JSON_PIPELINE_CACHE, by default ~/.cache/json_pipeline), keyed by the
+sha256 of the spec contents, its path and the operations of the Transform class, so later runs of the same
+spec skip parsing and validation.
+"""
+import os
+import re
+import json
+import pickle
+import hashlib
+import tempfile
+
+from json_pipeline.utils import load_object
+
+
+CACHE_VERSION = 1
+
+YAML_EXTENSIONS = ('.yaml', '.yml')
+
+# specs loaded by this process, by cache key
+_LOADED = {}
+
+
+def cache_dir():
+    path = os.environ.get('JSON_PIPELINE_CACHE')
+    if not path:
+        path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'json_pipeline')
+    return path
+
+
+def parse_spec(data, path):
+    """Parses the given spec file contents, as YAML if the path has a YAML extension and as JSON otherwise.
+    """
+    if path.lower().endswith(YAML_EXTENSIONS):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('YAML pipeline specs require the PyYAML package')
+        try:
+            # the libyaml loader is much faster, when available
+            return yaml.load(data, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+        except yaml.YAMLError as e:
+            raise ValueError(f"Invalid pipeline spec '{path}': {e}")
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        raise ValueError(f"Invalid pipeline spec '{path}': {e}")
+
+
+def _check_regex(value, flags, errors):
+    patterns = [value] if isinstance(value, str) else value
+    if not isinstance(patterns, list) or not all(isinstance(p, str) for p in patterns):
+        errors.append('regex must be a string or a list of strings')
+        return
+    for pattern in patterns:
+        try:
+            re.compile(pattern, flags)
+        except re.error as e:
+            errors.append(f'invalid regex {pattern!r}: {e}')
+
+
+def _check_flags(value, errors):
+    if not isinstance(value, list) or not all(isinstance(f, str) for f in value):
+        errors.append('regex_flags must be a list of flag names')
+        return 0
+    flags = 0
+    for name in value:
+        flag = getattr(re, name, None)
+        if not isinstance(flag, re.RegexFlag):
+            errors.append(f'unknown regex flag {name!r}')
+        else:
+            flags |= flag
+    return flags
+
+
+def _check_aggregations(value, errors):
+    from json_pipeline.groupby import parse_aggregation
+
+    if not isinstance(value, list) or not all(isinstance(a, str) for a in value):
+        errors.append('aggregations must be a list of strings')
+        return
+    for spec in value:
+        try:
+            parse_aggregation(spec)
+        except ValueError as e:
+            errors.append(str(e))
+
+
+def check_step(step, operations, names):
+    """Returns the list of errors of the given step (a mapping of Args properties). names are the pipeline
+    names of the spec.
+    """
+    if not isinstance(step, dict):
+        return ['a step must be a mapping']
+    operation = step.get('operation')
+    if operation not in operations:
+        return [f'unknown operation {operation!r}']
+    errors = []
+    allowed = operations[operation][1]
+    if operation == 'function':
+        from json_pipeline.transform import Args
+
+        # the function gets all the args of its step, i.e. utils.dict_to_text reads target and separator
+        allowed = Args._fields
+    unknown = sorted(k for k in step if k != 'operation' and k not in allowed)
+    if unknown:
+        errors.append(f"unknown argument{'s' if len(unknown) > 1 else ''} {', '.join(map(repr, unknown))}")
+    if 'field' in allowed and step.get('field') is None:
+        errors.append('missing field')
+    flags = _check_flags(step['regex_flags'], errors) if step.get('regex_flags') is not None else 0
+    if step.get('regex') is not None:
+        _check_regex(step['regex'], flags, errors)
+    if step.get('backend') is not None:
+        from json_pipeline.dedupe import BACKENDS
+
+        if step['backend'] not in BACKENDS:
+            errors.append(f"unknown dedupe backend {step['backend']!r}")
+    if step.get('capacity') is not None and (type(step['capacity']) is not int or step['capacity'] <= 0):
+        errors.append('capacity must be a positive integer')
+    error_rate = step.get('error_rate')
+    if error_rate is not None and (not isinstance(error_rate, (int, float)) or not 0 < error_rate < 1):
+        errors.append('error_rate must be between 0 and 1')
+    count, fraction = step.get('count'), step.get('fraction')
+    if count is not None and (type(count) is not int or count < 0):
+        errors.append('count must be a non-negative integer')
+    if fraction is not None and (not isinstance(fraction, (int, float)) or not 0 <= fraction <= 1):
+        errors.append('fraction must be between 0 and 1')
+    if step.get('seed') is not None and type(step['seed']) is not int:
+        errors.append('seed must be an integer')
+    if operation in ('limit', 'skip') and count is None:
+        errors.append('missing count')
+    if operation == 'sample' and (count is None) == (fraction is None):
+        errors.append('sample requires either count or fraction')
+    if step.get('max_groups') is not None and (type(step['max_groups']) is not int or step['max_groups'] <= 0):
+        errors.append('max_groups must be a positive integer')
+    if step.get('aggregations') is not None:
+        _check_aggregations(step['aggregations'], errors)
+    if operation == 'function' and step.get('field') is not None:
+        try:
+            func = load_object(step['field'])
+        except (ImportError, ValueError, NameError, TypeError, AttributeError) as e:
+            errors.append(f"can't load function {step['field']!r}: {e}")
+        else:
+            if not callable(func):
+                errors.append(f"{step['field']!r} is not callable")
+    if operation == 'preset':
+        if step.get('target') is None:
+            errors.append('missing target')
+        elif not step.get('pipeline') and not step.get('pipeline_file') and step['target'] not in names:
+            errors.append(f"unknown pipeline {step['target']!r}")
+    return errors
+
+
+def validate_spec(spec, operations, path):
+    """Validates the given parsed spec, raising ValueError with all its errors. Returns the spec, with the
+    preset steps that refer to pipelines of the same file pointing to it.
+    """
+    if not isinstance(spec, dict) or not all(isinstance(steps, list) for steps in spec.values()):
+        raise ValueError(f"Invalid pipeline spec '{path}': it must be a mapping from names to lists of steps")
+    errors = []
+    for name, steps in spec.items():
+        for idx, step in enumerate(steps):
+            for error in check_step(step, operations, spec):
+                op = f" ({step['operation']})" if isinstance(step, dict) and 'operation' in step else ''
+                errors.append(f'{name}[{idx}]{op}: {error}')
+            if isinstance(step, dict) and step.get('operation') == 'preset':
+                if not step.get('pipeline') and not step.get('pipeline_file'):
+                    step['pipeline_file'] = path
+    if errors:
+        raise ValueError(f"Invalid pipeline spec '{path}':\n  " + '\n  '.join(errors))
+    return spec
+
+
+def _cache_key(data, path, operations):
+    digest = hashlib.sha256(data)
+    digest.update(os.path.realpath(path).encode('utf-8'))
+    digest.update(repr((CACHE_VERSION, sorted((op, args) for op, (_, args) in operations.items()))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _read_cache(cachepath):
+    try:
+        with open(cachepath, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+
+
+def _write_cache(cachepath, spec):
+    """Writes the cache file atomically. Failures are ignored, the cache is only an optimization.
+    """
+    try:
+        os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(cachepath), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(spec, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath, cachepath)
+        except BaseException:
+            os.remove(tmppath)
+            raise
+    except OSError:
+        pass
+
+
+def load_spec(path, operations, cache=True):
+    """Returns the validated spec of the given file, a mapping from pipeline names to lists of steps (mappings
+    of Args properties).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    key = _cache_key(data, path, operations)
+    if key in _LOADED:
+        return _LOADED[key]
+    cachepath = os.path.join(cache_dir(), 'specs', key + '.pickle')
+    spec = _read_cache(cachepath) if cache else None
+    if spec is None:
+        spec = validate_spec(parse_spec(data, path), operations, os.path.abspath(path))
+        if cache:
+            _write_cache(cachepath, spec)
+    _LOADED[key] = spec
+    return spec
@@ -1,63 +1,72 @@
+import os
 import re
 import sys
 import json
+import time
+import random
 import argparse
 from functools import partial
+from operator import itemgetter
 from collections import namedtuple
 
-from json_pipeline.utils import load_object
+from json_pipeline.utils import load_object, reflags, plain, per_item_search, REGEX_CACHE  # noqa: F401
+from json_pipeline.compiler import compile_pipeline
+from json_pipeline.profiling import Profiler, progress
+from json_pipeline.matcher import MultiMatcher, patterns_from_args
+from json_pipeline.fileio import (InputFile, FollowFile, ShardedOutput, open_input, open_output, expand_input,
+                                  detect_compression, shard_of)
+from json_pipeline.codec import get_codec, BACKENDS as CODEC_BACKENDS
+from json_pipeline.dedupe import key_fields, make_seen, BACKENDS as DEDUPE_BACKENDS
+from json_pipeline.checkpoint import Checkpointer, track
+
+# the modules of the optional execution modes (parallel, batch, aio), of lookup, spec files and the optimizer
+# are imported by the methods that use them, so the command line starts fast
 
 
 _args_properties = ('operation', 'field', 'regex', 'target', 'separator', 'regex_flags',
-                    'regex_per_item', 'preset', 'pipeline')
+                    'regex_per_item', 'preset', 'pipeline', 'optimize', 'backend', 'capacity', 'error_rate',
+                    'hash_keys', 'escape_per_item', 'patterns_file', 'reference', 'reference_key', 'pipeline_file',
+                    'count', 'fraction', 'seed', 'aggregations', 'max_groups')
 Args = namedtuple('OpArgs', _args_properties)
 
+# compiled preset pipelines, by (class, id of the list of steps, optimize), with the list itself, so its id is
+# not reused while cached. Pipelines of spec files, converted to Args, by (class, id of the spec), with the spec
+_COMPILED = {}
+_SPEC_PIPELINES = {}
+_CACHE_SIZE = 128
+
 _ARGS_HELPS = {
     'field': 'target field',
 }
 
 
-def reflags(lst):
-    lst = lst or []
-    result = 0
-    for op in [getattr(re, f) for f in lst]:
-        result = result | op
-    return result
-
-
-_UNDERSCORE_RE = re.compile(r'[\s-]+')
-_REMOVE_RE = re.compile(r'[^\w\d\s-]+')
-
-
-def plain(txt):
-    txt = txt.lower()
-    txt = _UNDERSCORE_RE.sub('_', txt)
-    txt = _REMOVE_RE.sub('', txt)
-    return txt
-
-
 class Transform:
 
+    ARGS_PROPERTIES = _args_properties
     OPERATIONS = {
-        'filter_regex': ("Filters out records that don't match given regex in the given field",
-                         ('field', 'regex', 'regex_flags')),
-        'filter_regex_neg': ("Filters out records that match given regex in the given field",
-                             ('field', 'regex', 'regex_flags')),
+        'filter_regex': ("Filters out records that don't match given regex (or any of a list of regexes) in the \
+                          given field. The matching regex can be saved into the target field",
+                         ('field', 'regex', 'regex_flags', 'target', 'patterns_file')),
+        'filter_regex_neg': ("Filters out records that match given regex (or any of a list of regexes) in the given \
+                              field", ('field', 'regex', 'regex_flags', 'patterns_file')),
         'cross_filter': ("Filters out records for which given field don't match value from another (target) field",
                          ('field', 'target')),
         'filter_not_exists': ("Filters out records that doesn't have given field", ('field',)),
-        'rename_field': ("Rename provided field to the target one.",
+        'rename_field': ("Rename provided field to the target one. Field can also be a mapping from fields to targets.",
                          ('field', 'target')),
         'extract': ("Extracts the regex groups from the given field, and save in the given target field",
-                    ('field', 'regex', 'regex_flags', 'target', 'separator', 'regex_per_item')),
+                    ('field', 'regex', 'regex_flags', 'target', 'separator', 'regex_per_item', 'escape_per_item')),
         'template': ("Copy given fields (in template format) from each record in a dataset into the given target field",
                      ('field', 'target')),
         'remove_fields': ("Remove the given fields (either comma-separated or a list) of each record in a dataset.",
                           ('field',)),
-        'dedupe': ("Dedupe using given field as deduping key", ('field')),
+        'dedupe': ("Dedupe using given field (or comma-separated fields) as deduping key. Backend can be memory, \
+                    sqlite (spills to local disk) or bloom (fixed memory, with error_rate false positives)",
+                   ('field', 'backend', 'capacity', 'error_rate', 'hash_keys')),
         'preset': ("Preset filtering. Pipeline must be a mapping from a pipeline name (provided in args.target)\
-                    to a list of Args objects. Pipeline can be given via arguments or as a class attribute. ",
-                   ('target', 'operation')),
+                    to a list of Args objects. Pipeline can be given via arguments, as a class attribute or as a \
+                    JSON or YAML spec file (pipeline_file). ",
+                   ('target', 'operation', 'pipeline', 'optimize', 'pipeline_file')),
         'plaintext': ("Converts text to plain:\
                         - lowers letters\
                         - replace spaces and hyphens by _\
@@ -68,17 +77,50 @@ class Transform:
                       Function return value is the modified record.\
                       Function is provided in the field argument.",
                      ('field',)),
-        'fixed_value': ("Add a fixed target value to the given field in every record",
+        'lookup': ("Joins each record with the record of a reference file (jsonlines, or CSV if it has a .csv \
+                    extension) whose reference_key (by default, the same as field) is equal to the record field. \
+                    The reference record is saved into the target field, or if no target is given, its fields \
+                    are added to the record. The reference file is indexed on disk once and the index is reused.",
+                   ('field', 'target', 'reference', 'reference_key')),
+        'fixed_value': ("Add a fixed target value to the given field in every record. Field can also be a mapping \
+                         from fields to values.",
                         ('field', 'target')),
+        'limit': ("Keep only the first count records. Nothing more is read once they are out.", ('count',)),
+        'skip': ("Drop the first count records.", ('count',)),
+        'sample': ("Keep a random sample of the records: each one with probability fraction, or count of them \
+                    (reservoir sampling, kept in input order). Seed makes the sample reproducible.",
+                   ('count', 'fraction', 'seed')),
+        'group_by': ("Group records by the given field (or comma-separated fields), and output one record per group \
+                      with the key fields and the results of the aggregations (count, sum:field, min:field, \
+                      max:field, first:field, last:field, collect:field, distinct:field, optionally prefixed with \
+                      name=). Beyond max_groups groups, partial results are spilled to local disk.",
+                     ('field', 'aggregations', 'max_groups')),
     }
     DEFAULTS = {
         'regex_flags': list,
         'separator': str,
     }
     PIPELINE = None
+    # operations that need to see the whole dataset. They are never run inside parallel workers.
+    STATEFUL_OPERATIONS = ('dedupe', 'preset', 'limit', 'skip', 'sample', 'group_by')
 
     @staticmethod
     def filter_regex(dataset, args):
+        patterns = patterns_from_args(args)
+        if patterns is not None:
+            matcher = MultiMatcher(patterns, reflags(args.regex_flags))
+            for d in dataset:
+                if args.field not in d:
+                    yield d
+                elif not args.target:
+                    if matcher.search(d[args.field]):
+                        yield d
+                else:
+                    pattern = matcher.match(d[args.field])
+                    if pattern is not None:
+                        d[args.target] = pattern
+                        yield d
+            return
         regex_re = re.compile(args.regex, flags=reflags(args.regex_flags))
         for d in dataset:
             if args.field in d:
@@ -89,6 +131,13 @@ class Transform:
 
     @staticmethod
     def filter_regex_neg(dataset, args):
+        patterns = patterns_from_args(args)
+        if patterns is not None:
+            search = MultiMatcher(patterns, reflags(args.regex_flags)).search
+            for d in dataset:
+                if args.field not in d or not search(d[args.field]):
+                    yield d
+            return
         regex_re = re.compile(args.regex, flags=reflags(args.regex_flags))
         for d in dataset:
             if args.field in d:
@@ -114,20 +163,25 @@ class Transform:
 
     @staticmethod
     def rename_field(dataset, args):
+        mapping = args.field if isinstance(args.field, dict) else {args.field: args.target}
         for d in dataset:
-            if args.field in d:
-                d[args.target] = d.pop(args.field)
+            for field, target in mapping.items():
+                if field in d:
+                    d[target] = d.pop(field)
             yield d
 
     @staticmethod
     def extract(dataset, args):
         if args.regex is not None:
             regex_re = re.compile(args.regex, flags=reflags(args.regex_flags))
+        if args.regex_per_item is not None:
+            search = per_item_search(args.regex_per_item, reflags(args.regex_flags), escape=args.escape_per_item)
         for d in dataset:
             if args.field in d:
                 if args.regex_per_item is not None:
-                    regex_re = re.compile(args.regex_per_item.format(**d), flags=reflags(args.regex_flags))
-                m = regex_re.search(d[args.field])
+                    m = search(d, d[args.field])
+                else:
+                    m = regex_re.search(d[args.field])
                 if m:
                     if m.groups():
                         d[args.target] = args.separator.join(m.groups())
@@ -153,25 +207,119 @@ class Transform:
 
     @staticmethod
     def dedupe(dataset, args):
-        seen = set()
+        fields = key_fields(args.field)
+        if len(fields) == 1 and not args.backend and not args.hash_keys:
+            field, seen = fields[0], track(set())
+            for d in dataset:
+                if field not in d:
+                    yield d
+                elif d[field] not in seen:
+                    seen.add(d[field])
+                    yield d
+            return
+        seen = make_seen(args)
         for d in dataset:
-            if args.field not in d:
+            if any(f not in d for f in fields):
                 yield d
-            elif d[args.field] not in seen:
-                seen.add(d[args.field])
+            elif seen.add(tuple(d[f] for f in fields) if len(fields) > 1 else d[fields[0]]):
                 yield d
 
     @classmethod
-    def preset(cls, dataset, args):
-        pipeline = load_object(args.pipeline) if args.pipeline else cls.PIPELINE
+    def load_pipeline(cls, args):
+        """Returns the list of Args steps that the given operation args runs.
+        """
+        if args.operation != 'preset':
+            return [args]
+        pipeline = cls._preset_steps(args)
+        if args.optimize:
+            from json_pipeline.optimizer import optimize
+
+            pipeline, _ = optimize(pipeline)
+        return pipeline
+
+    @classmethod
+    def _preset_steps(cls, args):
+        if args.pipeline_file:
+            pipeline = cls.load_pipeline_file(args.pipeline_file)
+        elif isinstance(args.pipeline, dict):
+            pipeline = args.pipeline
+        else:
+            pipeline = load_object(args.pipeline) if args.pipeline else cls.PIPELINE
         assert pipeline, 'A pipeline must be defined.'
+        return pipeline[args.target]
+
+    @classmethod
+    def load_pipeline_file(cls, path):
+        """Returns the mapping from pipeline names to lists of Args of the given spec file, validated against
+        OPERATIONS. See json_pipeline.spec.
+        """
+        from json_pipeline.spec import load_spec
+
+        spec = load_spec(path, cls.OPERATIONS)
+        # the same spec gives the same pipelines, so their compiled presets are reused
+        cached = _SPEC_PIPELINES.get((cls, id(spec)))
+        if cached is None or cached[0] is not spec:
+            if len(_SPEC_PIPELINES) >= _CACHE_SIZE:
+                _SPEC_PIPELINES.clear()
+            pipelines = {name: [cls.args_from_dict(step) for step in steps] for name, steps in spec.items()}
+            cached = _SPEC_PIPELINES[cls, id(spec)] = (spec, pipelines)
+        return cached[1]
+
+    @classmethod
+    def chain(cls, dataset, pipeline):
         result = dataset
-        for opargs in pipeline[args.target]:
+        for opargs in pipeline:
             opname = opargs.operation
             op = getattr(cls, opname)
             result = op(result, opargs)
         return result
 
+    @classmethod
+    def compile(cls, pipeline):
+        """Compiles the given pipeline into a single function that, given a dataset, returns the
+        same results as chain(). See json_pipeline.compiler.
+        """
+        def fusable(opname):
+            return getattr(cls, opname) is getattr(Transform, opname, None)
+        return compile_pipeline(cls, pipeline, fusable)
+
+    @classmethod
+    def batched(cls, pipeline, batch_size=None):
+        """Returns a function that, given a dataset, returns the same results as chain(), running the
+        pipeline over batches of batch_size records (by default, json_pipeline.batch.DEFAULT_BATCH_SIZE).
+        See json_pipeline.batch.
+        """
+        from json_pipeline.batch import batch_pipeline, DEFAULT_BATCH_SIZE
+
+        def batchable(opname):
+            return getattr(cls, opname) is getattr(Transform, opname, None)
+        return batch_pipeline(cls, pipeline, batchable, batch_size or DEFAULT_BATCH_SIZE)
+
+    @classmethod
+    def achain(cls, dataset, pipeline, concurrency=16, executor=None, queue_size=1024, batch_size=256,
+               ordered=True):
+        """Async counterpart of chain(): returns an async generator of the results of running the given
+        pipeline over dataset, a sync or async iterable. Coroutine functions given to function steps are
+        awaited, up to concurrency at once. See json_pipeline.aio.
+        """
+        from json_pipeline.aio import arun
+
+        def batchable(opname):
+            return getattr(cls, opname) is getattr(Transform, opname, None)
+        return arun(cls, dataset, pipeline, batchable, concurrency=concurrency, executor=executor,
+                    queue_size=queue_size, batch_size=batch_size, ordered=ordered)
+
+    @classmethod
+    def preset(cls, dataset, args):
+        steps = cls._preset_steps(args)
+        key = (cls, id(steps), bool(args.optimize))
+        cached = _COMPILED.get(key)
+        if cached is None or cached[0] is not steps:
+            if len(_COMPILED) >= _CACHE_SIZE:
+                _COMPILED.clear()
+            cached = _COMPILED[key] = (steps, cls.compile(cls.load_pipeline(args)))
+        return cached[1](dataset)
+
     @staticmethod
     def plaintext(dataset, args):
         for d in dataset:
@@ -188,15 +336,115 @@ class Transform:
 
     @staticmethod
     def fixedvalue(dataset, args):
+        mapping = args.field if isinstance(args.field, dict) else {args.field: args.target}
         for d in dataset:
-            d[args.field] = args.target
+            d.update(mapping)
             yield d
 
-    def run(self, dataset, args):
+    fixed_value = fixedvalue
+
+    @staticmethod
+    def lookup(dataset, args):
+        from json_pipeline.lookup import ReferenceIndex, enrich
+
+        key = args.reference_key or args.field
+        index = ReferenceIndex(args.reference, key)
+        for d in dataset:
+            if args.field in d:
+                reference = index.get(d[args.field])
+                if reference is not None:
+                    enrich(d, reference, key, args.target)
+            yield d
+
+    @staticmethod
+    def limit(dataset, args):
+        taken = track([0])
+        if taken[0] >= args.count:
+            return
+        for d in dataset:
+            taken[0] += 1
+            yield d
+            # stop before pulling the next record from upstream
+            if taken[0] >= args.count:
+                return
+
+    @staticmethod
+    def skip(dataset, args):
+        skipped = track([0])
+        dataset = iter(dataset)
+        for d in dataset:
+            if skipped[0] < args.count:
+                skipped[0] += 1
+            else:
+                yield d
+                yield from dataset
+
+    @staticmethod
+    def sample(dataset, args):
+        if (args.count is None) == (args.fraction is None):
+            raise ValueError('sample requires either count or fraction')
+        # random generator, number of records seen and (index, record) reservoir
+        state = track([random.Random(args.seed), 0, []])
+        rng = state[0]
+        if args.fraction is not None:
+            fraction, draw = args.fraction, rng.random
+            for d in dataset:
+                if draw() < fraction:
+                    yield d
+            return
+        count, reservoir = args.count, state[2]
+        for d in dataset:
+            seen = state[1]
+            if seen < count:
+                reservoir.append((seen, d))
+            else:
+                idx = rng.randrange(seen + 1)
+                if idx < count:
+                    reservoir[idx] = (seen, d)
+            state[1] = seen + 1
+        reservoir.sort(key=itemgetter(0))
+        for _, d in reservoir:
+            yield d
+
+    @staticmethod
+    def group_by(dataset, args):
+        from json_pipeline.groupby import group_by
+
+        return group_by(dataset, args)
+
+    def run(self, dataset, args, profiler=None, batch_size=None):
+        """Runs the operation described by args over dataset. If a profiler (see json_pipeline.profiling) is
+        given, each step of the pipeline runs as a separate, instrumented stage. If batch_size is given, the
+        pipeline runs over batches of records (see batched()).
+        """
+        if batch_size:
+            yield from self.batched(self.load_pipeline(args), batch_size)(dataset)
+            return
+        if profiler is not None:
+            stages = [(f'{step.operation}({getattr(step.field, "__name__", step.field)})',
+                       partial(getattr(self, step.operation), args=step)) for step in self.load_pipeline(args)]
+            yield from profiler.instrument(dataset, stages)
+            return
         operation = partial(getattr(self, args.operation), args=args)
         for d in operation(dataset):
             yield d
 
+    def arun(self, dataset, args, **kwargs):
+        """Async counterpart of run(), for sync or async iterables. Keyword arguments are the ones of
+        achain().
+        """
+        return self.achain(dataset, self.load_pipeline(args), **kwargs)
+
+    def run_parallel(self, dataset, args, workers=None, chunksize=1000, ordered=True, decode=None, encode=None):
+        """Same as run(), but split dataset in chunks of chunksize records which are processed by a pool of
+        workers processes. Stateful steps (and everything after them) run serially in the current process.
+        See json_pipeline.parallel.run_parallel() for details.
+        """
+        from json_pipeline.parallel import run_parallel
+
+        return run_parallel(type(self), dataset, self.load_pipeline(args), workers=workers, chunksize=chunksize,
+                            ordered=ordered, decode=decode, encode=encode)
+
     @classmethod
     def get_default(cls, option):
         factory = cls.DEFAULTS.get(option, lambda: None)
@@ -210,53 +458,459 @@ class Transform:
         return Args(**jsonspec)
 
 
+def _signature_value(value):
+    # functions by their path, as their repr changes between runs
+    if callable(value):
+        return f'{value.__module__}.{value.__qualname__}'
+    return repr(value)
+
+
+def _tagger(decode, field, path):
+    def decode_tagged(line):
+        d = decode(line)
+        d[field] = path
+        return d
+    return decode_tagged
+
+
 class TransformScript(Transform):
 
-    def __init__(self):
-        self.args = self.parse_args()
+    def __init__(self, argv=None):
+        self._buffer = []
+        self.checkpointer = None
+        self.args = self.parse_args(argv)
 
-    def parse_args(self):
+    def parse_args(self, argv=None):
         self.argparser = argparse.ArgumentParser()
         self.add_argparser_options()
-        args = self.argparser.parse_args()
+        argv = sys.argv[1:] if argv is None else list(argv)
+        # a first pass finds the operation, whose options are then added for the actual parsing. Help is left
+        # for the latter, so it lists the options of the operation
+        known, _ = self.argparser.parse_known_args([a for a in argv if a not in ('-h', '--help')])
+        if known.operation is not None:
+            self.add_operation_options(known.operation)
+        args = self.argparser.parse_args(argv)
+        if isinstance(getattr(args, 'regex', None), list) and len(args.regex) == 1:
+            args.regex = args.regex[0]
+        if getattr(args, 'pipeline_file', None):
+            try:
+                pipelines = self.load_pipeline_file(args.pipeline_file)
+            except (OSError, ImportError, ValueError) as e:
+                self.argparser.error(str(e))
+            if args.target not in pipelines:
+                self.argparser.error(f"'{args.pipeline_file}' has no pipeline named '{args.target}'")
+        if args.operation in ('limit', 'skip') and args.count is None:
+            self.argparser.error(f'{args.operation} requires --count')
+        if args.operation == 'sample' and (args.count is None) == (args.fraction is None):
+            self.argparser.error('sample requires either --count or --fraction')
+        if args.operation == 'group_by':
+            from json_pipeline.groupby import parse_aggregation
+
+            if not args.field:
+                self.argparser.error('group_by requires --field')
+
+            try:
+                for spec in args.aggregations or ():
+                    parse_aggregation(spec)
+            except ValueError as e:
+                self.argparser.error(str(e))
+        input_offset, output_offset = self.open_checkpoint(args)
+        if args.shard_key and not args.shards:
+            self.argparser.error('--shard-key requires --shards')
+        if args.follow:
+            self.check_follow(args)
+        try:
+            if args.follow:
+                args.input = FollowFile(args.input, poll_interval=args.poll_interval, idle_timeout=args.idle_timeout)
+            else:
+                args.input = open_input(args.input, offset=input_offset, readers=args.readers)
+        except (OSError, ImportError, EOFError, ValueError) as e:
+            self.argparser.error(f"can't open '{args.input}': {e}")
+        if self.checkpointer is not None and not isinstance(args.input, InputFile):
+            args.input.close()
+            self.argparser.error('--checkpoint is only available with a single input file')
+        try:
+            if args.shards:
+                args.output = ShardedOutput(args.output, args.shards, level=args.compress_level)
+            else:
+                args.output = open_output(args.output, level=args.compress_level, offset=output_offset)
+        except (OSError, ImportError, ValueError) as e:
+            args.input.close()
+            self.argparser.error(f"can't open '{args.output}': {e}")
         return args
 
+    def check_follow(self, args):
+        for option, value in (('--workers', args.workers != 1), ('--batch-size', args.batch_size),
+                              ('--checkpoint', args.checkpoint), ('--shards', args.shards)):
+            if value:
+                self.argparser.error(f'{option} is not available with --follow')
+        if args.input == '-' or expand_input(args.input) != [args.input]:
+            self.argparser.error('--follow requires a single input file')
+
+    # options that change the records read or their output
+    SIGNATURE_OPTIONS = ('input', 'output', 'codec', 'lazy', 'provenance_field')
+
+    def checkpoint_signature(self, args):
+        """Returns the signature of the run saved into its checkpoints, which a resumed run must match: the
+        arguments of every step it runs (nested presets expanded) and the options that change its records.
+        """
+        def expand(step):
+            if step.operation != 'preset':
+                return [step]
+            return [s for nested in self.load_pipeline(step) for s in expand(nested)]
+
+        steps = [args] + expand(args) if args.operation == 'preset' else [args]
+        return (tuple((option, getattr(args, option, None)) for option in self.SIGNATURE_OPTIONS),
+                tuple(tuple((prop, _signature_value(getattr(step, prop, None))) for prop in _args_properties)
+                      for step in steps))
+
+    def open_checkpoint(self, args):
+        """Sets up the checkpointer of the run, if --checkpoint is given. Returns the input and output offsets
+        to start from (0 and None unless resuming).
+        """
+        if args.resume and not args.checkpoint:
+            self.argparser.error('--resume requires --checkpoint')
+        if not args.checkpoint:
+            return 0, None
+        if args.workers != 1:
+            self.argparser.error('--checkpoint is not available with multiple workers')
+        if args.batch_size:
+            self.argparser.error('--checkpoint is not available with --batch-size')
+        if args.shards:
+            self.argparser.error('--checkpoint is not available with --shards')
+        if args.output == '-' or detect_compression(args.output) is not None:
+            self.argparser.error('--checkpoint requires an uncompressed --output file')
+        self.checkpointer = Checkpointer(args.checkpoint, args.checkpoint_interval,
+                                         signature=self.checkpoint_signature(args))
+        if not args.resume:
+            return 0, None
+        try:
+            saved = self.checkpointer.load()
+        except (OSError, ValueError) as e:
+            self.argparser.error(f"can't resume from '{args.checkpoint}': {e}")
+        return saved['input_offset'], saved['output_offset']
+
     def add_argparser_options(self):
-        self.argparser.add_argument('--input', type=argparse.FileType('r'), help='Target file (default is stdin)',
-                                    default=sys.stdin)
-        self.argparser.add_argument('--output', type=argparse.FileType('w'), help='Target file (default is stdout)',
-                                    default=sys.stdout)
+        self.argparser.add_argument('--input', default='-',
+                                    help='Target file (default is stdin), directory or glob pattern. gzip, bzip2, xz \
+                                    and zstd compressed files are detected and decompressed')
+        self.argparser.add_argument('--output', default='-',
+                                    help='Target file (default is stdout). Compressed if it has a .gz, .bz2, .xz or \
+                                    .zst extension. With --shards, a path template with {shard}')
+        self.argparser.add_argument('--readers', type=int, default=4,
+                                    help='Number of input files read ahead at once by threads, for directory or glob \
+                                    input (default: %(default)s)')
+        self.argparser.add_argument('--provenance-field', metavar='FIELD',
+                                    help='Add the path of the input file of each record into this field')
+        self.argparser.add_argument('--shards', type=int,
+                                    help='Split the output into this number of files, round-robin unless --shard-key \
+                                    is given')
+        self.argparser.add_argument('--shard-key', metavar='FIELD',
+                                    help='Assign records to output shards by hashing this field')
+        self.argparser.add_argument('--compress-level', type=int,
+                                    help='Compression level of the output file (default depends on the compression)')
+        self.argparser.add_argument('--buffer-size', type=int, default=1000,
+                                    help='Number of output records buffered before each write (default: %(default)s)')
+        self.argparser.add_argument('--codec', choices=['auto'] + list(CODEC_BACKENDS), default='json',
+                                    help='JSON library used to decode and encode records. auto picks the fastest \
+                                    installed one (default: %(default)s)')
+        self.argparser.add_argument('--lazy', action='store_true',
+                                    help='Decode records only up to the fields used by the operations, and write \
+                                    unmodified records as the original lines')
+        self.argparser.add_argument('--batch-size', type=int,
+                                    help='Run the pipeline over batches of this number of records at once')
+        self.argparser.add_argument('--workers', type=int, default=1,
+                                    help='Number of worker processes. 0 means one per CPU core (default: %(default)s)')
+        self.argparser.add_argument('--chunk-size', type=int, default=1000,
+                                    help='Number of input lines sent to each worker at once (default: %(default)s)')
+        self.argparser.add_argument('--profile', choices=['table', 'json'],
+                                    help='Print per-stage statistics into stderr, as a table or as a JSON report')
+        self.argparser.add_argument('--profile-sample', type=int, default=1,
+                                    help='Time only one of every N records when profiling (default: %(default)s)')
+        self.argparser.add_argument('--progress', type=float, metavar='SECONDS',
+                                    help='Print the number of processed records and the rate into stderr every \
+                                    given seconds')
+        self.argparser.add_argument('--explain', action='store_true',
+                                    help='Print the pipeline plan, before and after optimization, and exit')
+        self.argparser.add_argument('--unordered', action='store_true',
+                                    help='With multiple workers, don\'t preserve input order in the output')
+        self.argparser.add_argument('--follow', action='store_true',
+                                    help='Keep reading the input file as it grows, following its rotations, until \
+                                    interrupted or --idle-timeout')
+        self.argparser.add_argument('--poll-interval', type=float, default=0.1, metavar='SECONDS',
+                                    help='With --follow, maximum delay between checks for new input \
+                                    (default: %(default)s)')
+        self.argparser.add_argument('--flush-interval', type=float, default=0.1, metavar='SECONDS',
+                                    help='With --follow, maximum time a processed record waits before the output is \
+                                    flushed. Higher values mean fewer, bigger writes (default: %(default)s)')
+        self.argparser.add_argument('--idle-timeout', type=float, metavar='SECONDS',
+                                    help='With --follow, stop after this number of seconds without new input')
+        self.argparser.add_argument('--checkpoint', metavar='PATH',
+                                    help='Periodically save the progress of the run into this file')
+        self.argparser.add_argument('--checkpoint-interval', type=float, default=60, metavar='SECONDS',
+                                    help='Seconds between checkpoints (default: %(default)s)')
+        self.argparser.add_argument('--resume', action='store_true',
+                                    help='Continue the run saved in --checkpoint, appending to --output')
 
         subparsers = self.argparser.add_subparsers(dest='operation')
-        subparsers_maps = {}
-        for op, (helpstr, args) in self.OPERATIONS.items():
-            subparsers_maps[op] = subparsers.add_parser(op, help=helpstr)
-            if 'field' in args:
-                subparsers_maps[op].add_argument('--field', help='target field')
-            if 'regex' in args:
-                subparsers_maps[op].add_argument('--regex', help='Regex pattern')
-            if 'regex_flags' in args:
-                subparsers_maps[op].add_argument('--regex-flags', action='append',
-                                                 default=Transform.get_default('regex_flags'))
-            if 'target' in args:
-                subparsers_maps[op].add_argument('--target', help='Operation target (depends on operation)')
-            if 'separator' in args:
-                subparsers_maps[op].add_argument('--separator', help='Defines separator in join operations',
-                                                 default=Transform.get_default('separator'))
-            if 'regex_per_item' in args:
-                subparsers_maps[op].add_argument('--regex-per-item', help='Regex pattern applied per item')
-            if 'pipeline' in args:
-                subparsers_maps[op].add_argument('--pipeline', help='For preset operation, give pipeline \
-                                                 absolute python path object. It must be a dict')
+        # the options of each operation are only added when it is requested (see add_operation_options())
+        self.subparsers = {op: subparsers.add_parser(op, help=helpstr)
+                           for op, (helpstr, _) in self.OPERATIONS.items()}
+
+    def add_operation_options(self, op):
+        parser = self.subparsers[op]
+        args = self.OPERATIONS[op][1]
+        if 'field' in args:
+            parser.add_argument('--field', help='target field')
+        if 'regex' in args and 'patterns_file' in args:
+            parser.add_argument('--regex', action='append',
+                                help='Regex pattern. Can be given several times')
+        elif 'regex' in args:
+            parser.add_argument('--regex', help='Regex pattern')
+        if 'patterns_file' in args:
+            parser.add_argument('--patterns-file',
+                                help='File with more regex patterns or keywords, one per line')
+        if 'regex_flags' in args:
+            parser.add_argument('--regex-flags', action='append',
+                                default=Transform.get_default('regex_flags'))
+        if 'target' in args:
+            parser.add_argument('--target', help='Operation target (depends on operation)')
+        if 'separator' in args:
+            parser.add_argument('--separator', help='Defines separator in join operations',
+                                default=Transform.get_default('separator'))
+        if 'regex_per_item' in args:
+            parser.add_argument('--regex-per-item', help='Regex pattern applied per item')
+        if 'escape_per_item' in args:
+            parser.add_argument('--escape-per-item', action='store_true',
+                                help='Match values interpolated in --regex-per-item literally')
+        if 'pipeline' in args:
+            parser.add_argument('--pipeline', help='For preset operation, give pipeline \
+                                absolute python path object. It must be a dict')
+        if 'pipeline_file' in args:
+            parser.add_argument('--pipeline-file', help='JSON or YAML file with a mapping from \
+                                pipeline names to lists of steps')
+        if 'backend' in args:
+            parser.add_argument('--backend', choices=list(DEDUPE_BACKENDS),
+                                help='Dedupe seen-keys store (default: memory)')
+        if 'capacity' in args:
+            parser.add_argument('--capacity', type=int,
+                                help='Expected number of distinct keys, for the bloom backend')
+        if 'error_rate' in args:
+            parser.add_argument('--error-rate', type=float,
+                                help='Accepted false positive rate, for the bloom backend')
+        if 'hash_keys' in args:
+            parser.add_argument('--hash-keys', action='store_true',
+                                help='Keep fixed-width digests of the keys instead of the keys')
+        if 'reference' in args:
+            parser.add_argument('--reference', help='Reference jsonlines or CSV file')
+        if 'reference_key' in args:
+            parser.add_argument('--reference-key',
+                                help='Key field of the reference records (default: same as field)')
+        if 'count' in args:
+            parser.add_argument('--count', type=int, help='Number of records')
+        if 'fraction' in args:
+            parser.add_argument('--fraction', type=float, help='Probability of keeping each record')
+        if 'seed' in args:
+            parser.add_argument('--seed', type=int, help='Random seed')
+        if 'aggregations' in args:
+            parser.add_argument('--aggregate', dest='aggregations', action='append', metavar='[NAME=]FUNCTION[:FIELD]',
+                                help='Aggregation of each group. Can be given several times (default: count)')
+        if 'max_groups' in args:
+            parser.add_argument('--max-groups', type=int,
+                                help='Number of groups kept in memory before spilling them to disk (default: 1000000)')
+        if 'optimize' in args:
+            parser.add_argument('--optimize', action='store_true',
+                                help='Reorder and merge pipeline steps before running it')
 
     def main(self):
         if self.args.operation is None:
             self.argparser.error('Please provide an operation')
-        dataset = [json.loads(l) for l in self.args.input]
-        for d in Transform().run(dataset, self.args):
-            print(json.dumps(d), file=self.args.output)
+        if self.args.explain:
+            if self.args.operation != 'preset':
+                self.argparser.error('--explain is only available for the preset operation')
+            from json_pipeline.optimizer import explain
+
+            self.args.optimize = False
+            print(explain(self.load_pipeline(self.args)), file=sys.stderr)
+            return
+        codec = get_codec(self.args.codec)
+        decode = codec.lazy_decode if self.args.lazy else codec.decode
+        if self.args.workers != 1:
+            if self.args.profile:
+                self.argparser.error('--profile is not available with multiple workers')
+            if self.args.batch_size:
+                self.argparser.error('--batch-size is not available with multiple workers')
+            if self.args.provenance_field:
+                self.argparser.error('--provenance-field is not available with multiple workers')
+            if self.args.shard_key:
+                self.argparser.error('--shard-key is not available with multiple workers')
+            sample, args = self.presample()
+            lines = self.args.input if sample is None else self.sample(self.args.input, sample)
+            lines = self.run_parallel(lines, args, workers=self.args.workers or None,
+                                      chunksize=self.args.chunk_size, ordered=not self.args.unordered,
+                                      decode=decode, encode=codec.encode)
+            if self.args.progress:
+                lines = progress(lines, self.args.progress)
+            self.write(lines, encode=None)
+        else:
+            if self.args.profile and self.args.batch_size:
+                self.argparser.error('--profile is not available with --batch-size')
+            profiler = Profiler(self.args.profile_sample) if self.args.profile else None
+            # checkpoints cover the whole pipeline, sample included
+            presample = self.checkpointer is None and not self.args.follow
+            sample, args = self.presample() if presample else (None, self.args)
+            if self.checkpointer is not None:
+                dataset = self.checkpointed(decode)
+                self.checkpointer.activate()
+            elif self.args.follow:
+                dataset = self.followed(decode)
+            else:
+                dataset = self.records(decode, sample)
+            try:
+                result = self.run(dataset, args, profiler=profiler, batch_size=self.args.batch_size)
+                if self.args.progress:
+                    result = progress(result, self.args.progress)
+                self.write(result, encode=codec.encode)
+            except KeyboardInterrupt:
+                if not self.args.follow:
+                    raise
+                # interrupting is the usual way to stop following. Buffered lines are complete records
+                self.flush_buffer()
+                self.args.output.flush()
+            finally:
+                if self.checkpointer is not None:
+                    self.checkpointer.deactivate()
+            if profiler is not None:
+                profiler.emit(self.args.profile)
+            if self.checkpointer is not None:
+                self.checkpointer.report()
+
+    def records(self, decode, sample=None):
+        """Returns an iterator over the decoded input records, with the path of their input file in
+        args.provenance_field if given. If a sample step is given, only the lines it samples are decoded.
+        """
+        field = self.args.provenance_field
+        if not field:
+            lines = self.args.input if sample is None else self.sample(self.args.input, sample)
+            return (decode(l) for l in lines)
+        if sample is None:
+            return (d for path, lines in self.args.input.file_blocks()
+                    for d in map(_tagger(decode, field, path), lines))
+        lines = self.sample(((path, l) for path, lines in self.args.input.file_blocks() for l in lines), sample)
+        return (_tagger(decode, field, path)(l) for path, l in lines)
+
+    def presample(self):
+        """If the pipeline starts by sampling a fraction of the records, returns that step and the args that run
+        the rest of the pipeline, so the input lines can be sampled before they are decoded. Otherwise, returns
+        None and args.
+        """
+        if type(self).sample is not Transform.sample:
+            return None, self.args
+        steps = self.load_pipeline(self.args)
+        if not steps or steps[0].operation != 'sample' or steps[0].fraction is None or steps[0].count is not None:
+            return None, self.args
+        rest = self.args_from_dict({'operation': 'preset', 'target': 'rest', 'pipeline': {'rest': steps[1:]}})
+        return steps[0], rest
+
+    def checkpointed(self, decode):
+        """Yields the decoded input records, saving a checkpoint between input blocks when it is due, and a
+        last one when the input is exhausted. When the next block is read, the records before it went through
+        the whole pipeline already, so the checkpoint covers them and their results.
+        """
+        checkpointer = self.checkpointer
+        offset = self.args.input.offset
+        if self.args.provenance_field:
+            decode = _tagger(decode, self.args.provenance_field, self.args.input.path)
+        for lines, offset in self.args.input.blocks():
+            for l in lines:
+                yield decode(l)
+            if checkpointer.due():
+                self.save_checkpoint(offset)
+        # the results of the last record are written once it is pulled past the end of the input
+        self.save_checkpoint(offset, complete=True)
+
+    def followed(self, decode):
+        """Yields the decoded records of the followed input file, flushing the output once the records read
+        more than args.flush_interval seconds ago went through the pipeline. As in checkpointed(), the records
+        of a block are all written (into the buffer) when the next block is read.
+        """
+        if self.args.provenance_field:
+            decode = _tagger(decode, self.args.provenance_field, self.args.input.path)
+        interval = self.args.flush_interval
+        read_at = None
+        for lines, _ in self.args.input.blocks():
+            if lines and read_at is None:
+                read_at = time.monotonic()
+            for l in lines:
+                yield decode(l)
+            if read_at is not None and time.monotonic() - read_at >= interval:
+                self.flush_buffer()
+                self.args.output.flush()
+                read_at = None
+
+    def save_checkpoint(self, input_offset, complete=False):
+        output = self.args.output
+        self.flush_buffer()
+        output.flush()
+        os.fsync(output.fileno())
+        self.checkpointer.save(input_offset, output.tell(), complete=complete)
+
+    def write(self, dataset, encode=json.dumps):
+        """Streams the given records into the output file as jsonlines, writing them in
+        blocks of args.buffer_size lines. If encode is None, records must be already encoded.
+        """
+        if self.args.shards:
+            return self.write_shards(dataset, encode)
+        buffer_size = max(self.args.buffer_size, 1)
+        buffer = self._buffer
+        for d in dataset:
+            buffer.append(encode(d) if encode is not None else d)
+            if len(buffer) >= buffer_size:
+                self.flush_buffer()
+        self.flush_buffer()
+        self.args.output.flush()
+
+    def write_shards(self, dataset, encode=json.dumps):
+        """Same as write(), distributing the records across the output shards by hashing args.shard_key, or
+        round-robin.
+        """
+        files = self.args.output.files
+        buffer_size = max(self.args.buffer_size, 1)
+        buffers = [[] for _ in files]
+        key, shards = self.args.shard_key, len(files)
+        for i, d in enumerate(dataset):
+            shard = shard_of(d.get(key), shards) if key else i % shards
+            buffer = buffers[shard]
+            buffer.append(encode(d) if encode is not None else d)
+            if len(buffer) >= buffer_size:
+                buffer.append('')
+                files[shard].write('\n'.join(buffer))
+                buffer.clear()
+        for f, buffer in zip(files, buffers):
+            if buffer:
+                buffer.append('')
+                f.write('\n'.join(buffer))
+        self.args.output.flush()
+
+    def flush_buffer(self):
+        """Writes the buffered lines into the output file.
+        """
+        if self._buffer:
+            self._buffer.append('')
+            self.args.output.write('\n'.join(self._buffer))
+            self._buffer.clear()
+
+    def close(self):
+        """Closes the input and output files. Compressed output files are incomplete until closed.
+        """
+        self.args.input.close()
+        if self.args.output is not sys.stdout:
+            self.args.output.close()
 
 
 if __name__ == '__main__':
     transform = TransformScript()
-    transform.main()
+    try:
+        transform.main()
+    finally:
+        transform.close()
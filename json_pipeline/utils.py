@@ -1,4 +1,8 @@
+import re
+import threading
+from string import Formatter
 from importlib import import_module
+from collections import OrderedDict
 from copy import deepcopy
 
 
@@ -24,6 +28,118 @@ def load_object(path):
     return obj
 
 
+def reflags(lst):
+    lst = lst or []
+    result = 0
+    for op in [getattr(re, f) for f in lst]:
+        result = result | op
+    return result
+
+
+_UNDERSCORE_RE = re.compile(r'[\s-]+')
+_REMOVE_RE = re.compile(r'[^\w\d\s-]+')
+
+
+def plain(txt):
+    txt = txt.lower()
+    txt = _UNDERSCORE_RE.sub('_', txt)
+    txt = _REMOVE_RE.sub('', txt)
+    return txt
+
+
+class RegexCache:
+    """Bounded LRU cache of compiled regexes, keyed by pattern and flags. Thread safe, as steps may run in
+    executor threads (see json_pipeline.aio).
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def compile(self, pattern, flags=0):
+        key = (pattern, flags)
+        with self.lock:
+            regex = self.cache.get(key)
+            if regex is not None:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return regex
+            self.misses += 1
+        # compiled outside the lock, so other threads don't wait for it
+        regex = re.compile(pattern, flags=flags)
+        with self.lock:
+            self.cache[key] = regex
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+        return regex
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.cache), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+REGEX_CACHE = RegexCache()
+
+
+class _EscapeFormatter(Formatter):
+
+    def format_field(self, value, format_spec):
+        return re.escape(super().format_field(value, format_spec))
+
+
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+
+
+class LiteralMatch:
+    """Match-like result of a plain substring search.
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+    def group(self):
+        return self.text
+
+    def groups(self):
+        return ()
+
+
+def per_item_search(template, flags=0, escape=False, cache=REGEX_CACHE):
+    """Returns a function search(d, text) that searches text for the regex resulting of formatting the
+    given template with the record d. Compiled regexes are kept in the given cache.
+
+    If escape is True, the values interpolated from the record are matched literally. Then, if the template
+    itself has no regex special characters and no flags are given, the search is done as a plain substring
+    search, without any regex involved.
+    """
+    if escape:
+        literal = all(not _REGEX_SPECIAL.intersection(text) for text, _, _, _ in Formatter().parse(template))
+        if literal and not flags:
+            def search(d, text):
+                needle = template.format(**d)
+                return LiteralMatch(needle) if needle in text else None
+            return search
+        formatter = _EscapeFormatter()
+
+        def search(d, text):
+            return cache.compile(formatter.format(template, **d), flags).search(text)
+        return search
+
+    def search(d, text):
+        return cache.compile(template.format(**d), flags).search(text)
+    return search
+
+
 def dict_to_text(d, args):
     """Converts a dictionary to a string representation, replacing args.target with result.
     Use args.separator as separator between key/val pairs.
@@ -0,0 +1,142 @@
+import asyncio
+from copy import deepcopy
+from unittest import TestCase
+
+from json_pipeline.transform import Transform
+
+
+async def fetch_size(d, args):
+    # slower for the first records, so they finish last
+    await asyncio.sleep(0.002 * (5 - int(d['id']) % 5))
+    d['size'] = len(d['name'])
+    return d
+
+
+async def failing(d, args):
+    if d['id'] == '7':
+        raise ValueError('failed')
+    return d
+
+
+async def failing_later(d, args):
+    # finishes together with the next records, so they are queued after the failure
+    await asyncio.sleep(0.01)
+    return await failing(d, args)
+
+
+class AsyncTransform(Transform):
+    PIPELINE = {
+        'offices': [
+            Transform.args_from_dict({'operation': 'filter_regex', 'field': 'name', 'regex': 'Office'}),
+            Transform.args_from_dict({'operation': 'dedupe', 'field': 'key'}),
+            Transform.args_from_dict({'operation': 'function', 'field': fetch_size}),
+            Transform.args_from_dict({'operation': 'plaintext', 'field': 'name'}),
+        ],
+        'nested': [
+            Transform.args_from_dict({'operation': 'preset', 'target': 'offices'}),
+            Transform.args_from_dict({'operation': 'fixed_value', 'field': 'chain', 'target': 'USPS'}),
+        ],
+    }
+
+
+async def produce(dataset):
+    for d in dataset:
+        await asyncio.sleep(0)
+        yield d
+
+
+async def collect(aiterable):
+    return [d async for d in aiterable]
+
+
+class AsyncTest(TestCase):
+
+    dataset = [{'id': str(i), 'key': str(i % 40), 'name': f'Office {i}' if i % 3 else f'Shop {i}'} for i in range(100)]
+
+    def _expected(self, target):
+        def fetch(dataset, args):
+            for d in dataset:
+                d['size'] = len(d['name'])
+                yield d
+        pipeline = AsyncTransform.PIPELINE['offices']
+        result = Transform.chain(deepcopy(self.dataset), pipeline[:2])
+        result = fetch(result, None)
+        result = Transform.chain(result, pipeline[3:])
+        if target == 'nested':
+            result = Transform.chain(result, AsyncTransform.PIPELINE['nested'][1:])
+        return list(result)
+
+    def test_arun(self):
+        """Async runs give the same results as sync ones, from sync or async iterables, in order.
+        """
+        for target in ('offices', 'nested'):
+            args = Transform.args_from_dict({'operation': 'preset', 'target': target})
+            expected = self._expected(target)
+            for source in (list, produce):
+                for kwargs in ({}, {'executor': False, 'batch_size': 3, 'queue_size': 2, 'concurrency': 1}):
+                    dataset = source(deepcopy(self.dataset))
+                    result = asyncio.run(collect(AsyncTransform().arun(dataset, args, **kwargs)))
+                    self.assertEqual(result, expected)
+
+    def test_unordered(self):
+        args = Transform.args_from_dict({'operation': 'preset', 'target': 'offices'})
+        result = asyncio.run(collect(AsyncTransform().arun(deepcopy(self.dataset), args, ordered=False)))
+        self.assertNotEqual(result, self._expected('offices'))
+        self.assertEqual(sorted(result, key=lambda d: int(d['id'])), self._expected('offices'))
+
+    def test_errors(self):
+        args = Transform.args_from_dict({'operation': 'function', 'field': failing})
+        for ordered in (True, False):
+            with self.assertRaisesRegex(ValueError, 'failed'):
+                asyncio.run(collect(Transform().arun(deepcopy(self.dataset), args, ordered=ordered)))
+
+        # unordered failures end the stream, so the steps after them never get one as a record
+        pipeline = [Transform.args_from_dict({'operation': 'function', 'field': failing_later}),
+                    Transform.args_from_dict({'operation': 'remove_fields', 'field': 'name'})]
+        for executor in (None, False):
+            with self.assertRaisesRegex(ValueError, 'failed'):
+                asyncio.run(collect(Transform.achain(deepcopy(self.dataset), pipeline, ordered=False,
+                                                     executor=executor)))
+
+        async def first():
+            async for d in Transform().arun(produce(deepcopy(self.dataset)), args):
+                return d
+        self.assertEqual(asyncio.run(first()), self.dataset[0])
+
+    def test_sqlite_dedupe(self):
+        """Stores that are built in the loop thread work from the executor threads.
+        """
+        args = Transform.args_from_dict({'operation': 'dedupe', 'field': 'key', 'backend': 'sqlite'})
+        expected = list(Transform().run(deepcopy(self.dataset), args))
+        self.assertEqual(len(expected), 40)
+        result = asyncio.run(collect(Transform().arun(deepcopy(self.dataset), args, batch_size=7)))
+        self.assertEqual(result, expected)
+
+    def test_stateful_steps(self):
+        """Steps that keep state over the whole stream run sequentially, with the same results as sync runs. A
+        limit stops reading the input.
+        """
+        pipeline = [
+            Transform.args_from_dict({'operation': 'skip', 'count': 3}),
+            Transform.args_from_dict({'operation': 'sample', 'fraction': 0.5, 'seed': 1}),
+            Transform.args_from_dict({'operation': 'function', 'field': fetch_size}),
+            Transform.args_from_dict({'operation': 'plaintext', 'field': 'name'}),
+            Transform.args_from_dict({'operation': 'limit', 'count': 5}),
+        ]
+        args = Transform.args_from_dict({'operation': 'preset', 'target': 'p', 'pipeline': {'p': pipeline}})
+        expected = list(Transform.chain(deepcopy(self.dataset), pipeline[:2]))[:5]
+        for d in expected:
+            d['size'] = len(d['name'])
+            d['name'] = d['name'].lower().replace(' ', '_')
+        pulled = []
+
+        async def source():
+            for d in deepcopy(self.dataset):
+                pulled.append(d)
+                yield d
+        for kwargs in ({}, {'executor': False, 'batch_size': 2, 'queue_size': 2, 'concurrency': 1}):
+            pulled.clear()
+            result = asyncio.run(collect(Transform().arun(source(), args, **kwargs)))
+            self.assertEqual(result, expected)
+            if kwargs:
+                self.assertLess(len(pulled), 30)
@@ -0,0 +1,102 @@
+import random
+from copy import deepcopy
+from unittest import TestCase
+
+from json_pipeline.transform import Transform
+from json_pipeline.utils import plain
+from json_pipeline.batch import plain_column
+from json_pipeline.compiler import COMPILERS
+
+
+def shout(d, args):
+    d['name'] = d['name'].upper()
+    return d
+
+
+STEPS = {
+    'filter_regex': {'field': 'name', 'regex': r'^office', 'regex_flags': ['I']},
+    'filter_regex_neg': {'field': 'city', 'regex': 'Paris'},
+    'cross_filter': {'field': 'name', 'target': 'suffix'},
+    'filter_not_exists': {'field': 'city'},
+    'rename_field': {'field': 'city', 'target': 'town'},
+    'extract': {'field': 'name', 'regex': r'(\d)(\d)', 'target': 'digits', 'separator': '-'},
+    'template': {'field': '{name}/{id}', 'target': 'key'},
+    'remove_fields': {'field': 'suffix,missing'},
+    'dedupe': {'field': 'id'},
+    'plaintext': {'field': 'name'},
+    'function': {'field': shout},
+    'fixed_value': {'field': {'chain': 'USPS', 'id': 'X'}},
+}
+
+
+class BatchedTransform(Transform):
+
+    @staticmethod
+    def plaintext(dataset, args):
+        for d in dataset:
+            d[args.field] = 'overriden'
+            yield d
+
+
+class BatchTest(TestCase):
+
+    def setUp(self):
+        rnd = random.Random(1)
+        self.dataset = []
+        for i in range(500):
+            d = {'id': str(rnd.randrange(100)), 'name': rnd.choice(['Office', 'Shop', 'Σίσσυ ΟΣ']) + f' {i}',
+                 'suffix': str(i % 10)}
+            if i % 7:
+                d['city'] = rnd.choice(['Paris', 'London'])
+            self.dataset.append(d)
+
+    def test_operations(self):
+        """Every operation gives the same results in batches, of any size, as one record at a time.
+        """
+        self.assertEqual(set(COMPILERS) - {'fixedvalue'}, set(STEPS))
+        for opname, spec in STEPS.items():
+            args = Transform.args_from_dict(dict(spec, operation=opname))
+            expected = list(Transform.chain(deepcopy(self.dataset), [args]))
+            for batch_size in (1, 7, 1024):
+                result = list(Transform().run(deepcopy(self.dataset), args, batch_size=batch_size))
+                self.assertEqual(result, expected, f'{opname} with batch size {batch_size}')
+
+    def test_pipeline(self):
+        pipeline = [Transform.args_from_dict(dict(spec, operation=opname)) for opname, spec in STEPS.items()
+                    if opname != 'filter_not_exists']
+        expected = list(Transform.chain(deepcopy(self.dataset), pipeline))
+        self.assertTrue(expected)
+        self.assertEqual(list(Transform.batched(pipeline, 64)(deepcopy(self.dataset))), expected)
+        self.assertEqual(list(BatchedTransform.batched(pipeline, 64)(deepcopy(self.dataset))),
+                         list(BatchedTransform.chain(deepcopy(self.dataset), pipeline)))
+        self.assertEqual(len(BatchedTransform.batched(pipeline, 64).stages), 3)
+
+    def test_fused_segments(self):
+        """Steps without column kernels run as the compiled pipeline, without reading a batch ahead, and
+        between column kernels as a loop over the batch.
+        """
+        pulled = []
+
+        def records():
+            for d in deepcopy(self.dataset):
+                pulled.append(d)
+                yield d
+        pipeline = [Transform.args_from_dict(dict(STEPS[opname], operation=opname))
+                    for opname in ('filter_regex', 'rename_field', 'fixed_value', 'remove_fields')]
+        run = Transform.batched(pipeline, 64)
+        self.assertEqual(len(run.stages), 1)
+        self.assertEqual(next(iter(run(records()))), next(Transform.chain(deepcopy(self.dataset), pipeline)))
+        self.assertLess(len(pulled), 10)
+        pipeline.insert(2, Transform.args_from_dict(dict(STEPS['plaintext'], operation='plaintext')))
+        self.assertEqual(list(Transform.batched(pipeline, 64)(deepcopy(self.dataset))),
+                         list(Transform.chain(deepcopy(self.dataset), pipeline)))
+
+    def test_plain_column(self):
+        for values in ([], ['ΟΣ', 'Σ Σ', 'a-\x00-b', 'x'], ['A b', 'c--D!'], ['A', 1]):
+            try:
+                expected = [plain(v) for v in values]
+            except AttributeError:
+                with self.assertRaises(AttributeError):
+                    plain_column(values)
+                continue
+            self.assertEqual(plain_column(values), expected)
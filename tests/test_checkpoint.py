@@ -0,0 +1,129 @@
+import os
+import json
+import pickle
+import tempfile
+from unittest import TestCase, mock
+
+from json_pipeline.transform import Transform, TransformScript
+from json_pipeline.checkpoint import Checkpointer, track
+
+
+class Interrupted(Exception):
+    pass
+
+
+def crash_once(d, args):
+    if CheckpointScript.crash_at == d['id']:
+        CheckpointScript.crash_at = None
+        raise Interrupted()
+    return d
+
+
+class CheckpointScript(TransformScript):
+    crash_at = None
+    PIPELINE = {
+        name: [
+            Transform.args_from_dict({'operation': 'dedupe', 'field': 'key', **backend}),
+            Transform.args_from_dict({'operation': 'dedupe', 'field': 'key,id'}),
+            Transform.args_from_dict({'operation': 'function', 'field': crash_once}),
+            Transform.args_from_dict({'operation': 'plaintext', 'field': 'name'}),
+        ] for name, backend in (('memory', {}), ('sqlite', {'backend': 'sqlite'}),
+                                ('bloom', {'backend': 'bloom', 'capacity': 10000}))
+    }
+
+
+class CheckpointTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.inpath = os.path.join(self.tmpdir.name, 'in.jl')
+        with open(self.inpath, 'w') as f:
+            for i in range(6000):
+                f.write(json.dumps({'id': str(i), 'key': str(i * 7 % 4000), 'name': f'Office {i}'}) + '\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _run(self, outpath, *options, target='memory'):
+        script = CheckpointScript(['--input', self.inpath, '--output', outpath, '--buffer-size', '100', *options,
+                                   'preset', '--target', target])
+        try:
+            script.main()
+        finally:
+            script.close()
+        return script
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_resume(self):
+        """A run resumed from its last checkpoint writes the same output as an uninterrupted one.
+        """
+        for target in CheckpointScript.PIPELINE:
+            expected = os.path.join(self.tmpdir.name, f'{target}-expected.jl')
+            self._run(expected, target=target)
+            outpath = os.path.join(self.tmpdir.name, f'{target}.jl')
+            checkpoint = os.path.join(self.tmpdir.name, f'{target}.checkpoint')
+            options = ('--checkpoint', checkpoint, '--checkpoint-interval', '0')
+            CheckpointScript.crash_at = '3500'
+            with self.assertRaises(Interrupted):
+                self._run(outpath, *options, target=target)
+            with open(checkpoint, 'rb') as f:
+                saved = pickle.load(f)
+            self.assertFalse(saved['complete'])
+            self.assertGreater(saved['input_offset'], 0)
+            # results after the checkpoint were written too, and are discarded when resuming
+            self.assertGreater(os.path.getsize(outpath), saved['output_offset'])
+            script = self._run(outpath, *options, '--resume', target=target)
+            self.assertEqual(self._read(outpath), self._read(expected))
+            self.assertEqual(len(script.checkpointer.stores), 2)
+            self.assertGreater(script.checkpointer.stats()['checkpoints'], 0)
+            with open(checkpoint, 'rb') as f:
+                self.assertTrue(pickle.load(f)['complete'])
+            # resuming a complete run writes nothing more
+            self._run(outpath, *options, '--resume', target=target)
+            self.assertEqual(self._read(outpath), self._read(expected))
+
+    def test_checkpointer(self):
+        path = os.path.join(self.tmpdir.name, 'run.checkpoint')
+        checkpointer = Checkpointer(path, signature=('a',))
+        checkpointer.activate()
+        try:
+            seen = track({1, 2})
+        finally:
+            checkpointer.deactivate()
+        self.assertEqual(track(set()), set())
+        self.assertEqual(checkpointer.stores, [seen])
+        checkpointer.save(10, 20)
+        resumed = Checkpointer(path, signature=('a',))
+        self.assertEqual(resumed.load()['input_offset'], 10)
+        resumed.register(set())
+        self.assertEqual(resumed.stores, [{1, 2}])
+        with self.assertRaisesRegex(ValueError, 'more stateful steps'):
+            resumed.register(set())
+        with self.assertRaisesRegex(ValueError, 'different operation arguments'):
+            Checkpointer(path, signature=('b',)).load()
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+    def test_signature(self):
+        """Runs are not resumed with different steps (nested in presets too) or options.
+        """
+        outpath = os.path.join(self.tmpdir.name, 'out.jl')
+        options = ('--checkpoint', os.path.join(self.tmpdir.name, 'out.checkpoint'))
+        self._run(outpath, *options)
+        steps = CheckpointScript.PIPELINE['memory']
+        changed = [steps[0]._replace(field='name')] + steps[1:]
+        with mock.patch.dict(CheckpointScript.PIPELINE, memory=changed):
+            with self.assertRaises(SystemExit):
+                self._run(outpath, *options, '--resume')
+        with self.assertRaises(SystemExit):
+            self._run(outpath, *options, '--provenance-field', 'path', '--resume')
+        self._run(outpath, *options, '--resume')
+
+    def test_options(self):
+        outpath = os.path.join(self.tmpdir.name, 'out.jl')
+        for options in (['--resume'], ['--checkpoint', 'x', '--workers', '2'], ['--checkpoint', 'x', '--output', '-'],
+                        ['--checkpoint', 'x', '--batch-size', '10'], ['--checkpoint', 'missing', '--resume']):
+            with self.assertRaises(SystemExit):
+                CheckpointScript(['--input', self.inpath, '--output', outpath, *options, 'dedupe', '--field', 'id'])
@@ -0,0 +1,86 @@
+import json
+from copy import deepcopy
+from unittest import TestCase, skipUnless
+
+from json_pipeline.transform import Transform
+from json_pipeline.codec import get_codec, LazyRecord, Codec
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+LINES = [
+    '{"name": "Office A", "id": "A", "hours": {"Mon": "9-18"}, "tags": ["a", "b"]}',
+    '{ "name" : "Shop B" ,"id":"B\\u00e9", "hours": {}, "n": 1.5e3, "ok": true, "none": null}',
+    '{}',
+]
+
+
+class CodecTest(TestCase):
+
+    def test_lazy_record(self):
+        """Lazy records give the same data as json.loads(), decoding only up to the requested field.
+        """
+        for line in LINES:
+            record = LazyRecord(line)
+            self.assertEqual(dict(record), json.loads(line))
+            self.assertEqual(record, json.loads(line))
+        record = LazyRecord(LINES[0] + '\n')
+        self.assertEqual(record['name'], 'Office A')
+        self.assertEqual(record.data, {'name': 'Office A'})
+        self.assertNotIn('missing', record)
+        self.assertEqual(record.data, {'name': 'Office A'})
+        self.assertEqual(len(record), 4)
+        self.assertIsNone(record.pos)
+
+    def test_lazy_record_errors(self):
+        for line in ('{"a": 1 "b": 2}', '{"a": }', '{"a": 1,}', '{a: 1}'):
+            with self.assertRaises(json.JSONDecodeError):
+                dict(LazyRecord(line))
+
+    def test_encode_unmodified(self):
+        """Unmodified lazy records are encoded as their original line.
+        """
+        codec = get_codec('json')
+        record = codec.lazy_decode(LINES[1] + '\n')
+        self.assertEqual(record['id'], 'Bé')
+        self.assertEqual(codec.encode(record), LINES[1])
+        record['id'] = 'C'
+        self.assertEqual(json.loads(codec.encode(record)), dict(json.loads(LINES[1]), id='C'))
+        record = codec.lazy_decode(LINES[0])
+        record['hours']['Tue'] = '9-18'
+        self.assertEqual(json.loads(codec.encode(record))['hours'], {'Mon': '9-18', 'Tue': '9-18'})
+
+    def test_lazy_pipeline(self):
+        """Pipelines over lazy records give the same results as over plain dicts.
+        """
+        codec = get_codec('json')
+        lines = [json.dumps({'name': f'Office {i}' if i % 3 else f'Shop {i}', 'id': str(i % 20), 'n': i})
+                 for i in range(100)]
+        pipeline = [
+            Transform.args_from_dict({'operation': 'filter_regex', 'field': 'name', 'regex': 'Office'}),
+            Transform.args_from_dict({'operation': 'dedupe', 'field': 'id'}),
+            Transform.args_from_dict({'operation': 'template', 'field': '{name}-{n}', 'target': 'key'}),
+            Transform.args_from_dict({'operation': 'remove_fields', 'field': 'n'}),
+        ]
+        expected = [json.dumps(d) for d in Transform.chain(map(json.loads, lines), pipeline)]
+        for run in (Transform.chain, lambda dataset, p: Transform.compile(p)(dataset)):
+            self.assertEqual([codec.encode(d) for d in run(map(codec.lazy_decode, lines), pipeline)], expected)
+        filtered = [codec.encode(d) for d in Transform.compile(pipeline[:2])(map(codec.lazy_decode, lines))]
+        self.assertEqual(filtered, [line for line in lines if json.loads(line) in
+                                    list(Transform.chain(map(json.loads, lines), pipeline[:2]))])
+
+    @skipUnless(orjson, 'orjson is not installed')
+    def test_orjson(self):
+        codec = get_codec('orjson')
+        for line in LINES:
+            self.assertEqual(codec.decode(line), json.loads(line))
+            self.assertEqual(json.loads(codec.encode(json.loads(line))), json.loads(line))
+        self.assertEqual(get_codec('auto').name, 'orjson')
+
+    def test_pickle(self):
+        codec = deepcopy(get_codec('json'))
+        self.assertIsInstance(codec, Codec)
+        self.assertEqual(codec.decode('{"a": 1}'), {'a': 1})
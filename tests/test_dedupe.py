@@ -0,0 +1,68 @@
+from copy import deepcopy
+from unittest import TestCase
+
+from json_pipeline.transform import Transform
+from json_pipeline.dedupe import MemorySeen, SqliteSeen, BloomSeen
+
+
+class DedupeTest(TestCase):
+
+    dataset = [{'name': f'Office {i % 10}', 'city': 'NY' if i % 4 else 'LA', 'id': str(i)} for i in range(100)]
+
+    def test_backends(self):
+        """All backends give the same result as the default one when there are no false positives.
+        """
+        expected = list(Transform().run(deepcopy(self.dataset),
+                                        Transform.args_from_dict({'operation': 'dedupe', 'field': 'name'})))
+        self.assertEqual(len(expected), 10)
+        for backend in ('memory', 'sqlite', 'bloom'):
+            for hash_keys in (False, True):
+                args = Transform.args_from_dict({'operation': 'dedupe', 'field': 'name', 'backend': backend,
+                                                 'hash_keys': hash_keys})
+                self.assertEqual(list(Transform().run(deepcopy(self.dataset), args)), expected)
+                self.assertEqual(list(Transform.compile([args])(deepcopy(self.dataset))), expected)
+
+    def test_composite_key(self):
+        """Dedupe on several fields at once. Records missing any of them always survive.
+        """
+        args = Transform.args_from_dict({'operation': 'dedupe', 'field': 'name,city'})
+        dataset = deepcopy(self.dataset) + [{'name': 'Office 1'}]
+        result = list(Transform().run(dataset, args))
+        self.assertEqual(len(result), 16)
+        self.assertEqual(result, list(Transform.compile([args])(deepcopy(self.dataset) + [{'name': 'Office 1'}])))
+
+    def test_single_field_forms(self):
+        """A one-element list key works like the plain field, in every execution mode, and without a field
+        records pass through as they always did.
+        """
+        expected = list(Transform().run(deepcopy(self.dataset),
+                                        Transform.args_from_dict({'operation': 'dedupe', 'field': 'name'})))
+        args = Transform.args_from_dict({'operation': 'dedupe', 'field': ['name']})
+        self.assertEqual(list(Transform().run(deepcopy(self.dataset), args)), expected)
+        self.assertEqual(list(Transform.compile([args])(deepcopy(self.dataset))), expected)
+        self.assertEqual(list(Transform.batched([args], 7)(deepcopy(self.dataset))), expected)
+        args = Transform.args_from_dict({'operation': 'dedupe'})
+        self.assertEqual(list(Transform().run(deepcopy(self.dataset), args)), self.dataset)
+        self.assertEqual(list(Transform.compile([args])(deepcopy(self.dataset))), self.dataset)
+        self.assertEqual(list(Transform.batched([args], 7)(deepcopy(self.dataset))), self.dataset)
+        args = Transform.args_from_dict({'operation': 'dedupe', 'backend': 'sqlite'})
+        self.assertEqual(list(Transform().run(deepcopy(self.dataset), args)), self.dataset)
+
+    def test_stores(self):
+        for store in (MemorySeen(), MemorySeen(hash_keys=True), SqliteSeen(), SqliteSeen(hash_keys=True)):
+            self.assertTrue(store.add('a'))
+            self.assertTrue(store.add(('a', 'b')))
+            self.assertFalse(store.add('a'))
+            self.assertFalse(store.add(('a', 'b')))
+            self.assertEqual(len(store), 2)
+
+    def test_bloom_error_rate(self):
+        """Bloom filter size is fixed by capacity and error_rate, and false positives stay around error_rate.
+        """
+        store = BloomSeen(capacity=10000, error_rate=0.01)
+        self.assertLess(len(store.bits), 12500)
+        for i in range(0, 20000, 2):
+            store.add(f'key{i}')
+        self.assertFalse(any(store.add(f'key{i}') for i in range(0, 20000, 2)))
+        false_positives = sum(f'key{i}' in store for i in range(1, 20000, 2))
+        self.assertLess(false_positives, 200)
@@ -0,0 +1,221 @@
+import os
+import bz2
+import gzip
+import lzma
+import json
+import time
+import tempfile
+import threading
+from unittest import TestCase, skipUnless
+
+from json_pipeline.transform import TransformScript
+from json_pipeline.fileio import (InputFile, MultiInput, FollowFile, ShardedOutput, open_output, iter_lines,
+                                  detect_compression, expand_input, shard_of)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+LINES = [json.dumps({'id': str(i), 'name': f'Offîce {i}' * (i % 7)}) for i in range(500)]
+
+
+class FileIOTest(TestCase):
+
+    def test_iter_lines(self):
+        """Lines are split right across block boundaries, with or without a final newline.
+        """
+        for data in ('\n'.join(LINES) + '\n', '\n'.join(LINES), ''):
+            encoded = data.encode('utf-8')
+            for block_size in (1, 7, 64, 1 << 20):
+                blocks = (encoded[i:i + block_size] for i in range(0, len(encoded), block_size))
+                self.assertEqual(list(iter_lines(lambda _: next(blocks, b''), block_size)),
+                                 data.splitlines())
+
+    def test_detect_compression(self):
+        self.assertEqual(detect_compression('data.jsonl.GZ'), 'gzip')
+        self.assertEqual(detect_compression('data.jl', gzip.compress(b'{}')), 'gzip')
+        self.assertEqual(detect_compression('data.jl', bz2.compress(b'{}')), 'bz2')
+        self.assertEqual(detect_compression('data.jl', lzma.compress(b'{}')), 'xz')
+        self.assertIsNone(detect_compression('data.jl', b'{"a": 1}'))
+
+    def test_roundtrip(self):
+        """Files written compressed according to their extension are read back, also if misnamed.
+        """
+        extensions = ['', '.gz', '.bz2', '.xz'] + (['.zst'] if zstandard else [])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for extension in extensions:
+                path = os.path.join(tmpdir, 'data.jl' + extension)
+                output = open_output(path, level=1)
+                output.write('\n'.join(LINES) + '\n')
+                output.close()
+                for readpath in (path, path + '.renamed'):
+                    if readpath != path:
+                        os.rename(path, readpath)
+                    infile = InputFile(readpath)
+                    self.assertEqual(list(infile), LINES)
+                    infile.close()
+            empty = os.path.join(tmpdir, 'empty.jl')
+            open(empty, 'w').close()
+            self.assertEqual(list(InputFile(empty)), [])
+
+    @skipUnless(zstandard, 'zstandard is not installed')
+    def test_zstd_frames(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'data.jl.zst')
+            compressor = zstandard.ZstdCompressor()
+            with open(path, 'wb') as f:
+                f.write(compressor.compress(b'{"a": 1}\n') + compressor.compress(b'{"a": 2}\n'))
+            self.assertEqual(list(InputFile(path)), ['{"a": 1}', '{"a": 2}'])
+
+    def test_main_compressed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inpath, outpath = os.path.join(tmpdir, 'in.jl.gz'), os.path.join(tmpdir, 'out.jl.bz2')
+            with gzip.open(inpath, 'wt') as f:
+                f.write('\n'.join(LINES) + '\n')
+            script = TransformScript(['--input', inpath, '--output', outpath, '--compress-level', '1',
+                                      'filter_regex', '--field', 'id', '--regex', '^1'])
+            try:
+                script.main()
+            finally:
+                script.close()
+            with bz2.open(outpath, 'rt') as f:
+                result = [json.loads(l)['id'] for l in f]
+        self.assertEqual(result, [str(i) for i in range(500) if str(i).startswith('1')])
+
+    def _write_shards(self, tmpdir):
+        paths = []
+        for i, (opener, extension) in enumerate(((open, ''), (gzip.open, '.gz'), (bz2.open, '.bz2'), (open, ''))):
+            path = os.path.join(tmpdir, f'part-{i}.jl{extension}')
+            with opener(path, 'wt') as f:
+                f.write(''.join(l + '\n' for l in LINES[i * 100:(i + 1) * 100]))
+            paths.append(path)
+        open(os.path.join(tmpdir, '.hidden'), 'w').close()
+        return paths
+
+    def test_multi_input(self):
+        """Files are read ahead concurrently, and their lines come out in file order.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = self._write_shards(tmpdir)
+            self.assertEqual(expand_input(tmpdir), sorted(paths))
+            self.assertEqual(expand_input(os.path.join(tmpdir, 'part-*.jl')), [paths[0], paths[3]])
+            self.assertEqual(expand_input(paths[1]), [paths[1]])
+            with self.assertRaises(FileNotFoundError):
+                expand_input(os.path.join(tmpdir, '*.csv'))
+            for readers in (1, 2, 8):
+                infile = MultiInput(sorted(paths), readers=readers, block_size=256, queue_size=2)
+                self.assertEqual(list(infile), LINES[:400])
+                infile.close()
+            blocks = MultiInput(paths).file_blocks()
+            self.assertEqual({path for path, _ in blocks}, set(paths))
+            with self.assertRaises(FileNotFoundError):
+                list(MultiInput([paths[0], os.path.join(tmpdir, 'missing.jl')]))
+
+    def test_main_multi_input(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = self._write_shards(tmpdir)
+            outpath = os.path.join(tmpdir, 'out', 'data-{shard:02d}.jl')
+            os.mkdir(os.path.dirname(outpath))
+            script = TransformScript(['--input', os.path.join(tmpdir, 'part-*'), '--output', outpath,
+                                      '--provenance-field', 'source', '--shards', '3', '--shard-key', 'name',
+                                      'filter_regex', '--field', 'id', '--regex', '0$'])
+            try:
+                script.main()
+            finally:
+                script.close()
+            shards = []
+            for shard in range(3):
+                with open(outpath.format(shard=shard)) as f:
+                    shards.append([json.loads(l) for l in f])
+        result = sorted((d for shard in shards for d in shard), key=lambda d: int(d['id']))
+        self.assertEqual([d['id'] for d in result], [str(i) for i in range(0, 400, 10)])
+        self.assertEqual(result[-1]['source'], sorted(paths)[3])
+        for shard, records in enumerate(shards):
+            self.assertTrue(records)
+            self.assertTrue(all(shard_of(d['name'], 3) == shard for d in records))
+
+    def test_round_robin_shards(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inpath = os.path.join(tmpdir, 'in.jl')
+            with open(inpath, 'w') as f:
+                f.write('\n'.join(LINES) + '\n')
+            template = os.path.join(tmpdir, 'out-{shard}.jl.gz')
+            script = TransformScript(['--input', inpath, '--output', template, '--shards', '4', '--buffer-size', '7',
+                                      'plaintext', '--field', 'id'])
+            try:
+                script.main()
+            finally:
+                script.close()
+            shards = []
+            for shard in range(4):
+                with gzip.open(template.format(shard=shard), 'rt') as f:
+                    shards.append(f.read().splitlines())
+            self.assertEqual([len(lines) for lines in shards], [125] * 4)
+            self.assertEqual(shards[1][:2], [LINES[1], LINES[5]])
+            with self.assertRaisesRegex(ValueError, 'must contain'):
+                ShardedOutput(os.path.join(tmpdir, 'out.jl'), 2)
+
+    def _append(self, path, lines, delay=0.01):
+        for line in lines:
+            with open(path, 'a') as f:
+                f.write(line)
+            time.sleep(delay)
+
+    def test_follow(self):
+        """Appended lines are read as they come, across rotations and truncations, until the idle timeout.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'in.jl')
+            with open(path, 'w') as f:
+                f.write('a\nb\n')
+
+            def produce():
+                self._append(path, ['c\n', 'd', 'e\n'])
+                os.rename(path, path + '.1')
+                self._append(path, ['f\n', 'g'])
+                # a truncation is only noticed if the file is shorter than what was read of it when polled
+                with open(path, 'w') as f:
+                    f.write('h\n')
+                time.sleep(0.1)
+                self._append(path, ['i\n'])
+
+            infile = FollowFile(path, poll_interval=0.01, idle_timeout=0.5, block_size=4)
+            producer = threading.Thread(target=produce)
+            producer.start()
+            try:
+                lines = [l for lines, _ in infile.blocks() for l in lines]
+            finally:
+                producer.join()
+                infile.close()
+            self.assertEqual(lines, ['a', 'b', 'c', 'de', 'f', 'h', 'i'])
+            self.assertEqual(infile.rotations, 2)
+            with gzip.open(path + '.gz', 'wt') as f:
+                f.write('a\n')
+            with self.assertRaisesRegex(ValueError, 'compressed'):
+                FollowFile(path + '.gz')
+
+    def test_main_follow(self):
+        """With --follow, the pipeline (and the dedupe state) stays alive over the appended records, whose
+        results are written within --flush-interval.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inpath, outpath = os.path.join(tmpdir, 'in.jl'), os.path.join(tmpdir, 'out.jl')
+            open(inpath, 'w').close()
+            script = TransformScript(['--input', inpath, '--output', outpath, '--follow', '--poll-interval', '0.01',
+                                      '--flush-interval', '0.02', '--idle-timeout', '1', 'dedupe', '--field', 'id'])
+            thread = threading.Thread(target=script.main)
+            thread.start()
+            try:
+                self._append(inpath, [json.dumps({'id': i % 3}) + '\n' for i in range(6)])
+                time.sleep(0.3)
+                with open(outpath) as f:
+                    self.assertEqual([json.loads(l)['id'] for l in f], [0, 1, 2])
+            finally:
+                thread.join()
+                script.close()
+            for options in (['--workers', '2'], ['--shards', '2']):
+                with self.assertRaises(SystemExit):
+                    TransformScript(['--input', inpath, '--output', outpath, '--follow'] + options +
+                                    ['plaintext', '--field', 'id'])
@@ -0,0 +1,184 @@
+import os
+import json
+import asyncio
+import tempfile
+from copy import deepcopy
+from unittest import TestCase, mock
+
+from json_pipeline.transform import Transform, TransformScript
+from json_pipeline import groupby
+from json_pipeline.groupby import GroupStore, parse_aggregation
+
+
+AGGREGATIONS = ['count', 'sum:price', 'min:price', 'max:price', 'first:id', 'last:id', 'collect:id',
+                'cities=distinct:city', 'count:discount']
+
+
+class Interrupted(Exception):
+    pass
+
+
+def crash_once(d, args):
+    if GroupScript.crash_at == d['id']:
+        GroupScript.crash_at = None
+        raise Interrupted()
+    return d
+
+
+class GroupScript(TransformScript):
+    crash_at = None
+    PIPELINE = {
+        'totals': [
+            Transform.args_from_dict({'operation': 'function', 'field': crash_once}),
+            Transform.args_from_dict({'operation': 'group_by', 'field': 'key', 'max_groups': 50,
+                                      'aggregations': ['count', 'sum:price', 'first:id', 'collect:id']}),
+        ],
+    }
+
+
+class GroupByTest(TestCase):
+
+    dataset = [{'id': i, 'key': f'k{i * 7 % 23}', 'city': ['NY', 'LA', 'SF'][i % 3 if i % 23 else 0],
+                'price': i % 10, **({'discount': 1} if i % 5 == 0 else {})} for i in range(300)]
+
+    def _group(self, dataset, **args):
+        args = Transform.args_from_dict({'operation': 'group_by', 'field': 'key', 'aggregations': AGGREGATIONS,
+                                         **args})
+        return list(Transform().run(deepcopy(dataset), args))
+
+    def test_aggregations(self):
+        """Each group is reduced to one record with the key and the aggregation results, in the order of
+        their first record.
+        """
+        result = self._group(self.dataset)
+        self.assertEqual([d['key'] for d in result], list(dict.fromkeys(d['key'] for d in self.dataset)))
+        records = [d for d in self.dataset if d['key'] == 'k7']
+        self.assertEqual(result[1], {
+            'key': 'k7',
+            'count': len(records),
+            'sum_price': sum(d['price'] for d in records),
+            'min_price': min(d['price'] for d in records),
+            'max_price': max(d['price'] for d in records),
+            'first_id': records[0]['id'],
+            'last_id': records[-1]['id'],
+            'collect_id': [d['id'] for d in records],
+            'cities': len({d['city'] for d in records}),
+            'count_discount': sum(1 for d in records if 'discount' in d),
+        })
+        self.assertEqual(result[0]['cities'], 1)
+        empty = self._group([{'key': 'a'}])
+        self.assertEqual(empty[0]['sum_price'], None)
+        self.assertEqual((empty[0]['count'], empty[0]['cities'], empty[0]['collect_id']), (1, 0, None))
+
+    def test_composite_key(self):
+        args = Transform.args_from_dict({'operation': 'group_by', 'field': 'key,city'})
+        result = list(Transform().run(deepcopy(self.dataset), args))
+        self.assertEqual(result[0], {'key': 'k0', 'city': 'NY', 'count': 14})
+        self.assertEqual(sum(d['count'] for d in result), len(self.dataset))
+        result = list(Transform().run([{'key': 'a'}, {}], args))
+        self.assertEqual(result, [{'key': 'a', 'city': None, 'count': 1}, {'key': None, 'city': None, 'count': 1}])
+
+    def test_spill(self):
+        """Beyond max_groups groups, partial aggregates are spilled to disk and merged at the end, with the same
+        results (sorted by key) as in memory.
+        """
+        expected = sorted(self._group(self.dataset), key=lambda d: json.dumps(d['key']))
+        for max_groups in (1, 5, 22):
+            self.assertEqual(self._group(self.dataset, max_groups=max_groups), expected)
+        with mock.patch.object(groupby, 'MERGE_FANIN', 3):
+            store = GroupStore(['count'], max_groups=2)
+            for d in self.dataset:
+                store.add(d['key'], d)
+            self.assertLess(len(store.runs), 3)
+            runs = list(store.runs)
+            self.assertEqual([count for _, (count,) in store.results()], [d['count'] for d in expected])
+        self.assertFalse(any(os.path.exists(path) for path in runs))
+
+    def test_null_values(self):
+        """Null values are skipped by sum, min and max, whatever the order of the records, and kept by the
+        other functions, in memory and spilled.
+        """
+        aggregations = ['first:v', 'last:v', 'sum:v', 'min:v', 'max:v', 'collect:v', 'distinct:v', 'count:v']
+        for dataset in ([{'k': 1, 'v': None}, {'k': 1, 'v': 2}], [{'k': 1, 'v': 2}, {'k': 1, 'v': None}]):
+            expected = {'k': 1, 'first_v': dataset[0]['v'], 'last_v': dataset[1]['v'], 'sum_v': 2, 'min_v': 2,
+                        'max_v': 2, 'collect_v': [d['v'] for d in dataset], 'distinct_v': 2, 'count_v': 2}
+            for max_groups in (None, 1):
+                result = self._group(dataset + [{'k': 2, 'v': None}], field='k', aggregations=aggregations,
+                                     max_groups=max_groups)
+                self.assertEqual(result[0], expected)
+                self.assertEqual(result[1], {'k': 2, 'first_v': None, 'last_v': None, 'sum_v': None, 'min_v': None,
+                                             'max_v': None, 'collect_v': [None], 'distinct_v': 1, 'count_v': 1})
+
+    def test_list_keys(self):
+        """Key values can be lists or dicts, grouped by their JSON value.
+        """
+        dataset = [{'k': [1, 2], 'c': 'a'}, {'k': {'x': 1}, 'c': 'a'}, {'k': [1, 2], 'c': 'b'}, {'k': 3, 'c': 'a'}]
+        expected = [{'k': [1, 2], 'count': 2}, {'k': {'x': 1}, 'count': 1}, {'k': 3, 'count': 1}]
+        self.assertEqual(self._group(dataset, field='k', aggregations=['count']), expected)
+        self.assertEqual(self._group(dataset, field='k', aggregations=['count'], max_groups=1),
+                         sorted(expected, key=lambda d: json.dumps(d['k'], sort_keys=True)))
+        self.assertEqual(self._group(dataset, field='k,c', aggregations=['count']),
+                         [{'k': [1, 2], 'c': 'a', 'count': 1}, {'k': {'x': 1}, 'c': 'a', 'count': 1},
+                          {'k': [1, 2], 'c': 'b', 'count': 1}, {'k': 3, 'c': 'a', 'count': 1}])
+
+    def test_parse_aggregation(self):
+        self.assertEqual(parse_aggregation('count'), ('count', 'count', None))
+        self.assertEqual(parse_aggregation('sum:price'), ('sum_price', 'sum', 'price'))
+        self.assertEqual(parse_aggregation('total=sum:price'), ('total', 'sum', 'price'))
+        for spec in ('avg:price', 'sum'):
+            with self.assertRaises(ValueError):
+                parse_aggregation(spec)
+
+    def test_main(self):
+        """The CLI takes aggregations with --aggregate, and a run interrupted after some groups were spilled
+        resumes from its checkpoint with the same output.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inpath = os.path.join(tmpdir, 'in.jl')
+            with open(inpath, 'w') as f:
+                for i in range(3000):
+                    f.write(json.dumps({'id': str(i), 'key': str(i * 7 % 400), 'price': i % 10}) + '\n')
+
+            def run(outpath, *options):
+                script = GroupScript(['--input', inpath, '--output', outpath, *options])
+                try:
+                    script.main()
+                finally:
+                    script.close()
+
+            expected = os.path.join(tmpdir, 'expected.jl')
+            run(expected, 'preset', '--target', 'totals')
+            with open(expected) as f:
+                records = [json.loads(l) for l in f]
+            self.assertEqual(len(records), 400)
+            self.assertEqual(sum(d['count'] for d in records), 3000)
+            outpath, checkpoint = os.path.join(tmpdir, 'out.jl'), os.path.join(tmpdir, 'out.checkpoint')
+            options = ('--checkpoint', checkpoint, '--checkpoint-interval', '0')
+            GroupScript.crash_at = '2500'
+            with self.assertRaises(Interrupted):
+                run(outpath, *options, 'preset', '--target', 'totals')
+            run(outpath, *options, '--resume', 'preset', '--target', 'totals')
+            with open(outpath) as f, open(expected) as g:
+                self.assertEqual(f.read(), g.read())
+
+            outpath = os.path.join(tmpdir, 'cli.jl')
+            run(outpath, 'group_by', '--field', 'key', '--aggregate', 'n=count', '--aggregate', 'sum:price',
+                '--max-groups', '100')
+            with open(outpath) as f:
+                result = [json.loads(l) for l in f]
+            self.assertEqual([(d['key'], d['n'], d['sum_price']) for d in result],
+                             [(d['key'], d['count'], d['sum_price']) for d in records])
+            for options in (['--field', 'key', '--aggregate', 'avg:price'], ['--aggregate', 'count']):
+                with self.assertRaises(SystemExit):
+                    GroupScript(['--input', inpath, '--output', outpath, 'group_by', *options])
+
+    def test_async(self):
+        """group_by runs over the whole stream in async pipelines too.
+        """
+        args = Transform.args_from_dict({'operation': 'group_by', 'field': 'key', 'aggregations': AGGREGATIONS,
+                                         'max_groups': 5})
+        expected = list(Transform().run(deepcopy(self.dataset), args))
+
+        async def collect():
+            return [d async for d in Transform().arun(deepcopy(self.dataset), args, batch_size=7)]
+        self.assertEqual(asyncio.run(collect()), expected)
@@ -0,0 +1,104 @@
+import os
+import json
+import tempfile
+from copy import deepcopy
+from unittest import TestCase
+
+from json_pipeline.transform import Transform, TransformScript
+from json_pipeline.lookup import ReferenceIndex, build_index, index_path
+
+
+class LookupTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.reference = os.path.join(self.tmpdir.name, 'stores.jl')
+        with open(self.reference, 'w') as f:
+            for i in range(100):
+                f.write(json.dumps({'store_id': str(i), 'city': f'City {i % 7}', 'size': i}) + '\n')
+            f.write(json.dumps({'store_id': '1', 'city': 'Duplicated'}) + '\n')
+        self.dataset = [{'name': f'Office {i}', 'store': str(i * 3)} for i in range(50)] + [{'name': 'No store'}]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_index(self):
+        """The index is built once and reused while the reference file doesn't change.
+        """
+        path = build_index(self.reference, 'store_id')
+        self.assertEqual(path, index_path(self.reference, 'store_id'))
+        mtime = os.stat(path).st_mtime_ns
+        self.assertEqual(build_index(self.reference, 'store_id'), path)
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+        index = ReferenceIndex(self.reference, 'store_id', cache_size=10)
+        self.assertEqual(index.get('1'), {'store_id': '1', 'city': 'City 1', 'size': 1})
+        self.assertIsNone(index.get(1))
+        keys = [str(i) for i in range(0, 200, 3)] * 2
+        self.assertEqual(index.get_many(keys), [index.get(k) for k in keys])
+        self.assertEqual(index.stats()['size'], 10)
+        with open(self.reference, 'a') as f:
+            f.write(json.dumps({'store_id': 'new'}) + '\n')
+        self.assertEqual(ReferenceIndex(self.reference, 'store_id').get('new'), {'store_id': 'new'})
+
+    def test_lookup(self):
+        args = Transform.args_from_dict({'operation': 'lookup', 'field': 'store', 'reference': self.reference,
+                                         'reference_key': 'store_id'})
+        result = list(Transform().run(deepcopy(self.dataset), args))
+        self.assertEqual(result[1], {'name': 'Office 1', 'store': '3', 'city': 'City 3', 'size': 3})
+        self.assertEqual(result[40], {'name': 'Office 40', 'store': '120'})
+        self.assertEqual(result[-1], {'name': 'No store'})
+        self.assertEqual(list(Transform().run(deepcopy(self.dataset), args, batch_size=16)), result)
+        args = args._replace(target='ref')
+        result = list(Transform().run(deepcopy(self.dataset), args))
+        self.assertEqual(result[2]['ref'], {'store_id': '6', 'city': 'City 6', 'size': 6})
+
+    def test_cached_rows(self):
+        """Changes to the nested values added by a lookup don't reach the records of the same key after it.
+        """
+        reference = os.path.join(self.tmpdir.name, 'nested.jl')
+        with open(reference, 'w') as f:
+            f.write(json.dumps({'id': 1, 'address': {'city': 'NY'}, 'tags': ['a']}) + '\n')
+
+        def change(d, args):
+            row = d.get('ref', d)
+            row['address']['city'] = 'LA'
+            row['tags'].append('b')
+            return d
+        for target in (None, 'ref'):
+            pipeline = [Transform.args_from_dict({'operation': 'lookup', 'field': 'id', 'reference': reference,
+                                                  'target': target}),
+                        Transform.args_from_dict({'operation': 'function', 'field': change})]
+            for run in (lambda dataset: Transform.chain(dataset, pipeline), Transform.batched(pipeline, 2)):
+                rows = [d.get('ref', d) for d in run([{'id': 1} for _ in range(3)])]
+                self.assertEqual([(r['address'], r['tags']) for r in rows], [({'city': 'LA'}, ['a', 'b'])] * 3)
+
+    def test_lookup_csv(self):
+        reference = os.path.join(self.tmpdir.name, 'stores.csv')
+        with open(reference, 'w') as f:
+            f.write('store,city\n3,Springfield\n')
+        with open(os.path.join(self.tmpdir.name, 'in.jl'), 'w') as f:
+            f.write('\n'.join(json.dumps(d) for d in self.dataset[:3]) + '\n')
+        outpath = os.path.join(self.tmpdir.name, 'out.jl')
+        script = TransformScript(['--input', os.path.join(self.tmpdir.name, 'in.jl'), '--output', outpath,
+                                  'lookup', '--field', 'store', '--reference', reference])
+        try:
+            script.main()
+        finally:
+            script.close()
+        with open(outpath) as f:
+            self.assertEqual([json.loads(l).get('city') for l in f], [None, 'Springfield', None])
+
+    def test_csv_number_keys(self):
+        """CSV values are strings, so number keys are looked up in CSV references by their str().
+        """
+        reference = os.path.join(self.tmpdir.name, 'stores.csv')
+        with open(reference, 'w') as f:
+            f.write('store,city\n3,Springfield\nTrue,Shelbyville\n')
+        index = ReferenceIndex(reference, 'store')
+        self.assertEqual(index.get(3), index.get('3'))
+        self.assertEqual(index.get_many([3, True, 3.0, [3]]), [index.get('3'), index.get('True'), None, None])
+        dataset = [{'store': 3}, {'store': '3'}, {'store': 4}]
+        args = Transform.args_from_dict({'operation': 'lookup', 'field': 'store', 'reference': reference})
+        expected = [{'store': 3, 'city': 'Springfield'}, {'store': '3', 'city': 'Springfield'}, {'store': 4}]
+        self.assertEqual(list(Transform().run(deepcopy(dataset), args)), expected)
+        self.assertEqual(list(Transform().run(deepcopy(dataset), args, batch_size=2)), expected)
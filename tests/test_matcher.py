@@ -0,0 +1,57 @@
+import os
+import re
+import random
+import tempfile
+from copy import deepcopy
+from unittest import TestCase
+
+from json_pipeline.transform import Transform
+from json_pipeline.matcher import MultiMatcher, trie_regex, load_patterns
+
+
+class MatcherTest(TestCase):
+
+    def test_trie_regex(self):
+        keywords = ['foo', 'foobar', 'fob', 'bar', 'a.b']
+        regex = re.compile(trie_regex(keywords))
+        for keyword in keywords:
+            self.assertEqual(regex.fullmatch(keyword).group(), keyword)
+        self.assertIsNone(regex.search('fo ba axb'))
+
+    def test_multi_matcher(self):
+        """The matcher finds the same records as searching every pattern on its own, and reports a pattern
+        that matches.
+        """
+        rnd = random.Random(3)
+        words = [''.join(rnd.choice('abcdef') for _ in range(rnd.randint(3, 6))) for _ in range(200)]
+        texts = [' '.join(''.join(rnd.choice('abcdef') for _ in range(5)) for _ in range(5)) for _ in range(300)]
+        for patterns, flags in ((words, 0), (words, re.I), (words + [r'a\d', r'(b)\1c', r'(?P<x>ff)e'], 0),
+                                ([r'(?i)ab', 'cd'], 0)):
+            matcher = MultiMatcher(patterns, flags)
+            regexes = [re.compile(p, flags) for p in patterns]
+            for text in texts + [t.upper() for t in texts[:50]]:
+                expected = any(r.search(text) for r in regexes)
+                pattern = matcher.match(text)
+                self.assertEqual(pattern is not None, expected)
+                self.assertEqual(matcher.search(text), expected)
+                if pattern is not None:
+                    self.assertTrue(re.search(pattern, text, flags))
+        self.assertEqual(MultiMatcher(['b(c)', 'a', r'(\w)\1']).match('xx bd'), r'(\w)\1')
+        self.assertEqual(MultiMatcher(['b(c)', 'a']).match('abc'), 'a')
+
+    def test_filter_regex_patterns(self):
+        dataset = [{'name': 'Office North'}, {'name': 'Shop'}, {'name': 'Store 12'}, {'other': 'x'}]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'patterns.txt')
+            with open(path, 'w') as f:
+                f.write('# keywords\nshop\n\n')
+            self.assertEqual(load_patterns(path), ['shop'])
+            steps = [
+                Transform.args_from_dict({'operation': 'filter_regex', 'field': 'name', 'regex': ['north', r'\d+'],
+                                          'patterns_file': path, 'regex_flags': ['I'], 'target': 'matched'}),
+                Transform.args_from_dict({'operation': 'filter_regex_neg', 'field': 'name', 'regex': ['x', '2$']}),
+            ]
+            expected = [{'name': 'Office North', 'matched': 'north'}, {'name': 'Shop', 'matched': 'shop'},
+                        {'other': 'x'}]
+            self.assertEqual(list(Transform.chain(deepcopy(dataset), steps)), expected)
+            self.assertEqual(list(Transform.compile(steps)(deepcopy(dataset))), expected)
@@ -0,0 +1,122 @@
+import time
+from copy import deepcopy
+from unittest import TestCase
+
+from json_pipeline.transform import Transform
+from json_pipeline.optimizer import optimize, explain
+
+
+def _args(**kwargs):
+    return Transform.args_from_dict(kwargs)
+
+
+class OptimizerTest(TestCase):
+
+    dataset = [{'name': f'Office {i}' if i % 4 else f'Shop {i}', 'id': str(i), 'description': 'Office',
+                'city': 'NY' if i % 3 else 'LA'} for i in range(100)]
+
+    def assertEquivalent(self, pipeline, optimized):
+        self.assertEqual(list(Transform.chain(deepcopy(self.dataset), optimized)),
+                         list(Transform.chain(deepcopy(self.dataset), pipeline)))
+
+    def test_push_filters(self):
+        """Filters are moved before the steps that don't write the fields they read.
+        """
+        pipeline = [
+            _args(operation='template', field='{name}-{id}', target='key'),
+            _args(operation='plaintext', field='description'),
+            _args(operation='filter_regex', field='name', regex='^office', regex_flags=['I']),
+            _args(operation='filter_regex', field='description', regex='office'),
+        ]
+        optimized, log = optimize(pipeline)
+        self.assertEqual([(s.operation, s.field) for s in optimized],
+                         [('filter_regex', 'name'), ('template', '{name}-{id}'), ('plaintext', 'description'),
+                          ('filter_regex', 'description')])
+        self.assertEqual(len(log), 2)
+        self.assertEquivalent(pipeline, optimized)
+
+    def test_barriers(self):
+        """Filters never cross stateful or opaque steps.
+        """
+        pipeline = [
+            _args(operation='dedupe', field='city'),
+            _args(operation='filter_regex', field='name', regex='Office'),
+        ]
+        optimized, log = optimize(pipeline)
+        self.assertEqual(optimized, pipeline)
+        self.assertEqual(log, [])
+
+    def test_merge(self):
+        """Consecutive remove_fields, rename_field, fixedvalue and same-field regex filters are merged.
+        """
+        pipeline = [
+            _args(operation='rename_field', field='id', target='uid'),
+            _args(operation='rename_field', field='uid', target='key'),
+            _args(operation='fixedvalue', field='chain', target='USPS'),
+            _args(operation='fixedvalue', field='country', target='US'),
+            _args(operation='remove_fields', field='description'),
+            _args(operation='remove_fields', field=['city']),
+            _args(operation='filter_regex', field='name', regex='office', regex_flags=['I']),
+            _args(operation='filter_regex', field='name', regex=r'\d$', regex_flags=['I']),
+            _args(operation='filter_regex_neg', field='name', regex='5'),
+            _args(operation='filter_regex_neg', field='name', regex='7'),
+        ]
+        optimized, _ = optimize(pipeline)
+        self.assertEqual([s.operation for s in optimized],
+                         ['filter_regex', 'filter_regex_neg', 'remove_fields', 'rename_field', 'fixedvalue'])
+        self.assertEqual(optimized[2].field, ['description', 'city'])
+        self.assertEqual(optimized[3].field, {'id': 'uid', 'uid': 'key'})
+        self.assertEqual(optimized[4].field, {'chain': 'USPS', 'country': 'US'})
+        self.assertEquivalent(pipeline, optimized)
+        self.assertEqual(list(Transform.compile(optimized)(deepcopy(self.dataset))),
+                         list(Transform.chain(deepcopy(self.dataset), pipeline)))
+
+    def test_merged_filter_long_value(self):
+        """A merged filter_regex fails fast on long values that don't match, as it is anchored at the start.
+        """
+        pipeline = [_args(operation='filter_regex', field='name', regex='office'),
+                    _args(operation='filter_regex', field='name', regex='shop')]
+        optimized, _ = optimize(pipeline)
+        self.assertEqual(len(optimized), 1)
+        self.assertTrue(optimized[0].regex.startswith('\\A'))
+        dataset = [{'name': 'x' * 32768 + ' office'}, {'name': 'shop and office ' + 'x' * 32768}]
+        start = time.perf_counter()
+        self.assertEqual(list(Transform.chain(deepcopy(dataset), optimized)), [dataset[1]])
+        self.assertLess(time.perf_counter() - start, 1)
+
+    def test_merged_filter_flags(self):
+        """Filters in verbose mode are not merged, as a comment would swallow the rest of the merged regex.
+        """
+        pipeline = [_args(operation='filter_regex', field='name', regex='office  # the kind', regex_flags=['X', 'I']),
+                    _args(operation='filter_regex', field='name', regex=r'\d $', regex_flags=['X', 'I'])]
+        optimized, _ = optimize(pipeline)
+        self.assertEqual(optimized, pipeline)
+        self.assertEquivalent(pipeline, optimized)
+
+    def test_conflicts(self):
+        """Steps are not swapped when one writes a field the other uses.
+        """
+        pipeline = [
+            _args(operation='extract', field='name', target='num', regex=r'\d+'),
+            _args(operation='filter_regex', field='num', regex='1'),
+            _args(operation='remove_fields', field='num'),
+        ]
+        optimized, log = optimize(pipeline)
+        self.assertEqual(optimized, pipeline)
+        self.assertEqual(log, [])
+
+    def test_preset_optimize(self):
+        class MyTransform(Transform):
+            PIPELINE = {
+                'offices': [
+                    _args(operation='plaintext', field='name'),
+                    _args(operation='filter_regex', field='city', regex='NY'),
+                ],
+            }
+
+        args = MyTransform.args_from_dict({'operation': 'preset', 'target': 'offices', 'optimize': True})
+        self.assertEqual([s.operation for s in MyTransform.load_pipeline(args)], ['filter_regex', 'plaintext'])
+        self.assertEqual(list(MyTransform().run(deepcopy(self.dataset), args)),
+                         list(MyTransform().run(deepcopy(self.dataset), args._replace(optimize=False))))
+        report = explain(MyTransform.PIPELINE['offices'])
+        self.assertIn('Optimized plan:\n1. filter_regex(', report)
@@ -0,0 +1,48 @@
+import io
+import json
+from copy import deepcopy
+from unittest import TestCase
+
+from json_pipeline.transform import Transform
+from json_pipeline.profiling import Profiler, progress
+
+
+class ProfiledTransform(Transform):
+    PIPELINE = {
+        'offices': [
+            Transform.args_from_dict({'operation': 'filter_regex', 'field': 'name', 'regex': r'Office'}),
+            Transform.args_from_dict({'operation': 'dedupe', 'field': 'id'}),
+            Transform.args_from_dict({'operation': 'plaintext', 'field': 'name'}),
+        ],
+    }
+
+
+class ProfilingTest(TestCase):
+
+    dataset = [{'name': f'Office {i}' if i % 4 else f'Shop {i}', 'id': str(i % 30)} for i in range(1000)]
+    args = Transform.args_from_dict({'operation': 'preset', 'target': 'offices'})
+
+    def test_profile(self):
+        """Records in and out of every stage are counted, and the results are the same as without profiler.
+        """
+        for sample in (1, 10):
+            profiler = Profiler(sample=sample)
+            result = list(ProfiledTransform().run(deepcopy(self.dataset), self.args, profiler=profiler))
+            self.assertEqual(result, list(ProfiledTransform().run(deepcopy(self.dataset), self.args)))
+            report = profiler.report()
+            self.assertEqual([(r['stage'], r['records_in'], r['records_out']) for r in report],
+                             [('input', 0, 1000), ('filter_regex(name)', 1000, 750), ('dedupe(id)', 750, 30),
+                              ('plaintext(name)', 30, 30), ('output', 30, 0)])
+            self.assertEqual(report[1]['drop_rate'], 0.25)
+            self.assertTrue(all(r['wall_time'] >= 0 and r['cpu_time'] >= 0 for r in report))
+            self.assertIsNotNone(report[1]['p99_latency'])
+            stream = io.StringIO()
+            profiler.emit('json', stream)
+            self.assertEqual(json.loads(stream.getvalue()), json.loads(json.dumps(report)))
+            profiler.emit('table', stream)
+            self.assertIn('total: 30 records', stream.getvalue())
+
+    def test_progress(self):
+        stream = io.StringIO()
+        self.assertEqual(list(progress(range(1024), interval=0, stream=stream)), list(range(1024)))
+        self.assertEqual(len(stream.getvalue().splitlines()), 4)
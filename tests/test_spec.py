@@ -0,0 +1,148 @@
+import os
+import json
+import tempfile
+from copy import deepcopy
+from unittest import TestCase, mock
+
+from json_pipeline.transform import Transform, TransformScript
+from json_pipeline import spec
+
+
+def tag(d, args):
+    d['tagged'] = True
+    return d
+
+
+SPEC = {
+    'offices': [
+        {'operation': 'filter_regex', 'field': 'name', 'regex': 'office', 'regex_flags': ['I']},
+        {'operation': 'dedupe', 'field': 'key'},
+        {'operation': 'function', 'field': 'test_spec.tag'},
+    ],
+    'plain': [
+        {'operation': 'preset', 'target': 'offices'},
+        {'operation': 'plaintext', 'field': 'name'},
+    ],
+}
+
+YAML_SPEC = """
+offices:
+  - {operation: filter_regex, field: name, regex: office, regex_flags: [I]}
+  - {operation: dedupe, field: key}
+  - {operation: function, field: test_spec.tag}
+plain:
+  - operation: preset
+    target: offices
+  - operation: plaintext
+    field: name
+"""
+
+
+class SpecTest(TestCase):
+
+    dataset = [{'key': str(i % 5), 'name': f'Office {i}' if i % 3 else f'Shop {i}'} for i in range(20)]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.dict(os.environ, {'JSON_PIPELINE_CACHE': os.path.join(self.tmpdir.name, 'cache')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(spec._LOADED.clear)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write(self, name, contents):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as f:
+            f.write(contents if isinstance(contents, str) else json.dumps(contents))
+        return path
+
+    def _expected(self):
+        result = Transform.chain(deepcopy(self.dataset), [Transform.args_from_dict(s) for s in SPEC['offices']])
+        return list(Transform.plaintext(result, Transform.args_from_dict({'field': 'name'})))
+
+    def test_pipeline_file(self):
+        """JSON and YAML specs run the same as the equivalent Args pipelines, nested presets included.
+        """
+        for name, contents in (('spec.json', SPEC), ('spec.yaml', YAML_SPEC)):
+            path = self._write(name, contents)
+            args = Transform.args_from_dict({'operation': 'preset', 'target': 'plain', 'pipeline_file': path})
+            result = list(Transform().run(deepcopy(self.dataset), args))
+            self.assertEqual(result, self._expected())
+            self.assertTrue(all(d['tagged'] for d in result))
+
+    def test_cache(self):
+        """Validated specs are cached by contents, so later loads skip parsing and validation.
+        """
+        path = self._write('spec.json', SPEC)
+        pipelines = Transform.load_pipeline_file(path)
+        # the same pipelines, so compiled presets are reused
+        self.assertIs(Transform.load_pipeline_file(path), pipelines)
+        self.assertEqual(pipelines['plain'][0].pipeline_file, os.path.abspath(path))
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir.name, 'cache', 'specs'))), 1)
+        spec._LOADED.clear()
+        with mock.patch.object(spec, 'validate_spec') as validate:
+            self.assertEqual(Transform.load_pipeline_file(path), pipelines)
+        validate.assert_not_called()
+        changed = dict(SPEC, other=[{'operation': 'plaintext', 'field': 'name'}])
+        self._write('spec.json', changed)
+        self.assertEqual(set(Transform.load_pipeline_file(path)), set(changed))
+
+    def test_function_args(self):
+        """function steps take any Args property, as all of them are passed to the function.
+        """
+        path = self._write('spec.json', {'text': [
+            {'operation': 'function', 'field': 'json_pipeline.utils.dict_to_text', 'target': 'info', 'separator': '; '},
+        ]})
+        args = Transform.args_from_dict({'operation': 'preset', 'target': 'text', 'pipeline_file': path})
+        result = list(Transform().run([{'info': {'a': 1, 'b': 2}}], args))
+        self.assertEqual(result, [{'info': 'a: 1; b: 2'}])
+
+    def test_validation(self):
+        """All the errors of a spec are reported together.
+        """
+        path = self._write('spec.json', {
+            'bad': [
+                {'operation': 'filter_regex', 'field': 'name', 'regex': '(', 'feild': 'x'},
+                {'operation': 'unknown'},
+                {'operation': 'extract', 'field': 'name', 'regex': 'a', 'regex_flags': ['X', 'NOPE']},
+                {'operation': 'dedupe', 'field': 'id', 'backend': 'redis', 'error_rate': 2},
+                {'operation': 'function', 'field': 'test_spec.missing'},
+                {'operation': 'preset', 'target': 'missing'},
+                {'operation': 'plaintext'},
+                {'operation': 'sample', 'count': -1, 'fraction': 0.5},
+                {'operation': 'group_by', 'field': 'key', 'aggregations': ['avg:price'], 'max_groups': 0},
+            ],
+        })
+        with self.assertRaises(ValueError) as cm:
+            Transform.load_pipeline_file(path)
+        errors = str(cm.exception).splitlines()[1:]
+        self.assertEqual([e.split(':')[0].strip() for e in errors],
+                         ['bad[0] (filter_regex)', 'bad[0] (filter_regex)', 'bad[1] (unknown)', 'bad[2] (extract)',
+                          'bad[3] (dedupe)', 'bad[3] (dedupe)', 'bad[4] (function)', 'bad[5] (preset)',
+                          'bad[6] (plaintext)', 'bad[7] (sample)', 'bad[7] (sample)',
+                          'bad[8] (group_by)', 'bad[8] (group_by)'])
+        self.assertIn("unknown argument 'feild'", errors[0])
+        self.assertIn("unknown regex flag 'NOPE'", errors[3])
+        with self.assertRaisesRegex(ValueError, 'mapping from names'):
+            Transform.load_pipeline_file(self._write('list.json', SPEC['offices']))
+
+    def test_main(self):
+        """The CLI validates the spec before reading any input.
+        """
+        inpath = self._write('in.jl', ''.join(json.dumps(d) + '\n' for d in self.dataset))
+        outpath = os.path.join(self.tmpdir.name, 'out.jl')
+        path = self._write('spec.yml', YAML_SPEC)
+        script = TransformScript(['--input', inpath, '--output', outpath, 'preset', '--pipeline-file', path,
+                                  '--target', 'plain'])
+        try:
+            script.main()
+        finally:
+            script.close()
+        with open(outpath) as f:
+            self.assertEqual([json.loads(l) for l in f], self._expected())
+        for target, specpath in (('missing', path), ('plain', self._write('bad.json', {'plain': [{}]}))):
+            with self.assertRaises(SystemExit):
+                TransformScript(['--input', inpath, '--output', outpath, 'preset', '--pipeline-file', specpath,
+                                 '--target', target])
@@ -1,8 +1,28 @@
+import os
 import re
-from unittest import TestCase
+import sys
+import json
+import tempfile
+import subprocess
+import tracemalloc
+from copy import deepcopy
+from unittest import TestCase, mock
+from concurrent.futures import ThreadPoolExecutor
 
-from json_pipeline.transform import Transform, Args
-from json_pipeline.utils import dict_to_text
+from json_pipeline.transform import Transform, TransformScript, Args
+from json_pipeline.utils import dict_to_text, RegexCache, REGEX_CACHE
+
+
+class PipelineTransform(Transform):
+    PIPELINE = {
+        'offices': [
+            Transform.args_from_dict({'operation': 'filter_regex', 'field': 'name', 'regex': r'office',
+                                      'regex_flags': ['I']}),
+            Transform.args_from_dict({'operation': 'plaintext', 'field': 'name'}),
+            Transform.args_from_dict({'operation': 'dedupe', 'field': 'name'}),
+            Transform.args_from_dict({'operation': 'remove_fields', 'field': 'id'}),
+        ],
+    }
 
 
 class TransformTest(TestCase):
@@ -97,6 +117,41 @@ class TransformTest(TestCase):
                   [{'name': 'Office_A', 'description': 'Headquarter', 'id': 'OffA'},
                    {'name': 'Office_B', 'description': 'Office', 'id': 'OffB'}])
 
+    def test_extract_per_item(self):
+        """Extracts with a regex formatted with each record. Compiled regexes are cached, and values can be
+        matched literally with escape_per_item.
+        """
+        REGEX_CACHE.clear()
+        args = Transform.args_from_dict({
+            'operation': 'extract',
+            'field': 'name',
+            'target': 'match',
+            'regex_per_item': r'{id}\b',
+        })
+        dataset = [{'name': 'Office A.1', 'id': 'A.1'}, {'name': 'Office A-1', 'id': 'A.1'},
+                   {'name': 'Office B', 'id': 'B'}]
+        self.assertEqual([d.get('match') for d in Transform().run(deepcopy(dataset), args)], ['A.1', 'A-1', 'B'])
+        self.assertEqual(REGEX_CACHE.stats(), {'size': 2, 'maxsize': 1024, 'hits': 1, 'misses': 2, 'evictions': 0})
+        for regex_per_item in (r'{id}\b', '{id}'):
+            args = args._replace(regex_per_item=regex_per_item, escape_per_item=True)
+            self.assertEqual([d.get('match') for d in Transform().run(deepcopy(dataset), args)], ['A.1', None, 'B'])
+            self.assertEqual([d.get('match') for d in Transform.compile([args])(deepcopy(dataset))],
+                             ['A.1', None, 'B'])
+
+    def test_regex_cache(self):
+        cache = RegexCache(maxsize=2)
+        for pattern in ('a', 'b', 'a', 'c', 'b'):
+            cache.compile(pattern)
+        self.assertEqual(cache.stats(), {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 4, 'evictions': 2})
+        self.assertIs(cache.compile('b'), cache.compile('b', 0))
+        # shared by executor threads
+        cache = RegexCache(maxsize=8)
+        with ThreadPoolExecutor(4) as executor:
+            patterns = [f'p{i % 13}' for i in range(4000)]
+            self.assertEqual([r.pattern for r in executor.map(cache.compile, patterns)], patterns)
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['hits'] + stats['misses']), (8, 4000))
+
     def test_template(self):
         """Copy given fields (in template format as per str.format() function) from each record in a dataset,
         into the given target field.
@@ -173,6 +228,21 @@ class TransformTest(TestCase):
                          [{'name': 'Office_A', 'description': 'Office'},
                           {'name': 'Office_B', 'description': 'Office'}])
 
+    def test_preset_compiled_once(self):
+        """The pipeline of a preset is compiled on its first run only, and runs keep no state between them.
+        """
+        class MyTransform(Transform):
+            PIPELINE = {'keys': [Transform.args_from_dict({'operation': 'dedupe', 'field': 'id'})]}
+
+        args = MyTransform.args_from_dict({'operation': 'preset', 'target': 'keys'})
+        dataset = [{'id': 'A'}, {'id': 'B'}, {'id': 'A'}]
+        with mock.patch.object(MyTransform, 'compile', wraps=MyTransform.compile) as compile:
+            for _ in range(3):
+                self.assertEqual(list(MyTransform().run(deepcopy(dataset), args)), [{'id': 'A'}, {'id': 'B'}])
+            self.assertEqual(compile.call_count, 1)
+            list(MyTransform().run(deepcopy(dataset), args._replace(optimize=True)))
+            self.assertEqual(compile.call_count, 2)
+
     def test_plaintext(self):
         """
         Converts text to plain:
@@ -222,3 +292,219 @@ class TransformTest(TestCase):
         self.assertEqual(list(Transform().run(dataset, args)),
                          [{'name': 'Office A', 'chain': 'USPS', 'description': 'Headquarter'},
                           {'name': 'Office B', 'chain': 'USPS', 'description': 'Office'}])
+
+    def test_limit_skip(self):
+        """limit stops pulling records once it has count of them, skip drops the first count.
+        """
+        pulled = []
+
+        def dataset():
+            for i in range(100):
+                pulled.append(i)
+                yield {'id': i}
+
+        args = Transform.args_from_dict({'operation': 'limit', 'count': 3})
+        self.assertEqual(list(Transform().run(dataset(), args)), [{'id': 0}, {'id': 1}, {'id': 2}])
+        self.assertEqual(pulled, [0, 1, 2])
+        pipeline = [Transform.args_from_dict({'operation': 'skip', 'count': 5}),
+                    Transform.args_from_dict({'operation': 'filter_regex', 'field': 'name', 'regex': 'a'}),
+                    Transform.args_from_dict({'operation': 'limit', 'count': 2})]
+        args = Transform.args_from_dict({'operation': 'preset', 'target': 'p', 'pipeline': {'p': pipeline}})
+        for batch_size in (None, 4):
+            pulled.clear()
+            result = list(Transform().run(dataset(), args, batch_size=batch_size))
+            self.assertEqual(result, [{'id': 5}, {'id': 6}])
+            self.assertLess(len(pulled), 20)
+
+    def test_sample(self):
+        """sample keeps each record with probability fraction, or count records in input order. The same seed
+        gives the same sample.
+        """
+        dataset = [{'id': i} for i in range(1000)]
+        args = Transform.args_from_dict({'operation': 'sample', 'fraction': 0.1, 'seed': 7})
+        result = list(Transform().run(deepcopy(dataset), args))
+        self.assertTrue(50 < len(result) < 150)
+        self.assertEqual(list(Transform().run(deepcopy(dataset), args)), result)
+        args = Transform.args_from_dict({'operation': 'sample', 'count': 10, 'seed': 7})
+        result = list(Transform().run(deepcopy(dataset), args))
+        self.assertEqual(len(result), 10)
+        self.assertEqual(result, sorted(result, key=lambda d: d['id']))
+        self.assertEqual(list(Transform().run(deepcopy(dataset), args)), result)
+        self.assertEqual(len(list(Transform().run(dataset[:4], args))), 4)
+        with self.assertRaises(ValueError):
+            list(Transform().run(dataset, Transform.args_from_dict({'operation': 'sample'})))
+
+    def test_run_parallel(self):
+        """Parallel execution gives the same results as the serial one, in the same order unless
+        ordered=False is given. Stateful operations (dedupe) run serially after the parallel steps.
+        """
+        args = PipelineTransform.args_from_dict({
+            'operation': 'preset',
+            'target': 'offices',
+        })
+        dataset = [{'name': f'Office {i % 50}' if i % 3 else f'Shop {i}', 'id': str(i)} for i in range(500)]
+        expected = list(PipelineTransform().run(deepcopy(dataset), args))
+        self.assertEqual(len(expected), 50)
+        result = list(PipelineTransform().run_parallel(deepcopy(dataset), args, workers=2, chunksize=7))
+        self.assertEqual(result, expected)
+        result = list(PipelineTransform().run_parallel(deepcopy(dataset), args, workers=2, chunksize=7,
+                                                       ordered=False))
+        self.assertEqual(sorted(result, key=lambda d: d['name']), sorted(expected, key=lambda d: d['name']))
+
+    def test_compile(self):
+        """A compiled pipeline gives the same results as the chained operations, and keeps no state
+        between runs.
+        """
+        pipeline = [
+            Transform.args_from_dict({'operation': 'filter_not_exists', 'field': 'name'}),
+            Transform.args_from_dict({'operation': 'filter_regex', 'field': 'name', 'regex': r'office',
+                                      'regex_flags': ['I']}),
+            Transform.args_from_dict({'operation': 'filter_regex_neg', 'field': 'name', 'regex': r'9$'}),
+            Transform.args_from_dict({'operation': 'fixedvalue', 'field': 'chain', 'target': 'USPS'}),
+            Transform.args_from_dict({'operation': 'extract', 'field': 'name', 'target': 'num',
+                                      'regex': r'(\d)(\d)'}),
+            Transform.args_from_dict({'operation': 'extract', 'field': 'name', 'target': 'match',
+                                      'regex_per_item': r'{id}$'}),
+            Transform.args_from_dict({'operation': 'template', 'field': '{chain}-{id}', 'target': 'key'}),
+            Transform.args_from_dict({'operation': 'cross_filter', 'field': 'key', 'target': 'chain'}),
+            Transform.args_from_dict({'operation': 'rename_field', 'field': 'key', 'target': 'uid'}),
+            Transform.args_from_dict({'operation': 'plaintext', 'field': 'name'}),
+            Transform.args_from_dict({'operation': 'dedupe', 'field': 'num'}),
+            Transform.args_from_dict({'operation': 'function', 'field': dict_to_text, 'target': 'hours',
+                                      'separator': ', '}),
+            Transform.args_from_dict({'operation': 'remove_fields', 'field': 'chain,match'}),
+        ]
+        dataset = [{'name': f'Office {i}', 'id': str(i % 7), 'hours': {'Mon': '9-18'}} for i in range(200)]
+        dataset.extend([{'id': 'x'}, {'name': 'Shop 1', 'id': '1'}])
+        expected = list(Transform.chain(deepcopy(dataset), pipeline))
+        self.assertTrue(0 < len(expected) < len(dataset))
+        compiled = Transform.compile(pipeline)
+        self.assertEqual(len(compiled.stages), 1)
+        self.assertEqual(list(compiled(deepcopy(dataset))), expected)
+        self.assertEqual(list(compiled(deepcopy(dataset))), expected)
+
+    def test_compile_not_fusable(self):
+        """Operations overriden in a subclass are not inlined.
+        """
+        class MyTransform(Transform):
+            @staticmethod
+            def plaintext(dataset, args):
+                for d in dataset:
+                    d[args.field] = d[args.field].upper()
+                    yield d
+
+        pipeline = [
+            Transform.args_from_dict({'operation': 'dedupe', 'field': 'name'}),
+            Transform.args_from_dict({'operation': 'plaintext', 'field': 'name'}),
+            Transform.args_from_dict({'operation': 'fixedvalue', 'field': 'chain', 'target': 'USPS'}),
+        ]
+        dataset = [{'name': 'Office A'}, {'name': 'Office A'}, {'name': 'Office B'}]
+        compiled = MyTransform.compile(pipeline)
+        self.assertEqual(len(compiled.stages), 3)
+        self.assertEqual(list(compiled(dataset)), [{'name': 'OFFICE A', 'chain': 'USPS'},
+                                                   {'name': 'OFFICE B', 'chain': 'USPS'}])
+
+
+class TransformScriptTest(TestCase):
+
+    def _write_input(self, path, count):
+        with open(path, 'w') as f:
+            for i in range(count):
+                f.write(json.dumps({'id': str(i), 'name': f'Office {i}', 'description': 'x' * 64}) + '\n')
+
+    def _run_script(self, argv):
+        script = TransformScript(argv)
+        try:
+            script.main()
+        finally:
+            script.close()
+
+    def test_main_streaming(self):
+        """Records are decoded, transformed and written one at a time.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inpath, outpath = os.path.join(tmpdir, 'in.jl'), os.path.join(tmpdir, 'out.jl')
+            self._write_input(inpath, 25)
+            self._run_script(['--input', inpath, '--output', outpath, '--buffer-size', '10',
+                              'filter_regex', '--field', 'id', '--regex', '^1'])
+            with open(outpath) as f:
+                result = [json.loads(l) for l in f]
+        self.assertEqual([d['id'] for d in result], ['1'] + [str(i) for i in range(10, 20)])
+
+    def test_main_workers(self):
+        """With --workers, lines are decoded, transformed and encoded in a pool of processes.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inpath, outpath = os.path.join(tmpdir, 'in.jl'), os.path.join(tmpdir, 'out.jl')
+            self._write_input(inpath, 1000)
+            self._run_script(['--input', inpath, '--output', outpath, '--workers', '2', '--chunk-size', '64',
+                              'filter_regex', '--field', 'id', '--regex', '7'])
+            with open(outpath) as f:
+                result = [json.loads(l)['id'] for l in f]
+        self.assertEqual(result, [str(i) for i in range(1000) if '7' in str(i)])
+
+    def test_main_lazy(self):
+        """With --lazy, records that pass unmodified are written as the original lines.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inpath, outpath = os.path.join(tmpdir, 'in.jl'), os.path.join(tmpdir, 'out.jl')
+            with open(inpath, 'w') as f:
+                f.write('{"id":"1",  "name": "Office 1"}\n{"id": "2", "name": "Office 2"}\n')
+            self._run_script(['--input', inpath, '--output', outpath, '--lazy',
+                              'filter_regex', '--field', 'id', '--regex', '1'])
+            with open(outpath) as f:
+                self.assertEqual(f.read(), '{"id":"1",  "name": "Office 1"}\n')
+
+    def test_main_limit_sample(self):
+        """limit stops reading the input, and a leading fraction sample only decodes the lines it keeps.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inpath, outpath = os.path.join(tmpdir, 'in.jl'), os.path.join(tmpdir, 'out.jl')
+            with open(inpath, 'w') as f:
+                f.write('{"id": "1"}\n{"id": "2"}\nnot json\n')
+            self._run_script(['--input', inpath, '--output', outpath, 'limit', '--count', '2'])
+            with open(outpath) as f:
+                self.assertEqual([json.loads(l)['id'] for l in f], ['1', '2'])
+
+            args = Transform.args_from_dict({'fraction': 0.3, 'seed': 3})
+            kept = list(Transform.sample(range(200), args))
+            with open(inpath, 'w') as f:
+                for i in range(200):
+                    f.write(json.dumps({'id': str(i)}) + '\n' if i in kept else 'not json\n')
+            self._run_script(['--input', inpath, '--output', outpath, 'sample', '--fraction', '0.3',
+                              '--seed', '3'])
+            with open(outpath) as f:
+                self.assertEqual([int(json.loads(l)['id']) for l in f], kept)
+            with self.assertRaises(SystemExit):
+                TransformScript(['--input', inpath, '--output', outpath, 'sample', '--count', '1',
+                                 '--fraction', '0.5'])
+
+    def test_main_constant_memory(self):
+        """Peak memory doesn't grow with the input size.
+        """
+        peaks = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for count in (5000, 50000):
+                inpath, outpath = os.path.join(tmpdir, f'in{count}.jl'), os.path.join(tmpdir, f'out{count}.jl')
+                self._write_input(inpath, count)
+                tracemalloc.start()
+                self._run_script(['--input', inpath, '--output', outpath, 'plaintext', '--field', 'name'])
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+                self.assertEqual(sum(1 for _ in open(outpath)), count)
+        self.assertLess(peaks[1], peaks[0] * 2)
+        self.assertLess(peaks[1], 2 * 1024 * 1024)
+
+    def test_lazy_startup(self):
+        """Only the options of the requested operation are built, and heavy modules are not imported.
+        """
+        script = TransformScript(['--input', os.devnull, '--output', os.devnull, 'dedupe', '--field', 'id'])
+        script.close()
+        self.assertIn('--backend', script.subparsers['dedupe'].format_usage())
+        self.assertNotIn('--field', script.subparsers['plaintext'].format_usage())
+        code = 'import sys, json_pipeline.transform; print(" ".join(sys.modules))'
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        modules = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, text=True, cwd=root,
+                                 check=True).stdout.split()
+        for module in ('sqlite3', 'multiprocessing', 'concurrent.futures', 'asyncio', 'yaml'):
+            self.assertNotIn(module, modules)